@@ -19,6 +19,7 @@ if __name__ == "__main__":
         'numpy',
         'pandas',
         'scipy',
+        'pyarrow',
         'tables', # For reading .hdf files
     ]
     test_requirements = [
@@ -40,6 +41,10 @@ if __name__ == "__main__":
         package_dir={'': 'src'},
         packages=find_packages(where='src'),
         include_package_data=True,
+        package_data={
+            # Corruption data files and the lookup tables precompiled from them
+            'vivarium_research_prl.noise': ['*.csv', 'corruption-tables.pkl'],
+        },
 
         install_requires=install_requirements,
         test_require=test_requirements,
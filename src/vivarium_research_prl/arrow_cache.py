@@ -0,0 +1,222 @@
+"""
+Module for caching decoded dataframes on local disk as Arrow IPC files, so
+that loading the same data again (e.g., the same observer outputs in every
+notebook session) memory-maps the cached file instead of decoding the
+source again.
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'vivarium_research_prl', 'arrow')
+DEFAULT_MAX_BYTES = 10 * 2**30
+CACHE_FILE_EXT = '.arrow'
+
+class ArrowCache:
+    """Cache of dataframes loaded from files, stored as uncompressed Arrow
+    IPC files in cache_dir and returned memory-mapped, so that numeric,
+    string, and categorical columns are views of the file in the page cache
+    rather than copies.
+
+    Each entry is keyed by the function that loads the data, the source
+    path and the modification times (and sizes) of the file or of the files
+    in the directory, the other arguments, and the identity of any function
+    passed as an argument or as `transform` (its module, name, bytecode,
+    default arguments, and closure variables), so changing the source or
+    the code that loads or transforms it makes a new entry. When the files
+    in cache_dir take up more than max_bytes, the least recently used ones
+    are deleted.
+
+    Example:
+        cache = ArrowCache()
+        df = cache.load(data_loading.load_shards_and_concatenate, observer_dir, '.hdf')
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, load_function, source, *args, transform=None, **kwargs):
+        """Return load_function(source, *args, **kwargs), passed through
+        transform if it isn't None, from the cache if it's there, and
+        otherwise load it and add it to the cache.
+        """
+        path = self.cache_path(load_function, source, *args, transform=transform, **kwargs)
+        if os.path.exists(path):
+            os.utime(path) # Mark as recently used
+            return read_arrow_file(path)
+        df = load_function(source, *args, **kwargs)
+        if transform is not None:
+            df = transform(df)
+        write_arrow_file(df, path)
+        self.evict(keep=path)
+        return read_arrow_file(path)
+
+    def cache_path(self, load_function, source, *args, transform=None, **kwargs):
+        """Return the path of the cache file for the arguments of load()."""
+        key_parts = [
+            _callable_identity(load_function),
+            os.path.abspath(source),
+            _source_stamp(source),
+            [_argument_identity(arg) for arg in args],
+            sorted((name, _argument_identity(value)) for name, value in kwargs.items()),
+            _callable_identity(transform) if transform is not None else None,
+        ]
+        key = hashlib.sha256(repr(key_parts).encode()).hexdigest()[:32]
+        return os.path.join(self.cache_dir, key + CACHE_FILE_EXT)
+
+    def evict(self, keep=None):
+        """Delete the least recently used cache files until the total size is
+        at most max_bytes, but never the file `keep`.
+        """
+        entries = [
+            entry for entry in os.scandir(self.cache_dir)
+            if entry.name.endswith(CACHE_FILE_EXT) and entry.is_file()
+        ]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if entry.path == keep:
+                continue
+            total_bytes -= entry.stat().st_size
+            os.remove(entry.path) # Frames already mapped from it stay valid
+
+    def clear(self):
+        """Delete all the cache files."""
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(CACHE_FILE_EXT):
+                os.remove(entry.path)
+
+    def size(self):
+        """Return the total size in bytes of the cache files."""
+        return sum(
+            entry.stat().st_size for entry in os.scandir(self.cache_dir)
+            if entry.name.endswith(CACHE_FILE_EXT)
+        )
+
+def write_arrow_file(df, path):
+    """Write a dataframe to an uncompressed Arrow IPC file (under a temporary
+    name, renamed when complete).
+    """
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temp_path, path)
+
+def read_arrow_file(path):
+    """Read a dataframe from an Arrow IPC file by memory-mapping it, without
+    copying the columns that pandas can represent as views of Arrow data.
+    """
+    import pyarrow as pa
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True)
+
+def _source_stamp(source):
+    """Return the (name, modification time, size) of the file `source`, or of
+    each file in the directory `source`, to detect changes to the source.
+    """
+    if os.path.isdir(source):
+        with os.scandir(source) as scanner:
+            return sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in scanner if entry.is_file()
+            )
+    stat = os.stat(source)
+    return [(os.path.basename(source), stat.st_mtime_ns, stat.st_size)]
+
+def _argument_identity(value, _seen=None):
+    """Represent an argument in a cache key, identifying functions by their
+    code and the values they close over, and arrays and pandas objects by a
+    hash of their contents (their reprs are truncated when they're long).
+    """
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, [_argument_identity(item, _seen) for item in value])
+    if isinstance(value, dict):
+        return ('dict', sorted(
+            (repr(key), _argument_identity(item, _seen)) for key, item in value.items()
+        ))
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            contents = repr(value.tolist()).encode()
+        else:
+            contents = np.ascontiguousarray(value).view(np.uint8)
+        return ('ndarray', value.dtype.str, value.shape, hashlib.sha256(contents).hexdigest())
+    if isinstance(value, (pd.Series, pd.DataFrame, pd.Index)):
+        is_frame = isinstance(value, pd.DataFrame)
+        names = value.columns if is_frame else [value.name]
+        row_hashes = pd.util.hash_pandas_object(value, index=not isinstance(value, pd.Index))
+        return (
+            type(value).__name__, repr(list(names)), repr(value.dtypes if is_frame else value.dtype),
+            hashlib.sha256(row_hashes.to_numpy()).hexdigest(),
+        )
+    if callable(value):
+        return _callable_identity(value, _seen)
+    return repr(value)
+
+def _callable_identity(func, _seen=None):
+    """Identify a function (or functools.partial) by its module, name, a hash
+    of its bytecode and constants, its default arguments, and the values of
+    the variables it closes over, so that editing it or making it with
+    different values (e.g., a function returned by another function) changes
+    the key. Global variables the function refers to aren't part of the key.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(func) in _seen:
+        # E.g., a nested function whose closure refers to itself
+        return 'recursive'
+    _seen = _seen | {id(func)}
+    if isinstance(func, functools.partial):
+        return (
+            _callable_identity(func.func, _seen),
+            [_argument_identity(arg, _seen) for arg in func.args],
+            sorted((name, _argument_identity(value, _seen)) for name, value in func.keywords.items()),
+        )
+    func = inspect.unwrap(func)
+    code = getattr(func, '__code__', None)
+    code_hash = _code_hash(code).hexdigest()[:16] if code is not None else None
+    closure = [
+        _argument_identity(_cell_contents(cell), _seen)
+        for cell in getattr(func, '__closure__', None) or ()
+    ]
+    defaults = _argument_identity(getattr(func, '__defaults__', None), _seen)
+    kwdefaults = _argument_identity(getattr(func, '__kwdefaults__', None), _seen)
+    bound_to = getattr(func, '__self__', None)
+    if bound_to is not None and not inspect.ismodule(bound_to):
+        # A bound method also depends on its instance
+        bound_to = _argument_identity(bound_to, _seen)
+    else:
+        bound_to = None
+    return (
+        getattr(func, '__module__', None), getattr(func, '__qualname__', repr(func)), code_hash,
+        closure, defaults, kwdefaults, bound_to,
+    )
+
+def _cell_contents(cell):
+    """Return the value in a closure cell, or a marker if it's empty."""
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return '<empty cell>'
+
+def _code_hash(code):
+    """Hash a code object's bytecode and constants, including nested code
+    objects (e.g., of lambdas), whose reprs contain memory addresses.
+    """
+    code_hash = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            code_hash.update(_code_hash(const).digest())
+        else:
+            code_hash.update(repr(const).encode())
+    return code_hash
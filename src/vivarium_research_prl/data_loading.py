@@ -1,7 +1,16 @@
+import numpy as np
 import pandas as pd
+import ast
+import collections
+import concurrent.futures
+import functools
+import io
 import os
 import re
+import tokenize
 from tqdm import tqdm
+from . import datatypes
+from .utils import sizemb
 
 def convert_csvs_to_hdf(output_dir, save_dir, nrows=None):
     """Loads all shards stored as .csv.bz2 files in all subdirectories of
@@ -20,26 +29,16 @@ def convert_csvs_to_hdf(output_dir, save_dir, nrows=None):
             continue
         print("="*50)
         print("Loading data from", observer_name, "\n")
-        shards = []
-        for filename in filenames:
-            if filename.endswith(ext):
-                filename_root = filename[:-len(ext)]
-    #             seed = filename_root[:-seed_length]
-                filepath = os.path.join(dirpath, filename)
-                shards.append(datatypes.load_csv_data(filepath, convert_str_ids=True, nrows=nrows))
-        if shards:
-            # Before concatenating the dataframes, we need to make sure they have the same categories
-            # in each categorical column, so take the union of categories across shards
-            print("\nSetting categories for", observer_name)
-            categorical_cols = [col for col in shards[0] if shards[0][col].dtype == 'category']
-            for col in categorical_cols:
-                categories = shards[0][col].cat.categories
-                for shard in shards[1:]:
-                    categories = categories.union(shard[col].cat.categories)
-                for shard in shards:
-                    shard[col] = shard[col].cat.set_categories(categories)
-            print("Concatenating data for", observer_name)
-            df = pd.concat(shards, ignore_index=True)
+        filepaths = [os.path.join(dirpath, filename) for filename in filenames if filename.endswith(ext)]
+        if filepaths:
+            # Concatenate the shards as they're loaded, taking the union of the categories
+            # in each categorical column across shards, so only one shard is in memory at a time
+            print("Loading and concatenating data for", observer_name)
+            shards = (
+                datatypes.load_csv_data(filepath, convert_str_ids=True, nrows=nrows)
+                for filepath in filepaths
+            )
+            df = concat_conforming_categories(shards)
             print("Calculating memory usage")
             print(sizemb(df), "MB")
             observer_names.append(observer_name)
@@ -50,17 +49,89 @@ def convert_csvs_to_hdf(output_dir, save_dir, nrows=None):
             )
             # Not sure if I need this, but we can delete dataframes to save memory
             del df
-            del shards
     print('\nObservers:', observer_names, '\n')
     return 
 
+def convert_csvs_to_parquet(
+    output_dir,
+    save_dir,
+    nrows=None,
+    compression='zstd',
+    compression_level=None,
+    row_group_size=None,
+    incremental=True,
+    bz2_workers=None,
+):
+    """Loads all shards stored as .csv.bz2 files in all subdirectories of
+    output_dir, converts datatypes to numerics and categoricals as in
+    convert_csvs_to_hdf, and saves each shard as a Parquet file, partitioned
+    by observer and seed: the shard '<observer>_<seed>.csv.bz2' in the
+    directory for an observer is saved to
+    save_dir/<observer>/<observer>_<seed>.parquet, so an observer's data can be
+    loaded with load_shards_and_concatenate(..., '.parquet') (e.g., in
+    parallel or for a subset of seeds) or pd.read_parquet on the directory
+    (which, unlike load_shards_and_concatenate, returns categoricals with
+    non-string categories, such as years, as plain columns).
+
+    Unlike the bzip2-compressed HDF files, the files are compressed with a
+    fast codec (zstd by default; e.g., 'lz4' or 'snappy' also work),
+    categoricals are stored dictionary-encoded, and each row group has
+    min/max statistics so that readers can skip row groups with filters.
+
+    If incremental is True, shards whose Parquet file is newer than the csv
+    are skipped, so rerunning after a partial simulation only converts the
+    new shards. Each file is written under a temporary name and renamed
+    when complete, so an interrupted conversion doesn't leave a partial
+    file behind. If bz2_workers is passed (and nrows isn't), the shards are
+    read with datatypes.load_csv_data_parallel, decompressing each file in
+    bz2_workers threads. Returns a list of the paths of the files written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    ext = '.csv.bz2'
+    written = []
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        observer_name = os.path.basename(dirpath)
+        csv_filenames = sorted(filename for filename in filenames if filename.endswith(ext))
+        if observer_name == 'logs' or not csv_filenames:
+            continue
+        print("="*50)
+        print("Converting data from", observer_name, "\n")
+        observer_save_dir = os.path.join(save_dir, observer_name)
+        os.makedirs(observer_save_dir, exist_ok=True)
+        num_skipped = 0
+        for filename in csv_filenames:
+            csv_path = os.path.join(dirpath, filename)
+            parquet_path = os.path.join(observer_save_dir, filename[:-len(ext)] + '.parquet')
+            if (incremental and os.path.exists(parquet_path)
+                    and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path)):
+                num_skipped += 1
+                continue
+            if bz2_workers is not None and nrows is None:
+                df = datatypes.load_csv_data_parallel(
+                    csv_path, convert_str_ids=True, max_workers=bz2_workers)
+            else:
+                df = datatypes.load_csv_data(csv_path, convert_str_ids=True, nrows=nrows)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            del df
+            temp_path = parquet_path + '.tmp'
+            pq.write_table(
+                table, temp_path, compression=compression, compression_level=compression_level,
+                row_group_size=row_group_size, write_statistics=True,
+            )
+            os.replace(temp_path, parquet_path)
+            written.append(parquet_path)
+        print(f"Wrote {len(csv_filenames) - num_skipped} shards, skipped {num_skipped} up-to-date shards")
+    return written
+
 def conform_categories(shards): # Operates in place...
     """Take an iterable of dataframes (shards) with identical columns,
     find the union of each of their categorical columns,
     and re-set the categories in each column to the union across shards.
     After this has been done, the dataframes can be concatenated while
     retaining the categorical dtypes, avoiding a memory blow-up from
-    conversion to string dtypes.
+    conversion to string dtypes. Use concat_conforming_categories to do
+    both at once without keeping all the shards in memory.
     """
     # Code copied from:
     # 2023_08_04_check_address_ids_2023_07_28_08_33_09.ipynb
@@ -80,6 +151,155 @@ def conform_categories(shards): # Operates in place...
             shard[col] = shard[col].cat.set_categories(categories)
     return shards
 
+def concat_conforming_categories(shards, ignore_index=True, num_rows=None):
+    """Concatenate an iterable of dataframes (shards) with identical columns,
+    taking the union of the categories of each categorical column, like
+    conform_categories followed by pd.concat, but streaming: each shard is
+    copied into the output as it arrives, so shards can be generated (e.g.,
+    loaded from files) one at a time and peak memory is about the size of
+    the result, not twice that.
+
+    Each categorical column's categories are collected in a dict from
+    category to code as they appear, and each shard's codes are remapped
+    through a lookup array from its categories to their codes; at the end,
+    the categories are sorted, as by Index.union. The other columns are
+    copied into preallocated arrays, which grow as needed unless the total
+    number of rows is passed as num_rows. Columns with pandas extension
+    dtypes (e.g., 'str') in any shard are concatenated at the end instead,
+    with the same resulting dtype as in pd.concat.
+
+    If shards is a dict and ignore_index is False, the keys become the
+    outer level of the index, as in pd.concat.
+    """
+    if isinstance(shards, dict):
+        keyed_shards = shards.items()
+    else:
+        keyed_shards = ((None, shard) for shard in shards)
+    columns = None
+    keys, lengths, indexes = [], [], []
+    for key, shard in keyed_shards:
+        if columns is None:
+            columns = {col: _ConcatenatedColumn(num_rows) for col in shard}
+        elif list(shard.columns) != list(columns):
+            raise ValueError(f'shards have different columns: {list(columns)} and {list(shard.columns)}')
+        for col, column in columns.items():
+            column.append(shard[col])
+        keys.append(key)
+        lengths.append(len(shard))
+        if not ignore_index:
+            indexes.append(shard.index)
+        del shard
+    if columns is None:
+        raise ValueError('No objects to concatenate')
+    if ignore_index:
+        index = pd.RangeIndex(sum(lengths))
+    else:
+        index = indexes[0].append(indexes[1:])
+        if isinstance(shards, dict):
+            index = pd.MultiIndex.from_arrays([np.repeat(keys, lengths), index])
+    arrays = {col: column.finish() for col, column in columns.items()}
+    # Keep the dtypes, since pandas would infer 'str' for an object column of strings
+    return pd.DataFrame({
+        col: pd.Series(array, index=index, dtype=array.dtype, copy=False)
+        for col, array in arrays.items()
+    }, copy=False)
+
+class _ConcatenatedColumn:
+    """One column of the result of concat_conforming_categories, built by
+    appending the column of each shard."""
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.length = 0
+        self.values = None # Preallocated output array (codes for categoricals)
+        self.chunks = [] # Extension arrays to concatenate at the end
+        self.code_of = None # Dict from each category to its code, for categoricals
+        self.dtype = None
+
+    def append(self, column):
+        is_categorical = isinstance(column.dtype, pd.CategoricalDtype)
+        if self.dtype is None:
+            self.dtype = column.dtype
+            if is_categorical:
+                self.code_of = {}
+        elif is_categorical != (self.code_of is not None):
+            raise TypeError(f'column {column.name!r} is categorical in some shards but not others')
+        if is_categorical:
+            categories = column.cat.categories.tolist()
+            # Map the shard's codes to global codes, with -1 (missing) mapped to the last entry
+            code_map = np.fromiter(
+                (self.code_of.setdefault(category, len(self.code_of)) for category in categories),
+                dtype=np.int32, count=len(categories))
+            code_map = np.append(code_map, np.int32(-1))
+            self._append_array(code_map[column.cat.codes.to_numpy()])
+        elif isinstance(column.dtype, np.dtype) and not self.chunks:
+            self._append_array(column.to_numpy())
+        else:
+            if self.values is not None:
+                # Mixed numpy and extension dtypes (e.g., a 'str' column that's all NaN,
+                # so float64, in some shards): concatenate all of it at the end, like pd.concat
+                self.chunks.append(self.values[:self.length])
+                self.values = None
+            self.chunks.append(column.array)
+            self.length += len(column)
+
+    def _append_array(self, values):
+        if self.values is None:
+            self.values = np.empty(max(self.capacity or 0, len(values)), dtype=values.dtype)
+        elif values.dtype != self.values.dtype:
+            self.values = self.values.astype(np.result_type(self.values, values))
+        end = self.length + len(values)
+        if end > len(self.values):
+            # Grow geometrically
+            grown = np.empty(max(end, 2 * len(self.values)), dtype=self.values.dtype)
+            grown[:self.length] = self.values[:self.length]
+            self.values = grown
+        self.values[self.length:end] = values
+        self.length = end
+
+    def finish(self):
+        """Return the concatenated column as an array."""
+        if self.chunks:
+            # Concatenate as frames, since pd.concat of frames and of Series promote dtypes differently
+            frames = [pd.DataFrame({0: chunk}, copy=False) for chunk in self.chunks]
+            return pd.concat(frames, ignore_index=True)[0].array
+        if self.length < len(self.values):
+            self.values = self.values[:self.length].copy() # Free the unused capacity
+        if self.code_of is None:
+            return self.values
+        codes = self.values
+        try:
+            categories = pd.Index(list(self.code_of), dtype=self.dtype.categories.dtype)
+        except (TypeError, ValueError):
+            categories = pd.Index(list(self.code_of))
+        try:
+            order = categories.argsort()
+        except TypeError: # Categories that can't be compared stay in order of appearance
+            order = np.arange(len(categories))
+        new_code = np.empty(len(categories) + 1, dtype=np.int32)
+        new_code[order] = np.arange(len(categories))
+        new_code[-1] = -1
+        np.take(new_code, codes, out=codes, mode='wrap') # -1 wraps around to new_code[-1]
+        return pd.Categorical.from_codes(
+            codes, dtype=pd.CategoricalDtype(categories[order], self.dtype.ordered))
+
+def find_shards(observer_dir, ext, seeds='all'):
+    """Find the shards with extension `ext` in a directory with the output
+    from a single observer, and return a dict mapping each shard's random
+    seed to its path, sorted by seed. Only the seeds in `seeds` are included
+    unless seeds='all'.
+    """
+    shard_paths = {}
+    with os.scandir(observer_dir) as scanner:
+        for entry in scanner:
+            if entry.name.endswith(ext) and entry.is_file():
+                # Use regex to identify seed as a string of digits before the extension, e.g.,
+                # '9871' in 'social_security_observer_9871.hdf'
+                seed = int(re.match(fr'^.+_(\d+){re.escape(ext)}$', entry.name).group(1))
+                if seeds != 'all' and seed not in seeds:
+                    continue
+                shard_paths[seed] = entry.path
+    return dict(sorted(shard_paths.items()))
+
 def load_shards_and_concatenate(
     observer_dir,
     ext,
@@ -87,6 +307,13 @@ def load_shards_and_concatenate(
     filter_query=None,
     transform=None,
     ignore_index=True,
+    columns=None,
+    max_workers=None,
+    executor='thread',
+    max_in_flight=None,
+    union_categories=False,
+    bz2_workers=None,
+    ssns_to_uint32=False,
     **pd_read_kwargs
 ):
     """Loads shards from a directory with the output from a single observer
@@ -105,28 +332,256 @@ def load_shards_and_concatenate(
     would be to pass a function that conforms the categories in a categorical
     column of the shards so that they can be concatenated as dtype 'category'
     instead of getting converted to dtype 'object' because of mismatched
-    categories between shards.
+    categories between shards. Alternatively, pass union_categories=True
+    to concatenate the shards as they're loaded with
+    concat_conforming_categories, taking the union of the categories.
+
+    If `columns` is passed, only those columns are read from each shard, in
+    that order (filter_query can only refer to these columns). For .hdf shards in
+    'table' format, filter_query is passed to the reader as a `where`
+    condition, so that only the matching rows are read. For .parquet shards,
+    the comparisons of columns with literals in filter_query (==, <, <=, >,
+    >=, and 'in' a list, combined with and/or) are passed to the reader as
+    `filters`, which skips row groups and rows that can't match; the rest of
+    the query (e.g., != or comparisons between columns) is applied after
+    reading, as for the other formats. The categories of the categorical
+    columns then come from the rows that are read, not the whole shard.
+    Filters aren't passed to the reader when the index is kept
+    (ignore_index=False) but was only stored as a RangeIndex, which can't
+    be reconstructed for the rows that are read.
+
+    The shards are concatenated in order of their seeds. By default they are
+    loaded one at a time. If max_workers is passed, they are loaded in
+    parallel by a pool of max_workers threads (executor='thread', which
+    helps when loading is I/O-bound, e.g., on network storage) or processes
+    (executor='process', for CPU-bound parsing; transform must then be
+    picklable, e.g., not a lambda), with at most max_in_flight shards
+    (default 2 * max_workers) loading or waiting for the shards before them.
+
+    If bz2_workers is passed, .csv.bz2 shards are read with
+    datatypes.load_csv_data_parallel instead of pandas.read_csv, which
+    decompresses the bzip2 blocks of each shard in bz2_workers threads and
+    parses the csv with pyarrow; pd_read_kwargs are then passed to it
+    (e.g., use_categorical or convert_str_ids).
+
+    If ssns_to_uint32 is True, the string SSN and ITIN columns of each shard
+    are converted to 'UInt32' with datatypes.convert_ssns_to_uint32 as soon
+    as it's read (before filter_query and transform), so the strings are
+    never concatenated. Malformed SSNs raise a ValueError.
     """
+    shard_paths = find_shards(observer_dir, ext, seeds)
+    read_shard = functools.partial(
+        _read_shard, ext=ext, filter_query=filter_query, transform=transform,
+        columns=columns, pd_read_kwargs=pd_read_kwargs, bz2_workers=bz2_workers,
+        ssns_to_uint32=ssns_to_uint32, ignore_index=ignore_index)
+    if max_workers is None:
+        shards = ((seed, read_shard(path)) for seed, path in shard_paths.items())
+    else:
+        shards = _map_in_order(read_shard, shard_paths, max_workers, executor, max_in_flight)
+    if union_categories and ignore_index:
+        df = concat_conforming_categories(shard for seed, shard in shards)
+    elif union_categories:
+        df = concat_conforming_categories(dict(shards), ignore_index=False)
+    else:
+        df = pd.concat(dict(shards), ignore_index=ignore_index)
+    return df
+
+def _read_shard(
+    path, ext, filter_query, transform, columns, pd_read_kwargs, bz2_workers=None,
+    ssns_to_uint32=False, ignore_index=False,
+):
+    """Read, filter, and transform one shard for load_shards_and_concatenate."""
     pandas_read = {
         '.parquet': pd.read_parquet,
         '.hdf': pd.read_hdf,
         '.csv.bz2': pd.read_csv,
         '.csv': pd.read_csv,
     }
-    shards = {}
-    with os.scandir(observer_dir) as scanner:
-        for entry in scanner:
-            if entry.name.endswith(ext) and entry.is_file():
-                # Use regex to identify seed as a string of digits before the extension, e.g.,
-                # '9871' in 'social_security_observer_9871.hdf'
-                seed = int(re.match(fr'^.+_(\d+){ext}$', entry.name).group(1))
-                if seeds != 'all' and seed not in seeds:
-                    continue
-                shard = pandas_read[ext](entry, **pd_read_kwargs)
-                if filter_query:
-                    shard = shard.query(filter_query)
-                if transform:
-                    shard = transform(shard)
-                shards[seed] = shard
-    df = pd.concat(shards, ignore_index=ignore_index)
+    read_kwargs = dict(pd_read_kwargs)
+    if bz2_workers is not None and ext == '.csv.bz2':
+        pandas_read[ext] = functools.partial(datatypes.load_csv_data_parallel, max_workers=bz2_workers)
+        if columns is not None:
+            read_kwargs['include_columns'] = list(columns)
+    elif columns is not None:
+        read_kwargs['usecols' if ext.startswith('.csv') else 'columns'] = list(columns)
+    parquet_filters = (
+        _query_to_parquet_filters(filter_query)
+        if filter_query and ext == '.parquet' and 'filters' not in read_kwargs
+        and (ignore_index or _parquet_index_is_stored(path)) else None
+    )
+    if filter_query and ext == '.hdf' and 'where' not in read_kwargs:
+        try:
+            shard = pandas_read[ext](path, where=filter_query, **read_kwargs)
+            filter_query = None
+        except (TypeError, ValueError, SyntaxError, NotImplementedError):
+            # The store isn't in 'table' format, or the query isn't valid in PyTables
+            shard = pandas_read[ext](path, **read_kwargs)
+    elif parquet_filters:
+        import pyarrow as pa
+        try:
+            # Skips row groups by their statistics and the other rows as they're read;
+            # the query is still applied below, since the filters may only cover part of it
+            shard = pandas_read[ext](path, filters=parquet_filters, **read_kwargs)
+        except (pa.ArrowException, TypeError, ValueError, KeyError):
+            # E.g., a column that's not in the file or a value of the wrong type
+            shard = pandas_read[ext](path, **read_kwargs)
+    else:
+        shard = pandas_read[ext](path, **read_kwargs)
+    if ext == '.parquet':
+        shard = _restore_categoricals(shard, path)
+    if columns is not None:
+        shard = shard[list(columns)] # In the order requested, which pandas.read_csv doesn't keep
+    if ssns_to_uint32:
+        datatypes.convert_ssns_to_uint32(shard)
+    if filter_query:
+        shard = shard.query(filter_query)
+    if transform:
+        shard = transform(shard)
+    return shard
+
+# Comparisons that pyarrow filters evaluate like DataFrame.query, including
+# that missing values never match (unlike != and 'not in', which match them in pandas)
+_PARQUET_FILTER_OPS = {
+    ast.Eq: '==', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=', ast.In: 'in',
+}
+_FLIPPED_OPS = {'==': '==', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+_MAX_FILTER_CONJUNCTIONS = 64
+
+def _query_to_parquet_filters(query):
+    """Translate the simple parts of a DataFrame.query string into filters
+    for pd.read_parquet (a list of lists of (column, op, value) tuples, in
+    disjunctive normal form), which select a superset of the rows the query
+    selects. Comparisons of a column with a literal (==, <, <=, >, >=, and
+    'in' a list) combined with and/&/or/| are translated; other conditions
+    inside an 'and' are dropped (so the query must still be applied to the
+    result), and anything else gives None.
+    """
+    try:
+        tree = ast.parse(_with_boolean_precedence(query), mode='eval').body
+    except (SyntaxError, tokenize.TokenError): # E.g., backquoted column names
+        return None
+    filters = _filter_clauses(tree)
+    if not filters or filters == [[]]:
+        return None
+    return filters
+
+def _with_boolean_precedence(query):
+    """Replace & and | in a query with 'and' and 'or', as DataFrame.query
+    does, so that e.g. `a == 1 & b == 2` means `(a == 1) & (b == 2)`.
+    """
+    tokens = tokenize.generate_tokens(io.StringIO(query.strip()).readline)
+    replacements = {'&': 'and', '|': 'or'}
+    return tokenize.untokenize(
+        (tokenize.NAME, replacements[token.string]) if token.string in replacements
+        else (token.type, token.string)
+        for token in tokens
+    )
+
+def _filter_clauses(node):
+    """Return the filters (in disjunctive normal form) for an AST node of a
+    query, as in _query_to_parquet_filters, or None if there are none.
+    """
+    if isinstance(node, ast.BoolOp) or (
+            isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr))):
+        operands = node.values if isinstance(node, ast.BoolOp) else [node.left, node.right]
+        is_and = isinstance(node.op, (ast.And, ast.BitAnd))
+        operand_filters = [_filter_clauses(operand) for operand in operands]
+        if is_and:
+            # Conditions that can't be translated are left to the query
+            filters = [[]]
+            for clauses in operand_filters:
+                if clauses is not None:
+                    filters = [left + right for left in filters for right in clauses]
+        elif any(clauses is None for clauses in operand_filters):
+            return None
+        else:
+            filters = [conjunction for clauses in operand_filters for conjunction in clauses]
+        if len(filters) > _MAX_FILTER_CONJUNCTIONS:
+            return None
+        return filters
+    if isinstance(node, ast.Compare):
+        conjunction = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            condition = _filter_condition(left, op, right)
+            if condition is not None:
+                conjunction.append(condition)
+            left = right
+        return [conjunction] if conjunction else None
+    return None
+
+def _filter_condition(left, op, right):
+    """Return a (column, op, value) filter for the comparison `left op right`
+    of AST nodes, if it's between a column and a literal, or else None.
+    """
+    op = _PARQUET_FILTER_OPS.get(type(op))
+    if op is None:
+        return None
+    if isinstance(right, ast.Name) and op != 'in':
+        left, right, op = right, left, _FLIPPED_OPS[op]
+    if not isinstance(left, ast.Name):
+        return None
+    try:
+        value = ast.literal_eval(right)
+    except ValueError: # Not a literal
+        return None
+    if op == '==' and isinstance(value, list):
+        op = 'in' # DataFrame.query treats `column == [...]` as isin
+    if op == 'in':
+        if not isinstance(value, (list, tuple, set)):
+            return None
+        value = list(value)
+    return (left.id, op, value)
+
+def _parquet_index_is_stored(parquet_path):
+    """Whether the index of the DataFrame written to a Parquet file is
+    stored in its columns. A RangeIndex is only stored as metadata, so it
+    can't be reconstructed for the rows that a filtered read returns.
+    """
+    import pyarrow.parquet as pq
+    pandas_metadata = pq.read_schema(parquet_path).pandas_metadata or {}
+    index_columns = pandas_metadata.get('index_columns', [])
+    return bool(index_columns) and all(isinstance(column, str) for column in index_columns)
+
+def _restore_categoricals(df, parquet_path):
+    """Convert the columns of df read from a Parquet file that were
+    categorical when written back to categoricals. pyarrow only restores
+    dictionary-encoded strings, so categoricals with other categories
+    (e.g., years) come back as plain columns.
+    """
+    import pyarrow.parquet as pq
+    pandas_metadata = pq.read_schema(parquet_path).pandas_metadata or {}
+    for column in pandas_metadata.get('columns', []):
+        name = column['name']
+        if (column['pandas_type'] == 'categorical' and name in df
+                and not isinstance(df[name].dtype, pd.CategoricalDtype)):
+            df[name] = df[name].astype(pd.CategoricalDtype(ordered=column['metadata']['ordered']))
     return df
+
+def _map_in_order(func, items, max_workers, executor='thread', max_in_flight=None):
+    """Apply func to the values of the dict `items` in a pool of max_workers
+    threads or processes, yielding (key, result) pairs in the order of
+    items, with at most max_in_flight calls submitted but not yet yielded.
+    """
+    executor_classes = {
+        'thread': concurrent.futures.ThreadPoolExecutor,
+        'process': concurrent.futures.ProcessPoolExecutor,
+    }
+    if executor not in executor_classes:
+        raise ValueError(f"executor must be 'thread' or 'process', not {executor!r}")
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+    items = iter(items.items())
+    with executor_classes[executor](max_workers) as pool:
+        in_flight = collections.deque()
+        for key, value in items:
+            in_flight.append((key, pool.submit(func, value)))
+            if len(in_flight) >= max_in_flight:
+                break
+        while in_flight:
+            key, future = in_flight.popleft()
+            result = future.result()
+            for next_key, next_value in items:
+                in_flight.append((next_key, pool.submit(func, next_value)))
+                break
+            yield key, result
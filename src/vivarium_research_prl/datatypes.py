@@ -3,6 +3,8 @@ Module for specifying and converting datatypes when working with
 the output of the Vivarium PRL simulation in pandas.
 """
 
+import warnings
+import numpy as np
 import pandas as pd
 
 ID_PAD_WIDTH = 9 # Width to which to pad the 2nd component of an id when converting to int
@@ -15,32 +17,157 @@ STR_ID_COLUMNS = (
 SSN_COLUMNS = ('ssn', 'itin')
 
 def id_str_to_int(id_col_str):
-    """Convert a column of string IDs to integer IDs"""
-    id_pieces = id_col_str.str.split('_')
-    seed_id, sim_id = id_pieces.str[0].astype(int), id_pieces.str[1].astype(int)
-    seed_id.loc[sim_id == -1] = 0 # Use single sentinel -1 for all missing ids, regardless of seed
-    id_col_int = seed_id * 10**ID_PAD_WIDTH + sim_id
-    return id_col_int
+    """Convert a column of string IDs of the form '<seed>_<simulant>' to
+    integer IDs <seed> * 10**ID_PAD_WIDTH + <simulant>, using the single
+    sentinel -1 for all missing ids (simulant -1), regardless of seed.
+    The strings are parsed in Arrow without creating any Python objects.
+    """
+    id_col_int = _parse_string_ids(_to_arrow_strings(id_col_str))
+    return pd.Series(id_col_int, index=id_col_str.index, name=id_col_str.name)
+
+def _parse_string_ids(id_strings):
+    """Parse a pyarrow (Chunked)Array of string IDs into an int64 NumPy
+    array as in id_str_to_int.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if id_strings.null_count > 0:
+        raise ValueError(f'{id_strings.null_count} string ids are missing')
+    id_pieces = pc.split_pattern(id_strings, '_', max_splits=1)
+    malformed = pc.not_equal(pc.list_value_length(id_pieces), 2)
+    if pc.any(malformed).as_py():
+        example = pc.filter(id_strings, malformed)[0].as_py()
+        raise ValueError(f"string ids must have the form '<seed>_<simulant>', not {example!r}")
+    seed_id = pc.cast(pc.list_element(id_pieces, 0), pa.int64()).to_numpy()
+    sim_id = pc.cast(pc.list_element(id_pieces, 1), pa.int64()).to_numpy()
+    return np.where(sim_id == -1, -1, seed_id * 10**ID_PAD_WIDTH + sim_id)
 
 def id_int_to_str(id_col_int):
-    """Convert a column of integer IDs to string IDs"""
-    seed_id, sim_id = id_col_int.divmod(10**ID_PAD_WIDTH)
-    id_col_str = seed_id.astype(str) + '_' + sim_id.astype(str)
-    return id_col_str
+    """Convert a column of integer IDs to string IDs, the inverse of
+    id_str_to_int. The sentinel -1 is converted to '0_-1', since the seed
+    of a missing id is unknown.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    id_ints = np.asarray(id_col_int, dtype=np.int64)
+    seed_id, sim_id = np.divmod(id_ints, 10**ID_PAD_WIDTH)
+    missing = id_ints == -1
+    seed_id[missing], sim_id[missing] = 0, -1
+    id_strings = pc.binary_join_element_wise(
+        pc.cast(pa.array(seed_id), pa.string()), pc.cast(pa.array(sim_id), pa.string()), '_')
+    return id_strings.to_pandas().set_axis(id_col_int.index).rename(id_col_int.name)
+
+def _to_arrow_strings(strings):
+    """Return a pandas Series of strings as a pyarrow (Chunked)Array of
+    strings, without a copy if it is Arrow-backed. Arrays that are already
+    pyarrow arrays are only decoded if they are dictionary-encoded.
+    """
+    import pyarrow as pa
+    if isinstance(strings, (pa.Array, pa.ChunkedArray)):
+        arrow_strings = strings
+    else:
+        arrow_strings = pa.array(strings, from_pandas=True)
+    if pa.types.is_dictionary(arrow_strings.type):
+        arrow_strings = arrow_strings.cast(arrow_strings.type.value_type)
+    elif pa.types.is_null(arrow_strings.type): # E.g., an empty object Series
+        arrow_strings = arrow_strings.cast(pa.string())
+    return arrow_strings
 
 def ssn_to_int(ssn):
     """Convert a column of social security numbers from strings
     of the form 'abc-def-ghij' to 32-bit ints of the form abcdefghi.
     NaNs will be replaced by -1. The function also works on string
-    SSNs in the format 'abcdefghi'.
+    SSNs in the format 'abcdefghi'. Malformed SSNs raise a ValueError.
     """
-    ssn_int = (
-        ssn.str.replace('-', '')
-        .fillna(-1)
-        .astype('int32')
-    )
+    ssn_values, is_valid, is_malformed = parse_ssns(ssn)
+    _check_malformed_ssns(ssn, is_malformed, errors='raise')
+    ssn_int = pd.Series(
+        np.where(is_valid, ssn_values, -1).astype('int32'), index=ssn.index, name=ssn.name)
     return ssn_int
 
+def ssn_to_uint32(ssn, errors='raise'):
+    """Convert a column of SSNs or ITINs of the form 'abc-de-fghi' or
+    'abcdefghi' to a Series of dtype 'UInt32', i.e., compact uint32 values
+    with a separate validity mask, with missing values where ssn is missing.
+    If errors='raise', malformed values raise a ValueError; if
+    errors='coerce', they become missing values, with a warning reporting
+    how many there were. Since each value is parsed on its own, this can be
+    applied to each batch or shard of a dataset as it is loaded.
+    """
+    ssn_values, is_valid, is_malformed = parse_ssns(ssn)
+    _check_malformed_ssns(ssn, is_malformed, errors)
+    return pd.Series(
+        pd.arrays.IntegerArray(ssn_values, ~is_valid), index=ssn.index, name=ssn.name)
+
+def convert_ssns_to_uint32(df, errors='raise'):
+    """Convert the string (or categorical with string categories) SSN_COLUMNS
+    in df to 'UInt32' with ssn_to_uint32, with missing values for missing
+    (and, if errors='coerce', malformed) SSNs. Modifies df in place.
+    """
+    for col in SSN_COLUMNS:
+        if col not in df:
+            continue
+        if (isinstance(df[col].dtype, pd.CategoricalDtype)
+                and pd.api.types.is_string_dtype(df[col].cat.categories.dtype)):
+            # Parse each category once, and look the values up by their codes
+            codes = df[col].cat.codes.to_numpy()
+            values = ssn_to_uint32(pd.Series(df[col].cat.categories), errors).array
+            df[col] = pd.Series(values.take(codes, allow_fill=True), index=df.index, name=col)
+        elif pd.api.types.is_string_dtype(df[col].dtype):
+            df[col] = ssn_to_uint32(df[col], errors)
+
+# Positions of the 9 digits in SSN strings of each accepted length
+_SSN_DIGIT_POSITIONS = {9: np.arange(9), 11: np.array([0, 1, 2, 4, 5, 7, 8, 9, 10])}
+_SSN_DASH_POSITIONS = {9: [], 11: [3, 6]}
+
+def parse_ssns(ssn):
+    """Parse a column of SSNs or ITINs of the form 'abc-de-fghi' or
+    'abcdefghi' directly from the bytes of their Arrow string buffer.
+    Returns three arrays: the uint32 values abcdefghi (0 where invalid),
+    a boolean mask of the valid (present and well-formed) values, and a
+    boolean mask of the malformed values (present but not well-formed).
+    """
+    import pyarrow as pa
+    ssn_strings = _to_arrow_strings(ssn)
+    if isinstance(ssn_strings, pa.ChunkedArray):
+        ssn_strings = ssn_strings.combine_chunks()
+    ssn_strings = ssn_strings.cast(pa.large_string())
+    is_missing = ssn_strings.is_null().to_numpy(zero_copy_only=False)
+    _, offsets_buffer, data_buffer = ssn_strings.buffers()
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int64)[
+        ssn_strings.offset:ssn_strings.offset + len(ssn_strings) + 1]
+    data = np.frombuffer(data_buffer, dtype=np.uint8) if data_buffer is not None else np.empty(0, np.uint8)
+    lengths = np.diff(offsets)
+
+    ssn_values = np.zeros(len(ssn_strings), dtype=np.uint32)
+    is_valid = np.zeros(len(ssn_strings), dtype=bool)
+    place_values = 10 ** np.arange(8, -1, -1, dtype=np.int64)
+    for length, digit_positions in _SSN_DIGIT_POSITIONS.items():
+        rows = np.flatnonzero((lengths == length) & ~is_missing)
+        chars = data[offsets[rows, None] + np.arange(length)]
+        digits = chars[:, digit_positions] - np.uint8(ord('0')) # Non-digits wrap around to > 9
+        well_formed = (digits <= 9).all(axis=1)
+        well_formed &= (chars[:, _SSN_DASH_POSITIONS[length]] == ord('-')).all(axis=1)
+        rows = rows[well_formed]
+        ssn_values[rows] = digits[well_formed] @ place_values
+        is_valid[rows] = True
+    return ssn_values, is_valid, ~is_missing & ~is_valid
+
+def _check_malformed_ssns(ssn, is_malformed, errors):
+    num_malformed = np.count_nonzero(is_malformed)
+    if num_malformed == 0:
+        return
+    position = np.flatnonzero(is_malformed)[0]
+    example = ssn.iloc[position] if isinstance(ssn, pd.Series) else ssn[position].as_py()
+    name = getattr(ssn, 'name', None)
+    message = f'{num_malformed} malformed SSNs in {name!r}, e.g. {example!r}'
+    if errors == 'raise':
+        raise ValueError(message)
+    elif errors == 'coerce':
+        warnings.warn(f'{message}; replacing them with missing values')
+    else:
+        raise ValueError(f"errors must be 'raise' or 'coerce', not {errors!r}")
+
 def get_columns_by_dtype(use_categorical='maximal'):
     """Returns a dictionary mapping dtypes to lists of columns in the
     pseudopeople data. The datatypes and lists of columns were
@@ -245,13 +372,17 @@ def string_ids_to_ints(df, string_id_cols=None, include_ssn=None, concat=True):
     result = pd.concat(columns, axis=1) if concat else columns
     return result
 
-def load_csv_data(filepath, use_categorical='maximal', convert_str_ids=False, **kwargs):
+def load_csv_data(
+    filepath, use_categorical='maximal', convert_str_ids=False, ssns_to_uint32=False, **kwargs
+):
     """Loads a csv with dtypes specified according to the dictionary returned by
     get_columns_by_dtype(use_categorical), and ensures that certain categorical
     columns contain integers for their categories. Optionally converts STR_ID_COLUMNS
     to integer IDs using convert_string_ids_to_ints. Allows passing keywords to
     pandas.read_csv. If 'dtype' is passed as a keyword, it will override the call to
-    get_columns_by_dtype.
+    get_columns_by_dtype. If ssns_to_uint32 is True, the SSN and ITIN columns
+    are converted to 'UInt32' with convert_ssns_to_uint32 (before, and instead
+    of, any conversion by convert_str_ids).
     """
     if 'dtype' not in kwargs:
         columns_by_dtype = get_columns_by_dtype(use_categorical)
@@ -262,6 +393,8 @@ def load_csv_data(filepath, use_categorical='maximal', convert_str_ids=False, **
     # since all categories are read in as strings:
     # https://stackoverflow.com/questions/64652975/pandas-read-csv-with-dtype-pd-categoricaldtype-creates-object-categories-ev
     convert_string_cats_to_ints(df)
+    if ssns_to_uint32:
+        convert_ssns_to_uint32(df)
     if convert_str_ids:
         convert_string_ids_to_ints(df)
     return df
@@ -303,7 +436,8 @@ def to_int_and_categorical(df, exclude=(), concat=True):
 
     def convert_if_necessary(column):
         if (column.name not in exclude
-                and pd.api.types.is_object_dtype(column)):
+                and (pd.api.types.is_object_dtype(column)
+                     or isinstance(column.dtype, pd.StringDtype))):
             return column.astype('category')
         else:
             return column
@@ -311,3 +445,105 @@ def to_int_and_categorical(df, exclude=(), concat=True):
     columns = [convert_if_necessary(column) for column in columns]
     result = pd.concat(columns, axis=1) if concat else columns
     return result
+
+def load_csv_data_parallel(
+    filepath, use_categorical='maximal', convert_str_ids=False, max_workers=None,
+    ssns_to_uint32=False, **convert_options
+):
+    """Like load_csv_data, but parses the csv with the multithreaded
+    pyarrow.csv reader, applying the dtypes in get_columns_by_dtype during
+    parsing, and decompresses .bz2 files with parallel_bz2, which
+    decompresses the bzip2 blocks in a pool of max_workers threads.
+    Keyword arguments are passed to pyarrow.csv.ConvertOptions (e.g.,
+    include_columns=[...]). ssns_to_uint32 is as in load_csv_data.
+    """
+    import pyarrow as pa
+    column_types = {}
+    for dtype, columns in get_columns_by_dtype(use_categorical).items():
+        if dtype == 'str':
+            arrow_type = pa.string()
+        elif dtype == 'category':
+            arrow_type = pa.dictionary(pa.int32(), pa.string())
+        else:
+            arrow_type = pa.from_numpy_dtype(np.dtype(dtype))
+        column_types.update(dict.fromkeys(columns, arrow_type))
+    column_types.update(convert_options.pop('column_types', {}))
+    # Dates stay strings, as with pandas.read_csv
+    table = _read_csv_arrow(
+        _csv_source(filepath, max_workers), column_types, pa.string(), **convert_options)
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    convert_string_cats_to_ints(df)
+    if ssns_to_uint32:
+        convert_ssns_to_uint32(df)
+    if convert_str_ids:
+        convert_string_ids_to_ints(df)
+    return df
+
+def read_csv_int_and_categorical(
+    filepath, exclude=(), read_options=None, parse_options=None, max_workers=None,
+    **convert_options
+):
+    """Read a csv file (compressed files such as .csv.bz2 are decompressed)
+    directly into the dtypes that to_int_and_categorical would convert it
+    to, in one pass with pyarrow.csv, so that the data never exists as
+    Python strings: STR_ID_COLUMNS and SSN_COLUMNS are parsed to ints from
+    the Arrow strings, and all other string (and date) columns are read as
+    dictionary-encoded columns, which become categoricals. Columns in
+    `exclude` are left as strings. .bz2 files are decompressed with
+    parallel_bz2 in a pool of max_workers threads. Keyword arguments are
+    passed to pyarrow.csv.ConvertOptions (e.g., include_columns=[...]).
+    """
+    import pyarrow as pa
+    if isinstance(exclude, str):
+        exclude = (exclude,)
+    string_id_cols = set(STR_ID_COLUMNS + SSN_COLUMNS).difference(exclude)
+    column_types = {col: pa.string() for col in string_id_cols.union(exclude)}
+    column_types.update(convert_options.pop('column_types', {}))
+    table = _read_csv_arrow(
+        _csv_source(filepath, max_workers), column_types, pa.dictionary(pa.int32(), pa.string()),
+        read_options, parse_options, auto_dict_encode=True, auto_dict_max_cardinality=2**31 - 1,
+        **convert_options)
+
+    for i, name in enumerate(table.column_names):
+        if name in string_id_cols and pa.types.is_string(table.schema.field(name).type):
+            if name in SSN_COLUMNS:
+                ssn_values, is_valid, is_malformed = parse_ssns(table[name])
+                _check_malformed_ssns(table[name], is_malformed, errors='raise')
+                int_ids = np.where(is_valid, ssn_values, -1).astype('int32')
+            else:
+                int_ids = _parse_string_ids(table[name])
+            table = table.set_column(i, name, pa.array(int_ids))
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def _csv_source(filepath, max_workers):
+    """Return the decompressed bytes of a .bz2 file (decompressed in
+    parallel), or else the path itself, as a source for _read_csv_arrow.
+    """
+    if str(filepath).endswith('.bz2'):
+        from . import parallel_bz2
+        return parallel_bz2.decompress_file(filepath, max_workers)
+    return filepath
+
+def _read_csv_arrow(
+    source, column_types, temporal_type, read_options=None, parse_options=None, **convert_options
+):
+    """Read a csv file path or bytes with pyarrow.csv.read_csv, with the given
+    column_types, and with columns that pyarrow would infer as dates or
+    times (but that pandas would leave as strings) read as temporal_type.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as csv
+    column_types = dict(column_types)
+    def open_source():
+        return pa.BufferReader(source) if isinstance(source, bytes) else source
+    def make_convert_options():
+        return csv.ConvertOptions(
+            column_types=column_types, strings_can_be_null=True, **convert_options)
+
+    # Read the first block to find the columns inferred as temporal
+    with csv.open_csv(open_source(), read_options, parse_options, make_convert_options()) as reader:
+        schema = reader.schema
+    for field in schema:
+        if pa.types.is_temporal(field.type) and field.name not in column_types:
+            column_types[field.name] = temporal_type
+    return csv.read_csv(open_source(), read_options, parse_options, make_convert_options())
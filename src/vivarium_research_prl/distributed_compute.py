@@ -3,6 +3,7 @@ import os, time, datetime, pathlib, re, atexit
 import asyncio
 import requests
 from typing import Any, Dict, Literal
+import numpy as np
 import pandas
 from dataclasses import dataclass
 import types
@@ -496,6 +497,27 @@ class DataFrameOperations:
         max_memory_fraction = 20 if self.compute_engine == 'dask_local' else 4
         return memory_per_worker_b // (max_memory_fraction * self.threads_per_worker)
 
+    def map_partitions(self, df, func, *args, meta=None, **kwargs):
+        """Apply func(partition, *args, **kwargs) to each partition of df.
+        Pandas and Modin dataframes are a single partition.
+        For Dask, meta defaults to the result of func on the empty meta of df,
+        and func also receives the partition_info keyword, which is None for
+        that call and for non-Dask engines.
+        """
+        if not self.compute_engine.startswith('dask'):
+            return func(df, *args, partition_info=None, **kwargs)
+
+        if meta is None:
+            meta = func(df._meta, *args, partition_info=None, **kwargs)
+        return df.map_partitions(func, *args, meta=meta, **kwargs)
+
+    def partition_offsets(self, df):
+        """Return the number of rows in all previous partitions for each partition of df."""
+        if not self.compute_engine.startswith('dask'):
+            return [0]
+        lengths = df.map_partitions(len).compute()
+        return list(np.concatenate([[0], np.cumsum(lengths)[:-1]]))
+
     def ensure_large_string_capacity(self, df):
         if not self.compute_engine.startswith('dask'):
             # Not using pyarrow strings by default
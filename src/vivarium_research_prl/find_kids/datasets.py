@@ -1,5 +1,115 @@
 import numpy as np
 import pandas as pd
+from ..noise import random_streams
+
+class ColumnProjection:
+    """A lazy selection of rows and columns of a dataframe, some of which are
+    derived from the dataframe's columns (e.g., formatted dates).
+
+    `columns` maps each output column name to either the name of a column of
+    df, a pair (name of a column of df, function to apply to it), or an array
+    with one value per selected row. `rows` is a boolean mask (a boolean
+    Series is aligned with the index of df, as by df.loc), an index of row
+    labels as for df.loc, or None for all rows.
+
+    Nothing is copied or computed until the projection is materialized with
+    to_pandas() or written out with to_parquet(), which computes the derived
+    columns one batch of rows at a time. If all rows are selected, the
+    columns that are just selected are the columns of df themselves (copied
+    on write by pandas), rather than copies.
+    """
+    def __init__(self, df, columns, rows=None):
+        self.df = df
+        self.columns = dict(columns)
+        if rows is None:
+            self.positions = None
+        else:
+            if isinstance(rows, pd.Series) and pd.api.types.is_bool_dtype(rows.dtype):
+                rows = _align_mask(rows, df.index)
+            rows = np.asarray(rows)
+            if rows.dtype == bool:
+                self.positions = np.flatnonzero(rows)
+            else:
+                self.positions = df.index.get_indexer(rows)
+                if (self.positions < 0).any():
+                    raise KeyError('some rows to include are not in the index')
+
+    def __len__(self):
+        return len(self.df) if self.positions is None else len(self.positions)
+
+    def column(self, name, start=0, stop=None, index=None):
+        """Compute the column `name` for the selected rows from start to stop.
+        The result's index is `index` if passed, to share one index between
+        columns, and the index labels of the rows otherwise.
+        """
+        spec = self.columns[name]
+        stop = len(self) if stop is None else min(stop, len(self))
+        if index is None:
+            index = self.index(start, stop)
+        if not isinstance(spec, (str, tuple)):
+            return pd.Series(spec[start:stop], index=index, name=name)
+        source_column, func = (spec, None) if isinstance(spec, str) else spec
+        values = self.df[source_column].array
+        if self.positions is not None:
+            values = values.take(self.positions[start:stop])
+        elif (start, stop) != (0, len(self)):
+            values = values[start:stop]
+        values = pd.Series(values, index=index, name=name, copy=False)
+        return values if func is None else func(values).rename(name)
+
+    def index(self, start=0, stop=None):
+        """Return the index labels of the selected rows from start to stop."""
+        if self.positions is None:
+            return self.df.index[start:stop]
+        return self.df.index[self.positions[start:stop]]
+
+    def to_pandas(self, start=0, stop=None):
+        """Materialize the selected rows from start to stop as a DataFrame."""
+        index = self.index(start, stop)
+        return pd.DataFrame(
+            {name: self.column(name, start, stop, index) for name in self.columns},
+            index=index, copy=False)
+
+    def iter_batches(self, batch_size=2**20):
+        """Iterate over the projection as DataFrames of batch_size rows (with
+        one empty DataFrame if no rows are selected).
+        """
+        for start in range(0, max(len(self), 1), batch_size):
+            yield self.to_pandas(start, start + batch_size)
+
+    def to_parquet(self, path, batch_size=2**20, **kwargs):
+        """Write the projection to a Parquet file one batch at a time, so that
+        the derived columns never exist in memory for all rows at once, with
+        one row group per batch. Keyword arguments are passed to
+        pyarrow.parquet.ParquetWriter.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for batch in self.iter_batches(batch_size):
+                if writer is None:
+                    table = pa.Table.from_pandas(batch, preserve_index=True)
+                    writer = pq.ParquetWriter(path, table.schema, **kwargs)
+                else:
+                    table = pa.Table.from_pandas(batch, schema=writer.schema, preserve_index=True)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+def _align_mask(mask, index):
+    """Align a boolean Series with `index` like df.loc[mask], raising an
+    IndexingError if some labels of index aren't in the mask.
+    """
+    if not mask.index.equals(index):
+        mask = mask.reindex(index)
+        if mask.isna().any():
+            raise pd.errors.IndexingError(
+                'Unalignable boolean Series provided as indexer (index of the boolean Series'
+                ' and of the indexed object do not match)')
+    # Missing values in a nullable boolean mask aren't selected, as in df.loc
+    return mask.to_numpy(dtype=bool, na_value=False)
 
 def get_wic_coverage_df():
     wic_coverage_df = pd.DataFrame(
@@ -32,87 +142,134 @@ def filter_bad_rows(state_table_df):
     return included
 
 def select_random_wic_participants(state_table_df, random_state=None):
+    # Population coverage of the WIC categories for kids, indexed by age in years
     wic_coverage_df = get_wic_coverage_df()
-    # Make sure we only initialize with a seed once so that the same
-    # seed doesn't get used in every iteration of the for loop
-    rng = np.random.default_rng(random_state)
-    included = filter_bad_rows(state_table_df)
-    included &= state_table_df['age'] < 5 # Only include kids for now
-    age_year = np.floor(state_table_df['age'])
-    for age in range(5):
-        wic_category = 'Infants' if age == 0 else f'{age}-year-old children'
-        pop_group = included & (age_year == age)
-        pop_size = pop_group.sum() # Number of True's
-        included.loc[pop_group] &= (
-            rng.random(pop_size) < wic_coverage_df.loc[wic_category, 'population_coverage']
-        )
-    return included
+    coverage_by_age = wic_coverage_df.loc[
+        ['Infants'] + [f'{age}-year-old children' for age in range(1, 5)],
+        'population_coverage'
+    ].to_numpy()
+    rng = random_streams.as_generator(random_state)
+    included = filter_bad_rows(state_table_df).to_numpy(dtype=bool, copy=True)
+    age = state_table_df['age'].to_numpy(dtype=float)
+    included &= age < 5 # Only include kids for now
+    # Look up each kid's coverage probability and draw for all of them at once.
+    # Only ages in the table are drawn for (negative ages would index it from the end);
+    # as when each age group was drawn separately, other rows are left as they are
+    age_year = np.floor(age)
+    kids = np.flatnonzero(included & (age_year >= 0) & (age_year < len(coverage_by_age)))
+    coverage = coverage_by_age[age_year[kids].astype(np.intp)]
+    included[kids] = random_streams.restrict(rng, kids).random(len(kids)) < coverage
+    return pd.Series(included, index=state_table_df.index)
 
-def select_wic_columns(state_table_df, rows_to_include=None):
-    if rows_to_include is None:
-        rows_to_include = state_table_df.index
-    columns_for_wic = (
+def wic_projection(state_table_df, rows_to_include=None, first_wic_id=1):
+    """Return a lazy ColumnProjection of the WIC columns of the rows
+    rows_to_include of state_table_df (see select_wic_columns).
+    """
+    columns = {
+        column: column for column in
         ['first_name', 'middle_name', 'last_name', 'date_of_birth']
         + ['sex', 'race_ethnicity']
         + ['address', 'zipcode', 'household_id']
+    }
+    columns['date_of_birth'] = ('date_of_birth', format_dates)
+    projection = ColumnProjection(state_table_df, columns, rows_to_include)
+    projection.columns['wic_id'] = np.arange(first_wic_id, first_wic_id+len(projection))
+    return projection
+
+def select_wic_columns(state_table_df, rows_to_include=None, first_wic_id=1):
+    return wic_projection(state_table_df, rows_to_include, first_wic_id).to_pandas()
+
+def format_dates(dates):
+    """Format a Series of datetimes as 'YYYY-MM-DD' strings, with NaN for
+    missing dates, like dates.dt.strftime('%Y-%m-%d') but much faster: each
+    distinct day is formatted once, and the 10-byte strings are gathered into
+    an Arrow large_string buffer for all the rows.
+    """
+    import pyarrow as pa
+    days = dates.to_numpy(dtype='datetime64[D]').view(np.int64)
+    missing = np.isnat(days.view('datetime64[D]'))
+    present_days = days[~missing]
+    first, last = (present_days.min(), present_days.max()) if len(present_days) else (0, 0)
+    if last - first < len(days):
+        # Format the whole range of days, which is usually much shorter than the data
+        distinct_days = np.arange(first, last + 1)
+        day_index = np.where(missing, 0, days - first)
+    else:
+        distinct_days, day_index = np.unique(np.where(missing, first, days), return_inverse=True)
+    formatted = np.datetime_as_string(distinct_days.astype('datetime64[D]'), unit='D').astype('S10')
+    chars = formatted[day_index]
+    # 64-bit offsets, since 32-bit ones overflow past 2**31 bytes (about 215M dates),
+    # and pandas stores the strings as large_string anyway
+    strings = pa.LargeStringArray.from_buffers(
+        len(days),
+        pa.py_buffer(_fixed_width_offsets(len(days), 10)),
+        pa.py_buffer(chars),
+        pa.py_buffer(np.packbits(~missing, bitorder='little')),
+        np.count_nonzero(missing),
     )
-    wic_df = state_table_df.loc[rows_to_include, columns_for_wic]
-    wic_df['date_of_birth'] = wic_df['date_of_birth'].dt.strftime('%Y-%m-%d')
-    wic_df['wic_id'] = range(1, 1+len(wic_df))
-    return wic_df
+    return strings.to_pandas().set_axis(dates.index).rename(dates.name)
+
+def _fixed_width_offsets(num_strings, width):
+    """Return the int64 Arrow offsets of num_strings strings of `width` bytes each."""
+    return np.arange(0, width * num_strings + 1, width, dtype=np.int64)
 
 def generate_wic_data(state_table_df, random_state=None):
     include_in_wic = select_random_wic_participants(state_table_df, random_state)
     wic_df = select_wic_columns(state_table_df, include_in_wic)
     return wic_df
 
+def get_over5_frac(num_under5, num_over5, overall_frac, kid_frac):
+    """Calculate probability of including over-5-year-olds to get correct overall fraction."""
+    if num_over5 == 0:
+        return 0 # Value doesn't matter
+    return overall_frac + (num_under5 / num_over5) * (overall_frac - kid_frac)
+
 def select_random_census_respondents(
     state_table_df,
     overall_frac,
     kid_frac,
-    random_state=None
+    random_state=None,
+    over5_frac=None,
 ):
-    rng = np.random.default_rng(random_state) # Always use Generator instead of RandomState
-    included = filter_bad_rows(state_table_df)
-    num_included = included.sum()
-#     unif_rvs = rng.random(len(state_table_df))
-#     pd.Series(True, index=state_table_df.index, name='census_respondent')
-    under5 = included & (state_table_df['age'] < 5)
-    num_under5 = under5.sum() # Number of True's
-    over5 = included & ~under5
-    num_over5 = over5.sum() #num_included - num_under5 #len(state_table_df) - num_under5
-    if num_over5 == 0:
-        over5_frac = 0 # Value doesn't matter
-    else:
-        # Calculate probability of including over-5-year-olds to get correct overall fraction
-        over5_frac = overall_frac + (num_under5 / num_over5) * (overall_frac - kid_frac)
-    included.loc[under5] &= rng.random(num_under5) < kid_frac
-    included.loc[over5] &= rng.random(num_over5) < over5_frac
-    return included
+    """Select census respondents so that a fraction kid_frac of included kids
+    under 5 and a fraction overall_frac of all included simulants respond.
+    If over5_frac is passed, it is used as the response probability of the
+    over-5-year-olds instead of calculating it from the counts in state_table_df
+    (so that it can be calculated once for a partitioned dataset).
+    """
+    rng = random_streams.as_generator(random_state) # Always use Generator instead of RandomState
+    included = filter_bad_rows(state_table_df).to_numpy(dtype=bool, copy=True)
+    under5 = state_table_df['age'].to_numpy(dtype=float) < 5
+    if over5_frac is None:
+        num_under5 = np.count_nonzero(included & under5)
+        num_over5 = np.count_nonzero(included) - num_under5
+        over5_frac = get_over5_frac(num_under5, num_over5, overall_frac, kid_frac)
+    # One draw for all included simulants, with the response probability of their age group
+    rows = np.flatnonzero(included)
+    response_prob = np.where(under5[rows], kid_frac, over5_frac)
+    included[rows] = random_streams.restrict(rng, rows).random(len(rows)) < response_prob
+    return pd.Series(included, index=state_table_df.index)
+
+def census_projection(state_table_df, rows_to_include=None):
+    """Return a lazy ColumnProjection of the census columns of the rows
+    rows_to_include of state_table_df (see select_census_columns).
+    """
+    columns = {
+        'first_name': 'first_name',
+        'middle_initial': ('middle_name', lambda middle_name: middle_name.str[0]),
+        'last_name': 'last_name',
+        'date_of_birth': ('date_of_birth', format_dates),
+        'age': ('age', np.floor),
+        'sex': 'sex',
+        'race_ethnicity': 'race_ethnicity',
+        'relation_to_household_head': 'relation_to_household_head',
+        'address': 'address',
+        'zipcode': 'zipcode',
+    }
+    return ColumnProjection(state_table_df, columns, rows_to_include)
 
 def select_census_columns(state_table_df, rows_to_include=None):
-    if rows_to_include is None:
-        rows_to_include = state_table_df.index
-    columns_for_census = (
-        ['first_name', 'middle_name', 'last_name', 'date_of_birth']
-        + ['age', 'sex', 'race_ethnicity']
-        + ['relation_to_household_head', 'address', 'zipcode']
-    )
-    census_df = state_table_df.loc[rows_to_include, columns_for_census]
-    census_df['middle_name'] = census_df['middle_name'].str[0]
-    census_df.rename(columns={'middle_name': 'middle_initial'}, inplace=True)
-    census_df['age'] = np.floor(census_df['age'])
-    census_df['date_of_birth'] = census_df['date_of_birth'].dt.strftime('%Y-%m-%d')
-#     census_df = (
-#         state_table_df.loc[rows_to_include, columns_for_census]
-#         .assign(
-#             middle_name=lambda df: df['middle_name'].str[0],
-#             age=lambda df: np.floor(df['age']),
-#             date_of_birth=lambda df: df['date_of_birth'].dt.strftime('%Y-%m-%d')
-#         )
-#         .rename(columns={'middle_name': 'middle_initial'})
-#     )
-    return census_df
+    return census_projection(state_table_df, rows_to_include).to_pandas()
 
 def generate_census_data(
     state_table_df,
@@ -126,6 +283,88 @@ def generate_census_data(
     census_df = select_census_columns(state_table_df, include_in_census)
     return census_df
 
+def generate_census_data_distributed(
+    ops,
+    state_table_df,
+    overall_frac=0.95,
+    kid_frac=0.90,
+    random_state=None,
+    record_id_column=None,
+):
+    """Like generate_census_data, for a dataframe of any compute engine
+    supported by distributed_compute.DataFrameOperations `ops`, processing
+    each partition separately.
+
+    Each simulant's random draws are keyed by random_state and its integer
+    record id (from record_id_column, or the index if None), so the result
+    doesn't depend on how state_table_df is partitioned. The ids must be
+    unique across partitions (see check_unique_record_ids).
+    """
+    check_unique_record_ids(ops, state_table_df, record_id_column)
+    seed = np.random.SeedSequence(random_state).entropy
+    included = filter_bad_rows(state_table_df)
+    under5 = included & (state_table_df['age'] < 5)
+    num_under5, num_over5 = ops.compute(under5.sum(), (included & ~under5).sum())
+    over5_frac = get_over5_frac(num_under5, num_over5, overall_frac, kid_frac)
+    return ops.map_partitions(
+        state_table_df, _generate_census_partition,
+        overall_frac, kid_frac, seed, record_id_column, over5_frac)
+
+def _generate_census_partition(
+    df_part, overall_frac, kid_frac, seed, record_id_column, over5_frac, partition_info=None
+):
+    rng = random_streams.RecordBoundGenerator(seed, _record_ids(df_part, record_id_column))
+    include_in_census = select_random_census_respondents(
+        df_part, overall_frac, kid_frac, rng, over5_frac)
+    return select_census_columns(df_part, include_in_census)
+
+def generate_wic_data_distributed(ops, state_table_df, random_state=None, record_id_column=None):
+    """Like generate_wic_data, for a dataframe of any compute engine
+    supported by distributed_compute.DataFrameOperations `ops`, processing
+    each partition separately. The wic_id's are numbered consecutively
+    across partitions.
+
+    Each simulant's random draws are keyed by random_state and its integer
+    record id (from record_id_column, or the index if None), so the result
+    doesn't depend on how state_table_df is partitioned. The ids must be
+    unique across partitions (see check_unique_record_ids).
+    """
+    check_unique_record_ids(ops, state_table_df, record_id_column)
+    seed = np.random.SeedSequence(random_state).entropy
+    wic_df = ops.persist(ops.map_partitions(
+        state_table_df, _generate_wic_partition, seed, record_id_column))
+    offsets = ops.partition_offsets(wic_df)
+    return ops.map_partitions(wic_df, _offset_wic_ids, offsets)
+
+def _generate_wic_partition(df_part, seed, record_id_column, partition_info=None):
+    rng = random_streams.RecordBoundGenerator(seed, _record_ids(df_part, record_id_column))
+    include_in_wic = select_random_wic_participants(df_part, rng)
+    return select_wic_columns(df_part, include_in_wic)
+
+def _offset_wic_ids(wic_part, offsets, partition_info=None):
+    offset = offsets[partition_info['number']] if partition_info is not None else 0
+    return wic_part.assign(wic_id=wic_part['wic_id'] + offset)
+
+def _record_ids(df, record_id_column):
+    ids = df.index if record_id_column is None else df[record_id_column]
+    return np.asarray(ids, dtype=np.int64)
+
+def check_unique_record_ids(ops, df, record_id_column=None):
+    """Raise a ValueError if the record ids of df (from record_id_column, or
+    the index if None) aren't unique across all of its partitions. Rows with
+    the same id get the same random draws, and Dask partitions often each
+    have an index starting at 0 (e.g., from read_parquet without an index).
+    """
+    ids = df.index.to_series() if record_id_column is None else df[record_id_column]
+    num_ids, num_unique_ids = ops.compute(ids.size, ids.nunique(dropna=False))
+    if num_unique_ids != num_ids:
+        source = 'index' if record_id_column is None else f'column {record_id_column!r}'
+        raise ValueError(
+            f'The record ids in the {source} must be unique across partitions, but there are'
+            f' {num_ids} rows and {num_unique_ids} distinct ids; pass the name of a column of'
+            ' unique integer ids as record_id_column'
+        )
+
 def omit_kids_from_census(census_df, frac=0.05, random_state=None):
     """Generate decennial census data to link by dropping additional kids.
     
@@ -2,304 +2,316 @@
 Module for adding noise to the decennial census and WIC data before linking.
 """
 import numpy as np
-from ..noise import noisify, corruption, fake_names
+import pandas as pd
+from ..noise import noisify, fake_names, random_streams
+from . import datasets
 
-def add_noise_to_census(
-    df_census,
-    row_eligibility_rate = 0.01,
-    token_rate_multiplier = 1,
-    orig_token_prob = 1/5,
-    random_state=None,
-):
-    rng = np.random.default_rng(random_state)
-    # Copy the dataframe since we're going to alter it
-    df_census = df_census.copy()
+RACE_ETHNICITY_CHOICES = ['Black', 'White', 'Latino', 'Multiracial or Other', 'Asian','AIAN', 'NHOPI']
 
-    # First name
-    print('first name')
-    fname_mean_length = df_census['first_name'].str.len().mean()
-    fname_token_rate = token_rate_multiplier / fname_mean_length
-    noisify.apply_noise_function_to_column(
-        df_census, 'first_name', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column( # Replace random 1% with random fake name
-        df_census, 'first_name', row_eligibility_rate, rng,
-        corruption.random_choice, (fake_names.fake_first_names('title'),), inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'first_name', row_eligibility_rate, rng,
-        corruption.phonetic_corrupt, (fname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'first_name', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (fname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'first_name', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (fname_token_rate, orig_token_prob),
-        vectorized=False, inplace=True)
+def _missing(row_prob):
+    return {'corruption.replace_with_missing': dict(row_prob=row_prob, share_random_state=False)}
 
-    # Last name
-    print('last name')
-    lname_mean_length = df_census['last_name'].str.len().mean()
-    lname_token_rate = token_rate_multiplier / lname_mean_length
-    noisify.apply_noise_function_to_column(
-        df_census, 'last_name', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column( # Replace random 1% with random fake name
-        df_census, 'last_name', row_eligibility_rate, rng,
-        corruption.random_choice, (fake_names.fake_last_names('title'),), inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'last_name', row_eligibility_rate, rng,
-        corruption.phonetic_corrupt, (lname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'last_name', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (lname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'last_name', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (lname_token_rate, orig_token_prob),
-        vectorized=False, inplace=True)
+def _token_noise(row_prob, token_rate, addl_pr, phonetic=True, deduplicate=False):
+    """Phonetic, OCR, and keyboard errors, each at the same per-token rate.
+    With deduplicate=True, the tokens of each distinct value are found only once
+    (see corruption.corrupt_tokens), which is faster for columns of names.
+    """
+    kwargs = dict(deduplicate=True) if deduplicate else None
+    noise = {}
+    if phonetic:
+        noise['corruption.phonetic_corrupt'] = dict(row_prob=row_prob, args=(token_rate,), kwargs=kwargs)
+    noise['corruption.ocr_corrupt'] = dict(row_prob=row_prob, args=(token_rate,), kwargs=kwargs)
+    noise['corruption.keyboard_corrupt'] = dict(
+        row_prob=row_prob, args=(token_rate, addl_pr), kwargs=kwargs)
+    return noise
 
-    # Date of birth
-    print('DOB')
-    dob_token_rate = token_rate_multiplier / len('yyyymmdd')
-    noisify.apply_noise_function_to_column(
-        df_census, 'date_of_birth', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'date_of_birth', row_eligibility_rate, rng,
-        corruption.swap_month_day, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'date_of_birth', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (dob_token_rate, 0), # Don't add additional characters to DOB
-        vectorized=False, inplace=True)
+def _string_noise(row_prob, token_rate, addl_pr, fake_choices=None, deduplicate=False):
+    """Missingness, optionally fake values, and token errors for a string column."""
+    noise = _missing(row_prob)
+    if fake_choices is not None: # Replace random 1% with random fake name
+        noise['corruption.random_choice'] = dict(row_prob=row_prob, args=(fake_choices,))
+    noise.update(_token_noise(row_prob, token_rate, addl_pr, deduplicate=deduplicate))
+    return noise
+
+def mean_lengths(df, columns):
+    """Return a dict mapping each column to the mean length of its values.
+    Works for Dask dataframes too, computing all the means at once.
+    """
+    means = [df[col].str.len().mean() for col in columns]
+    if hasattr(means[0], 'compute'):
+        import dask
+        means = dask.compute(*means)
+    return dict(zip(columns, means))
 
-    # Zipcode
-    print('zip')
+def mean_lengths_parquet(path, columns):
+    """Like mean_lengths, for a Parquet file or directory of Parquet files,
+    reading one row group of the columns at a time.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    total_lengths = dict.fromkeys(columns, 0)
+    counts = dict.fromkeys(columns, 0)
+    for table in noisify.iter_parquet_row_groups(path, columns):
+        for col in columns:
+            values = table[col]
+            if pa.types.is_dictionary(values.type):
+                values = values.cast(values.type.value_type)
+            lengths = pc.utf8_length(values)
+            total_lengths[col] += pc.sum(lengths).as_py() or 0
+            counts[col] += len(lengths) - lengths.null_count
+    return {col: total_lengths[col] / counts[col] for col in columns}
+
+def _common_noise_spec(
+    df, row_eligibility_rate, token_rate_multiplier, orig_token_prob, use_fake_names=False,
+    lengths=None,
+):
+    """Noise specification for the columns shared by the census and WIC."""
+    if lengths is None:
+        lengths = mean_lengths(df, ['first_name', 'last_name', 'address'])
+    row_prob = row_eligibility_rate
+    fname_token_rate = token_rate_multiplier / lengths['first_name']
+    lname_token_rate = token_rate_multiplier / lengths['last_name']
+    dob_token_rate = token_rate_multiplier / len('yyyymmdd')
     zipcode_len = 5
     zipcode_token_rate = token_rate_multiplier / zipcode_len
     # Define relative error rates between first 2 digits, middle digit, last 2 digits
     zipcode_token_weights = np.array([1,4,10])
     zipcode_token_probs = zipcode_token_rate * zipcode_token_weights / zipcode_token_weights.mean()
-    noisify.apply_noise_function_to_column(
-        df_census, 'zipcode', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'zipcode', row_eligibility_rate, rng,
-        corruption.miswrite_zipcode, zipcode_token_probs, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'zipcode', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (zipcode_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'zipcode', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (zipcode_token_rate, 0), # Don't add extra characters to zip
-        vectorized=False, inplace=True)
-
-    # Address
-    print('address')
-    address_mean_length = df_census['address'].str.len().mean()
-    address_token_rate = token_rate_multiplier / address_mean_length
-    noisify.apply_noise_function_to_column(
-        df_census, 'address', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'address', row_eligibility_rate, rng,
-        corruption.phonetic_corrupt, (address_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'address', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (address_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'address', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (address_token_rate, orig_token_prob),
-        vectorized=False, inplace=True)
+    address_token_rate = token_rate_multiplier / lengths['address']
 
-    # Sex
-    print('sex')
-    noisify.apply_noise_function_to_column(
-        df_census, 'sex', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column( # Approximately 1%*(1/2)=0.5% will be different
-        df_census, 'sex', row_eligibility_rate, rng,
-        corruption.random_choice, (['Male', 'Female'],), inplace=True,
-    )
+    return {
+        'first_name': _string_noise(
+            row_prob, fname_token_rate, orig_token_prob,
+            fake_names.fake_first_names('title') if use_fake_names else None, deduplicate=True),
+        'last_name': _string_noise(
+            row_prob, lname_token_rate, orig_token_prob,
+            fake_names.fake_last_names('title') if use_fake_names else None, deduplicate=True),
+        'date_of_birth': {
+            **_missing(row_prob),
+            'corruption.swap_month_day': dict(row_prob=row_prob, share_random_state=False),
+            # Don't add additional characters to DOB
+            'corruption.keyboard_corrupt': dict(row_prob=row_prob, args=(dob_token_rate, 0)),
+        },
+        'zipcode': {
+            **_missing(row_prob),
+            'corruption.miswrite_zipcode': dict(row_prob=row_prob, args=tuple(zipcode_token_probs)),
+            # Don't add extra characters to zip
+            **_token_noise(row_prob, zipcode_token_rate, 0, phonetic=False),
+        },
+        'address': _string_noise(row_prob, address_token_rate, orig_token_prob),
+        'sex': {
+            **_missing(row_prob),
+            # Approximately 1%*(1/2)=0.5% will be different
+            'corruption.random_choice': dict(row_prob=row_prob, args=(['Male', 'Female'],)),
+        },
+        'race_ethnicity': {
+            **_missing(row_prob),
+            # Approximately 1%*(6/7) will be different
+            'corruption.random_choice': dict(row_prob=row_prob, args=(RACE_ETHNICITY_CHOICES,)),
+        },
+    }
 
-    # Age
-    print('age')
-    noisify.apply_noise_function_to_column(
-        df_census, 'age', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'age', row_eligibility_rate, rng,
-        corruption.miswrite_age, ([-2, -1, 1, 2],), inplace=True,
-    )
-
-    # Race/Ethnicity
-    print('race/ethnicity')
-    noisify.apply_noise_function_to_column(
-        df_census, 'race_ethnicity', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column( # Approximately 1%*(6/7) will be different
-        df_census, 'race_ethnicity', row_eligibility_rate, rng,
-        corruption.random_choice,
-        (['Black', 'White', 'Latino', 'Multiracial or Other', 'Asian','AIAN', 'NHOPI'],),
-        inplace=True
-    )
-
-    # Middle initial
-    print('middle initial')
+def census_noise_spec(
+    df_census,
+    row_eligibility_rate = 0.01,
+    token_rate_multiplier = 1,
+    orig_token_prob = 1/5,
+    lengths=None,
+):
+    """Return the noise specification (see noise.noisify.NoisePlan) for the
+    decennial census. The token error rates of the name and address columns
+    are scaled by the mean length of their values, which are taken from the
+    dict `lengths` if passed or else computed from df_census.
+    """
+    row_prob = row_eligibility_rate
+    spec = _common_noise_spec(
+        df_census, row_eligibility_rate, token_rate_multiplier, orig_token_prob,
+        use_fake_names=True, lengths=lengths)
+    spec['age'] = {
+        **_missing(row_prob),
+        'corruption.miswrite_age': dict(row_prob=row_prob, args=([-2, -1, 1, 2],)),
+    }
     middle_initial_length = 1
     mi_token_rate = token_rate_multiplier / middle_initial_length
-    noisify.apply_noise_function_to_column(
-        df_census, 'middle_initial', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'middle_initial', row_eligibility_rate, rng,
-        corruption.phonetic_corrupt, (mi_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'middle_initial', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (mi_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_census, 'middle_initial', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (mi_token_rate, 0), # Don't add extra characters to middle initial
-        vectorized=False, inplace=True)
-
-    return df_census
+    # Don't add extra characters to middle initial
+    spec['middle_initial'] = _string_noise(row_prob, mi_token_rate, 0, deduplicate=True)
+    return spec
 
-def add_noise_to_wic(
+def wic_noise_spec(
     df_wic,
     row_eligibility_rate = 0.01,
     token_rate_multiplier = 1,
     orig_token_prob = 1/5,
-    random_state=None,
+    lengths=None,
 ):
-    rng = np.random.default_rng(random_state)
-    # Copy the dataframe since we're going to alter it
-    df_wic = df_wic.copy()
+    """Return the noise specification (see noise.noisify.NoisePlan) for the
+    WIC data. The token error rates of the name and address columns
+    are scaled by the mean length of their values, which are taken from the
+    dict `lengths` if passed or else computed from df_wic.
+    """
+    if lengths is None:
+        lengths = mean_lengths(df_wic, ['first_name', 'last_name', 'address', 'middle_name'])
+    row_prob = row_eligibility_rate
+    spec = _common_noise_spec(
+        df_wic, row_eligibility_rate, token_rate_multiplier, orig_token_prob, lengths=lengths)
+    mname_token_rate = token_rate_multiplier / lengths['middle_name']
+    spec['middle_name'] = _string_noise(row_prob, mname_token_rate, orig_token_prob, deduplicate=True)
+    return spec
 
-    # First name
-    print('first name')
-    fname_mean_length = df_wic['first_name'].str.len().mean()
-    fname_token_rate = token_rate_multiplier / fname_mean_length
-    noisify.apply_noise_function_to_column(
-        df_wic, 'first_name', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'first_name', row_eligibility_rate, rng,
-        corruption.phonetic_corrupt, (fname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'first_name', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (fname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'first_name', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (fname_token_rate, orig_token_prob),
-        vectorized=False, inplace=True)
+def _noise_rng(random_state, record_ids):
+    if record_ids is None:
+        return np.random.default_rng(random_state)
+    return random_streams.RecordBoundGenerator(random_state, record_ids)
 
-    # Last name
-    print('last name')
-    lname_mean_length = df_wic['last_name'].str.len().mean()
-    lname_token_rate = token_rate_multiplier / lname_mean_length
-    noisify.apply_noise_function_to_column(
-        df_wic, 'last_name', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'last_name', row_eligibility_rate, rng,
-        corruption.phonetic_corrupt, (lname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'last_name', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (lname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'last_name', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (lname_token_rate, orig_token_prob),
-        vectorized=False, inplace=True)
+def add_noise_to_census(
+    df_census,
+    row_eligibility_rate = 0.01,
+    token_rate_multiplier = 1,
+    orig_token_prob = 1/5,
+    random_state=None,
+    record_ids=None,
+    stats=None,
+):
+    """Return a copy of df_census with noise added.
+    If record_ids (integer ids, one per row) are passed, the noise in each row
+    depends only on random_state and the row's id (given the noise
+    specification, whose token rates depend on the mean lengths of the
+    values; to noise partitions separately, build the specification from
+    the whole dataset and apply it to each partition with noisify.NoisePlan).
+    If stats is a list, statistics for each noise function are appended to it
+    (see noisify.apply_noise_to_column), including the ratio of rows to
+    distinct values for the deduplicated token noise of the name columns.
+    """
+    rng = _noise_rng(random_state, record_ids)
+    spec = census_noise_spec(df_census, row_eligibility_rate, token_rate_multiplier, orig_token_prob)
+    # Returns a copy since we're going to alter the dataframe
+    return noisify.NoisePlan(spec).apply(df_census, rng, verbose=True, stats=stats)
 
-    # Date of birth
-    print('DOB')
-    dob_token_rate = token_rate_multiplier / len('yyyymmdd')
-    noisify.apply_noise_function_to_column(
-        df_wic, 'date_of_birth', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'date_of_birth', row_eligibility_rate, rng,
-        corruption.swap_month_day, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'date_of_birth', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (dob_token_rate, 0), # Don't add additional characters to DOB
-        vectorized=False, inplace=True)
+def add_noise_to_wic(
+    df_wic,
+    row_eligibility_rate = 0.01,
+    token_rate_multiplier = 1,
+    orig_token_prob = 1/5,
+    random_state=None,
+    record_ids=None,
+    stats=None,
+):
+    """Return a copy of df_wic with noise added.
+    If record_ids (integer ids, one per row) are passed, the noise in each row
+    depends only on random_state and the row's id (given the noise
+    specification, whose token rates depend on the mean lengths of the
+    values; to noise partitions separately, build the specification from
+    the whole dataset and apply it to each partition with noisify.NoisePlan).
+    If stats is a list, statistics for each noise function are appended to
+    it, as in add_noise_to_census.
+    """
+    rng = _noise_rng(random_state, record_ids)
+    spec = wic_noise_spec(df_wic, row_eligibility_rate, token_rate_multiplier, orig_token_prob)
+    # Returns a copy since we're going to alter the dataframe
+    return noisify.NoisePlan(spec).apply(df_wic, rng, verbose=True, stats=stats)
 
-    # Zipcode
-    print('zip')
-    zipcode_len = 5
-    zipcode_token_rate = token_rate_multiplier / zipcode_len
-    # Define relative error rates between first 2 digits, middle digit, last 2 digits
-    zipcode_token_weights = np.array([1,4,10])
-    zipcode_token_probs = zipcode_token_rate * zipcode_token_weights / zipcode_token_weights.mean()
-    noisify.apply_noise_function_to_column(
-        df_wic, 'zipcode', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'zipcode', row_eligibility_rate, rng,
-        corruption.miswrite_zipcode, zipcode_token_probs, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'zipcode', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (zipcode_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'zipcode', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (zipcode_token_rate, 0), # Don't add extra characters to zip
-        vectorized=False, inplace=True)
+def add_noise_to_census_distributed(
+    ops,
+    df_census,
+    row_eligibility_rate = 0.01,
+    token_rate_multiplier = 1,
+    orig_token_prob = 1/5,
+    random_state=None,
+    record_id_column=None,
+):
+    """Like add_noise_to_census, for a dataframe of any compute engine
+    supported by distributed_compute.DataFrameOperations `ops`, noising each
+    partition separately. The mean lengths that determine the token error
+    rates are computed once for the whole dataframe, and the noise in each
+    row is keyed by random_state and the row's integer record id (from
+    record_id_column, or the index if None), so the result doesn't depend
+    on how df_census is partitioned. The ids must be unique across
+    partitions (see datasets.check_unique_record_ids).
+    """
+    spec = census_noise_spec(
+        df_census, row_eligibility_rate, token_rate_multiplier, orig_token_prob,
+        lengths=mean_lengths(df_census, ['first_name', 'last_name', 'address']))
+    return _add_noise_distributed(ops, df_census, spec, random_state, record_id_column)
 
-    # Address
-    print('address')
-    address_mean_length = df_wic['address'].str.len().mean()
-    address_token_rate = token_rate_multiplier / address_mean_length
-    noisify.apply_noise_function_to_column(
-        df_wic, 'address', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'address', row_eligibility_rate, rng,
-        corruption.phonetic_corrupt, (address_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'address', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (address_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'address', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (address_token_rate, orig_token_prob),
-        vectorized=False, inplace=True)
+def add_noise_to_wic_distributed(
+    ops,
+    df_wic,
+    row_eligibility_rate = 0.01,
+    token_rate_multiplier = 1,
+    orig_token_prob = 1/5,
+    random_state=None,
+    record_id_column=None,
+):
+    """Like add_noise_to_wic, for a dataframe of any compute engine
+    supported by distributed_compute.DataFrameOperations `ops`.
+    See add_noise_to_census_distributed.
+    """
+    spec = wic_noise_spec(
+        df_wic, row_eligibility_rate, token_rate_multiplier, orig_token_prob,
+        lengths=mean_lengths(df_wic, ['first_name', 'last_name', 'address', 'middle_name']))
+    return _add_noise_distributed(ops, df_wic, spec, random_state, record_id_column)
 
-    # Sex
-    print('sex')
-    noisify.apply_noise_function_to_column(
-        df_wic, 'sex', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column( # Approximately 1%*(1/2)=0.5% will be different
-        df_wic, 'sex', row_eligibility_rate, rng,
-        corruption.random_choice, (['Male', 'Female'],), inplace=True,
-    )
+def add_noise_to_census_parquet(
+    input_path,
+    output_path,
+    row_eligibility_rate = 0.01,
+    token_rate_multiplier = 1,
+    orig_token_prob = 1/5,
+    random_state=None,
+    record_id_column=None,
+    verbose=False,
+    stats=None,
+):
+    """Like add_noise_to_census, for census data in a Parquet file or directory
+    of Parquet files at input_path, streaming it one row group at a time
+    and writing the noised data to the directory output_path (see
+    noisify.NoisePlan.apply_to_parquet), so that memory use is bounded by the
+    size of a row group. The mean lengths that determine the token error
+    rates are computed for the whole dataset in a first pass over the name
+    and address columns. The noise in each row is keyed by random_state and
+    the row's record id (from record_id_column, or the row's position in the
+    input if None). Returns the number of rows written.
+    """
+    spec = census_noise_spec(
+        None, row_eligibility_rate, token_rate_multiplier, orig_token_prob,
+        lengths=mean_lengths_parquet(input_path, ['first_name', 'last_name', 'address']))
+    return noisify.NoisePlan(spec).apply_to_parquet(
+        input_path, output_path, random_state, record_id_column, verbose, stats)
 
-    # Race/Ethnicity
-    print('race/ethnicity')
-    noisify.apply_noise_function_to_column(
-        df_wic, 'race_ethnicity', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column( # Approximately 1%*(6/7) will be different
-        df_wic, 'race_ethnicity', row_eligibility_rate, rng,
-        corruption.random_choice,
-        (['Black', 'White', 'Latino', 'Multiracial or Other', 'Asian','AIAN', 'NHOPI'],),
-        inplace=True
-    )
+def add_noise_to_wic_parquet(
+    input_path,
+    output_path,
+    row_eligibility_rate = 0.01,
+    token_rate_multiplier = 1,
+    orig_token_prob = 1/5,
+    random_state=None,
+    record_id_column=None,
+    verbose=False,
+    stats=None,
+):
+    """Like add_noise_to_wic, for WIC data in a Parquet file or directory of
+    Parquet files. See add_noise_to_census_parquet.
+    """
+    spec = wic_noise_spec(
+        None, row_eligibility_rate, token_rate_multiplier, orig_token_prob,
+        lengths=mean_lengths_parquet(input_path, ['first_name', 'last_name', 'address', 'middle_name']))
+    return noisify.NoisePlan(spec).apply_to_parquet(
+        input_path, output_path, random_state, record_id_column, verbose, stats)
 
-    # Middle name
-    print('middle name')
-    mname_mean_length = df_wic['middle_name'].str.len().mean()
-    mname_token_rate = token_rate_multiplier / mname_mean_length
-    noisify.apply_noise_function_to_column(
-        df_wic, 'middle_name', row_eligibility_rate, rng,
-        corruption.replace_with_missing, share_random_state=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'middle_name', row_eligibility_rate, rng,
-        corruption.phonetic_corrupt, (mname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'middle_name', row_eligibility_rate, rng,
-        corruption.ocr_corrupt, (mname_token_rate,), vectorized=False, inplace=True)
-    noisify.apply_noise_function_to_column(
-        df_wic, 'middle_name', row_eligibility_rate, rng,
-        corruption.keyboard_corrupt, (mname_token_rate, orig_token_prob),
-        vectorized=False, inplace=True)
+def _add_noise_distributed(ops, df, spec, random_state, record_id_column):
+    datasets.check_unique_record_ids(ops, df, record_id_column)
+    # Fix the entropy here so every partition uses the same seed even if random_state is None
+    seed = np.random.SeedSequence(random_state).entropy
+    # Dask's meta is the result of noising the empty meta, with the same dtypes as df
+    return ops.map_partitions(df, _noise_partition, noisify.NoisePlan(spec), seed, record_id_column)
 
-    return df_wic
+def _noise_partition(df_part, plan, seed, record_id_column, partition_info=None):
+    ids = df_part.index if record_id_column is None else df_part[record_id_column]
+    rng = random_streams.RecordBoundGenerator(seed, np.asarray(ids, dtype=np.int64))
+    noised = plan.apply(df_part, rng)
+    # Keep the input dtypes (e.g., pyarrow strings) so the result matches Dask's meta
+    dtypes = {
+        col: dtype for col, dtype in df_part.dtypes.items()
+        if noised[col].dtype != dtype and not isinstance(dtype, pd.CategoricalDtype)
+    }
+    return noised.astype(dtypes) if dtypes else noised
@@ -0,0 +1,275 @@
+"""
+Module for measuring the throughput of the noise functions on synthetic data.
+
+run_noise_benchmarks times every noise function in corruption.py, applied to
+a synthetic column with noisify.apply_noise_function_to_column both
+vectorized and mapped over scalars, and saves the results as JSON so that
+runs on different commits can be compared with compare_noise_benchmarks.
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from . import corruption, noisify
+
+DEFAULT_SIZES = (10**4, 10**5, 10**6, 10**7)
+
+RACE_ETHNICITY_CHOICES = ['Black', 'White', 'Latino', 'Multiracial or Other', 'Asian', 'AIAN', 'NHOPI']
+STREET_NAMES = ['Main', 'Oak', 'Maple', 'Cedar', 'Pine', 'Elm', 'Washington', 'Lake', 'Hill', 'Park']
+STREET_SUFFIXES = ['St', 'Ave', 'Rd', 'Blvd', 'Ln', 'Dr', 'Ct', 'Way']
+
+# Noise functions to benchmark: case name -> (column, function key, parameters),
+# where the parameters (args, kwargs, and share_random_state) are passed to
+# noisify.apply_noise_function_to_column, with rates like those used for the
+# find_kids datasets
+NOISE_FUNCTION_CASES = {
+    'replace_with_missing': (
+        'first_name', 'corruption.replace_with_missing', dict(share_random_state=False)),
+    'random_choice': (
+        'race_ethnicity', 'corruption.random_choice', dict(args=(RACE_ETHNICITY_CHOICES,))),
+    'random_choice_resampling': (
+        'race_ethnicity', 'corruption.random_choice',
+        dict(args=(RACE_ETHNICITY_CHOICES,), kwargs={'exclusion_algorithm': 'resampling'})),
+    'random_choice_no_exclusion': (
+        'race_ethnicity', 'corruption.random_choice',
+        dict(args=(RACE_ETHNICITY_CHOICES,), kwargs={'exclusion_algorithm': None})),
+    'swap_month_day': (
+        'date_of_birth', 'corruption.swap_month_day', dict(share_random_state=False)),
+    'miswrite_zipcode': ('zipcode', 'corruption.miswrite_zipcode', dict(args=(0.04, 0.16, 0.4))),
+    'miswrite_age': ('age', 'corruption.miswrite_age', dict(args=([-2, -1, 1, 2],))),
+    **{
+        f'{function}/{column}': (column, f'corruption.{function}', dict(args=args))
+        for function, args in [
+            ('ocr_corrupt', (0.1,)), ('phonetic_corrupt', (0.1,)), ('keyboard_corrupt', (0.1, 0.2))]
+        for column in ['first_name', 'last_name', 'address']
+    },
+    # Token noise that finds the tokens of each distinct name only once
+    **{
+        f'{function}_deduplicated/first_name': (
+            'first_name', f'corruption.{function}', dict(args=args, kwargs={'deduplicate': True}))
+        for function, args in [
+            ('ocr_corrupt', (0.1,)), ('phonetic_corrupt', (0.1,)), ('keyboard_corrupt', (0.1, 0.2))]
+    },
+}
+
+def _nicknames():
+    return pd.read_csv(
+        os.path.join(os.path.dirname(__file__), 'nicknames.csv'),
+        header=None, usecols=[0]
+    )[0].str.title().to_numpy(dtype=object)
+
+def synthetic_names(num_names, random_state=None):
+    """Generate a Series of title-case first names by sampling (with replacement)
+    from the names in nicknames.csv.
+    """
+    rng = np.random.default_rng(random_state)
+    return pd.Series(rng.choice(_nicknames(), num_names), name='first_name')
+
+def synthetic_columns(num_rows, random_state=None, string_dtype=object):
+    """Generate a DataFrame of `num_rows` synthetic records with the columns
+    first_name, last_name, address, date_of_birth ('yyyy-mm-dd'), zipcode
+    (5 digits), age, and race_ethnicity. The string columns have the dtype
+    string_dtype (e.g., 'large_string[pyarrow]').
+    """
+    rng = np.random.default_rng(random_state)
+    names = _nicknames()
+    house_numbers = rng.integers(1, 10_000, num_rows).astype(str).astype(object)
+    addresses = (
+        house_numbers + ' ' + rng.choice(np.array(STREET_NAMES, dtype=object), num_rows)
+        + ' ' + rng.choice(np.array(STREET_SUFFIXES, dtype=object), num_rows))
+    dates_of_birth = (
+        np.datetime64('1920-01-01') + rng.integers(0, 100 * 365, num_rows)).astype(str)
+    zipcodes = pd.Series(rng.integers(0, 100_000, num_rows)).astype(str).str.zfill(5)
+    df = pd.DataFrame({
+        'first_name': rng.choice(names, num_rows),
+        'last_name': rng.choice(names, num_rows),
+        'address': addresses,
+        'date_of_birth': dates_of_birth.astype(object),
+        'zipcode': zipcodes.to_numpy(dtype=object),
+        'age': rng.integers(0, 100, num_rows),
+        'race_ethnicity': rng.choice(np.array(RACE_ETHNICITY_CHOICES, dtype=object), num_rows),
+    })
+    string_columns = df.columns.drop('age')
+    return df.astype({column: string_dtype for column in string_columns})
+
+def time_noise_function(
+    df, column, noise_function, args=(), kwargs=None, share_random_state=True,
+    vectorized=True, row_prob=1.0, random_state=None, repeat=1, measure_memory=True,
+):
+    """Time noisify.apply_noise_function_to_column applying noise_function
+    to df[column], in place on a copy of the column made before timing each
+    run. Returns a dict with the fastest time of `repeat` runs
+    (seconds), the throughput in rows per second, and (if measure_memory)
+    the peak memory allocated during one more run, as traced by tracemalloc
+    (which includes NumPy arrays but not pyarrow buffers). The traced run is
+    separate because tracing slows down allocation.
+    """
+    noise_function = noisify.get_noise_function(noise_function)
+    kwargs = {} if kwargs is None else kwargs
+
+    def run(column_df):
+        # apply_noise_function_to_column adds random_state to the kwargs it's passed
+        noisify.apply_noise_function_to_column(
+            column_df, column, row_prob, np.random.default_rng(random_state), noise_function,
+            args, dict(kwargs), vectorized=vectorized, share_random_state=share_random_state,
+            inplace=True)
+
+    times = []
+    for _ in range(repeat):
+        # Noise a copy of just the column in place, so that copying isn't timed
+        column_df = df[[column]].copy()
+        start = time.perf_counter()
+        run(column_df)
+        times.append(time.perf_counter() - start)
+    seconds = min(times)
+    result = {'seconds': seconds, 'rows_per_sec': len(df) / seconds, 'peak_memory_bytes': None}
+    if measure_memory:
+        column_df = df[[column]].copy()
+        tracemalloc.start()
+        try:
+            run(column_df)
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+def run_noise_benchmarks(
+    sizes=DEFAULT_SIZES,
+    cases=None,
+    modes=('vectorized', 'scalar'),
+    max_scalar_rows=10**5,
+    row_prob=1.0,
+    repeat=1,
+    measure_memory=True,
+    string_dtype=object,
+    random_state=None,
+    output_path=None,
+    verbose=False,
+):
+    """Time the noise functions in NOISE_FUNCTION_CASES (or the cases named
+    in `cases`) on synthetic columns with each number of rows in `sizes`,
+    applied to a fraction row_prob of the rows in each mode: 'vectorized'
+    (the function is passed the Series) and 'scalar' (the function is mapped
+    over the values). Scalar mode is skipped for more than max_scalar_rows
+    rows (pass None to never skip it), which is recorded in the results.
+
+    Returns a dict with the metadata of the run (time, git commit, package
+    versions, and parameters) and a list of results, one dict per case, mode,
+    and size; see time_noise_function. If output_path is passed, the dict is
+    also saved there as JSON.
+    """
+    cases = list(NOISE_FUNCTION_CASES) if cases is None else list(cases)
+    benchmarks = {
+        'metadata': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'parameters': {
+                'sizes': list(sizes), 'modes': list(modes), 'max_scalar_rows': max_scalar_rows,
+                'row_prob': row_prob, 'repeat': repeat, 'string_dtype': str(string_dtype),
+                'random_state': random_state,
+            },
+        },
+        'results': [],
+    }
+    for num_rows in sizes:
+        df = synthetic_columns(num_rows, random_state, string_dtype)
+        for case in cases:
+            column, function, params = NOISE_FUNCTION_CASES[case]
+            for mode in modes:
+                result = {
+                    'case': case, 'function': function, 'column': column, 'mode': mode,
+                    'num_rows': num_rows, 'skipped': False,
+                }
+                if mode == 'scalar' and max_scalar_rows is not None and num_rows > max_scalar_rows:
+                    result.update(skipped=True, seconds=None, rows_per_sec=None, peak_memory_bytes=None)
+                else:
+                    result.update(time_noise_function(
+                        df, column, function, **params, vectorized=(mode == 'vectorized'),
+                        row_prob=row_prob, random_state=random_state, repeat=repeat,
+                        measure_memory=measure_memory))
+                if verbose:
+                    print(_format_result(result), flush=True)
+                benchmarks['results'].append(result)
+    if output_path is not None:
+        save_noise_benchmarks(benchmarks, output_path)
+    return benchmarks
+
+def save_noise_benchmarks(benchmarks, path):
+    """Save the results of run_noise_benchmarks as JSON."""
+    with open(path, 'w') as f:
+        json.dump(benchmarks, f, indent=2)
+
+def load_noise_benchmarks(path):
+    """Load results saved by save_noise_benchmarks."""
+    with open(path) as f:
+        return json.load(f)
+
+def compare_noise_benchmarks(baseline, current):
+    """Compare two runs of run_noise_benchmarks (dicts or paths to their JSON
+    files). Returns a DataFrame indexed by case, mode, and number of rows, with
+    the throughput and peak memory of each run and their ratios (current /
+    baseline), sorted from the largest slowdown to the largest speedup.
+    """
+    frames = []
+    for label, benchmarks in [('baseline', baseline), ('current', current)]:
+        if not isinstance(benchmarks, dict):
+            benchmarks = load_noise_benchmarks(benchmarks)
+        frames.append(
+            pd.DataFrame(benchmarks['results'])
+            .query('not skipped')
+            .set_index(['case', 'mode', 'num_rows'])
+            [['rows_per_sec', 'peak_memory_bytes']]
+            .add_prefix(f'{label}_')
+        )
+    comparison = frames[0].join(frames[1], how='inner')
+    comparison['speedup'] = comparison['current_rows_per_sec'] / comparison['baseline_rows_per_sec']
+    comparison['memory_ratio'] = (
+        comparison['current_peak_memory_bytes'] / comparison['baseline_peak_memory_bytes'])
+    return comparison.sort_values('speedup')
+
+def _format_result(result):
+    label = f"{result['case']:<40} {result['mode']:<10} {result['num_rows']:>10,} rows"
+    if result['skipped']:
+        return f'{label}  skipped'
+    memory = result['peak_memory_bytes']
+    memory = '' if memory is None else f'  {memory / 2**20:10.1f} MiB'
+    return f"{label}  {result['rows_per_sec']:14,.0f} rows/s{memory}"
+
+def _git_commit():
+    """Return the commit of the repository containing this file, or None."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_phonetic_rules(num_names=10**7, corrupted_pr=0.2, random_state=None):
+    """Compare the throughput of context-sensitive phonetic corruption with
+    that of unconstrained phonetic corruption (which ignores the where, pre,
+    post, pattern, and start conditions) on a column of `num_names` names.
+    Returns a dict with the throughput of each in rows per second and the
+    ratio between them.
+    """
+    names = synthetic_names(num_names, random_state)
+    unconstrained_table = corruption.SubstitutionTable(corruption.phonetic_error_dict)
+    results = {'num_names': num_names}
+    for label, table in [
+        ('unconstrained', unconstrained_table),
+        ('context_sensitive', corruption.phonetic_table),
+    ]:
+        start = time.perf_counter()
+        corruption.corrupt_tokens(names, table, corrupted_pr, random_state=random_state)
+        results[f'{label}_rows_per_sec'] = num_names / (time.perf_counter() - start)
+    results['slowdown'] = (
+        results['unconstrained_rows_per_sec'] / results['context_sensitive_rows_per_sec'])
+    return results
@@ -0,0 +1,79 @@
+"""
+Module for working with pandas categorical Series in terms of their integer
+codes, so that noise functions can change the values of a categorical column
+without materializing a value for every row, and without adding new categories
+one value at a time.
+"""
+
+import numpy as np
+import pandas as pd
+
+def is_categorical(values):
+    """Check whether values (e.g., a Series) has a categorical dtype."""
+    return isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype)
+
+def encode(values, categories):
+    """Return the codes of `values` (an array-like, possibly categorical) among
+    the Index `categories`, with -1 for missing values, and an Index of the
+    values that aren't in `categories`. The new values get the codes
+    len(categories), len(categories)+1, ..., so the codes are valid for
+    categories.append(new_categories).
+    """
+    if is_categorical(values):
+        # Encode the (few) categories in use instead of the values themselves
+        values = pd.Categorical(values)
+        used, value_codes = used_categories(values.codes, len(values.categories))
+        used_codes, new_categories = encode(values.categories[used], categories)
+        return _take_codes(used_codes, value_codes), new_categories
+    value_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    unique_codes = categories.get_indexer(uniques).astype(np.int64)
+    is_new = unique_codes < 0
+    unique_codes[is_new] = len(categories) + np.arange(is_new.sum())
+    return _take_codes(unique_codes, value_codes), pd.Index(uniques[is_new], dtype=object)
+
+def used_categories(codes, num_categories):
+    """Return the positions of the categories that appear in `codes`, in
+    increasing order, and the codes relative to those categories.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    used = np.flatnonzero(np.bincount(codes[codes >= 0], minlength=num_categories))
+    position_in_used = np.full(num_categories, -1, dtype=np.int64)
+    position_in_used[used] = np.arange(len(used))
+    return used, _take_codes(position_in_used, codes)
+
+def _take_codes(codes, indices):
+    """Return codes[indices], or -1 where indices is -1."""
+    result = np.full(len(indices), -1, dtype=np.int64)
+    present = indices >= 0
+    result[present] = codes[indices[present]]
+    return result
+
+def extend(dtype, new_categories):
+    """Return the CategoricalDtype `dtype` with new_categories appended to its
+    categories (in one step), or dtype itself if there are none.
+    """
+    if len(new_categories) == 0:
+        return dtype
+    categories = dtype.categories.append(new_categories)
+    # Keep the dtype of the categories (e.g., str) if the new ones fit it
+    if categories.dtype != dtype.categories.dtype:
+        try:
+            categories = categories.astype(dtype.categories.dtype)
+        except (TypeError, ValueError):
+            pass
+    return pd.CategoricalDtype(categories, dtype.ordered)
+
+def from_codes(codes, dtype, index=None, name=None):
+    """Make a Series with the CategoricalDtype `dtype` from codes (with -1
+    for missing values).
+    """
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), index=index, name=name)
+
+def assign(series, rows, values):
+    """Return a copy of the categorical Series `series` with the values at
+    `rows` (a boolean mask or positions) replaced by `values`, adding all
+    the values that aren't categories yet to the categories at once.
+    """
+    codes = series.cat.codes.to_numpy(dtype=np.int64, copy=True)
+    codes[rows], new_categories = encode(values, series.cat.categories)
+    return from_codes(codes, extend(series.dtype, new_categories), series.index, series.name)
@@ -5,11 +5,20 @@ Informed by reading https://dmm.anu.edu.au/geco/flex-data-gen-manual.pdf but not
 
 NOTE: Noise functions that take strings as inputs can be vectorized by using pd.Series.str
 See the swap_month_day and miswrite_zipcode functions for examples.
+The token-level corruptors (ocr_corrupt, phonetic_corrupt, keyboard_corrupt)
+also accept a pandas Series, which is corrupted in a single pass by corrupt_tokens.
 """
 
+import functools
+import hashlib
+import os
+import pickle
+import warnings
 import numpy as np
 import pandas as pd
-import os
+from .matching import AhoCorasickMatcher
+from .phonetic_rules import ASCII_LOWERCASE, PhoneticRules, rules_by_token
+from . import categorical, random_streams
 
 # Store directory of this file to use relative filepaths for .csv's
 # I'm using this as a solution to a FileNotFoundError on module import
@@ -17,34 +26,422 @@ import os
 # https://stackoverflow.com/questions/61289041/python-import-module-from-directory-error-reading-file
 _this_dir = os.path.dirname(__file__)
 
-# Read in corruption data files as publicly available DataFrames
-
-df_ocr = pd.read_csv(
-    os.path.join(_this_dir, 'ocr-variations-upper-lower.csv'),
-    skiprows=[0,1], header=None, names=['ocr_true', 'ocr_err']
-)
-df_phonetic = pd.read_csv(
-    os.path.join(_this_dir, 'phonetic-variations.csv'),
-    skiprows=[0,1], header=None,
-    names=['where', 'orig', 'new', 'pre', 'post', 'pattern', 'start']
-)
-df_qwerty = pd.read_csv(
-    os.path.join(_this_dir, 'qwerty-keyboard.csv'),
-    skiprows=[0,1], header=None
-)
+# Corruption data files
+#
+# The data files are read the first time they're needed instead of on import,
+# so that importing this module (e.g., in every Dask worker) stays cheap.
+# The DataFrames, error dicts, and substitution tables are still available
+# as module attributes (df_ocr, ocr_error_dict, ocr_table, etc.), which are
+# loaded on first access by __getattr__ below.
+# The error dicts and phonetic rules are also precompiled into
+# PRECOMPILED_TABLES_FILE, which is used instead of the .csv files as long as
+# they haven't changed since it was written by write_precompiled_tables().
+# It's installed with the package (see package_data in setup.py); if it's
+# missing or out of date, a warning is issued and the .csv files are used.
+
+_DATA_FILES = {
+    'df_ocr': ('ocr-variations-upper-lower.csv', dict(names=['ocr_true', 'ocr_err'])),
+    'df_phonetic': (
+        'phonetic-variations.csv',
+        dict(names=['where', 'orig', 'new', 'pre', 'post', 'pattern', 'start'])),
+    'df_qwerty': ('qwerty-keyboard.csv', {}),
+}
+PRECOMPILED_TABLES_FILE = os.path.join(_this_dir, 'corruption-tables.pkl')
+
+@functools.lru_cache(maxsize=None)
+def read_data_file(name):
+    """Read one of the corruption data files ('df_ocr', 'df_phonetic', or
+    'df_qwerty') into a DataFrame, reading each file only once.
+    """
+    filename, kwargs = _DATA_FILES[name]
+    return pd.read_csv(os.path.join(_this_dir, filename), skiprows=[0,1], header=None, **kwargs)
+
+def _data_files_digest():
+    digest = hashlib.sha256()
+    for filename, _ in _DATA_FILES.values():
+        with open(os.path.join(_this_dir, filename), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def _data_files_stats():
+    """Return the name, size, and modification time of each data file."""
+    stats = []
+    for filename, _ in _DATA_FILES.values():
+        stat = os.stat(os.path.join(_this_dir, filename))
+        stats.append((filename, stat.st_size, stat.st_mtime_ns))
+    return stats
+
+def build_lookup_tables():
+    """Build the error dicts and phonetic rules from the corruption data files.
+    Returns a dict of plain Python objects, which is what gets saved in
+    PRECOMPILED_TABLES_FILE.
+    """
+    phonetic_tokens, phonetic_rule_lists = rules_by_token(read_data_file('df_phonetic'))
+    return {
+        'data_files_digest': _data_files_digest(),
+        'data_files_stats': _data_files_stats(),
+        'ocr_error_dict': generate_ocr_error_dict(),
+        'phonetic_error_dict': generate_phonetic_error_dict(),
+        'qwerty_error_dict': generate_qwerty_error_dict(),
+        'phonetic_tokens': phonetic_tokens,
+        'phonetic_rule_lists': phonetic_rule_lists,
+    }
+
+def write_precompiled_tables(path=PRECOMPILED_TABLES_FILE):
+    """Save the lookup tables built from the corruption data files to `path`.
+    Rerun this after editing the .csv files; until then, they are used directly
+    (more slowly).
+    """
+    with open(path, 'wb') as f:
+        pickle.dump(build_lookup_tables(), f, protocol=4)
+
+@functools.lru_cache(maxsize=None)
+def load_lookup_tables():
+    """Return the lookup tables (see build_lookup_tables), from
+    PRECOMPILED_TABLES_FILE if it is up to date with the data files and
+    from the data files otherwise.
+    """
+    try:
+        with open(PRECOMPILED_TABLES_FILE, 'rb') as f:
+            tables = pickle.load(f)
+        if not isinstance(tables, dict):
+            raise TypeError(f'expected a dict, not {type(tables).__name__}')
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, TypeError) as error:
+        # Missing, damaged, or written by an incompatible version
+        warnings.warn(
+            f"Couldn't read the precompiled corruption tables ({error!r}),"
+            ' so they are being built from the .csv files')
+        return build_lookup_tables()
+    if not _precompiled_tables_are_current(tables):
+        warnings.warn(
+            f'{PRECOMPILED_TABLES_FILE} is out of date with the corruption .csv files,'
+            ' so the tables are being built from the .csv files;'
+            ' run corruption.write_precompiled_tables() to update it')
+        return build_lookup_tables()
+    return tables
+
+def _precompiled_tables_are_current(tables):
+    """Check whether the precompiled tables were built from the current data
+    files: if the files' sizes and modification times are the same as when
+    the tables were written, without reading them, and otherwise (e.g., in
+    a fresh checkout) by comparing the digest of their contents.
+    """
+    try:
+        if tables.get('data_files_stats') == _data_files_stats():
+            return True
+        return tables.get('data_files_digest') == _data_files_digest()
+    except FileNotFoundError:
+        # The .csv files aren't installed, so the tables are all there is
+        return True
+
+@functools.lru_cache(maxsize=None)
+def get_substitution_table(kind):
+    """Return the SubstitutionTable for 'ocr', 'phonetic', or 'qwerty'
+    corruption, compiling it on first use.
+    """
+    tables = load_lookup_tables()
+    rules = None
+    if kind == 'phonetic':
+        rules = PhoneticRules(tables['phonetic_tokens'], tables['phonetic_rule_lists'])
+    return SubstitutionTable(tables[f'{kind}_error_dict'], rules)
+
+def __getattr__(name):
+    """Load the DataFrames, error dicts, and substitution tables on first access."""
+    if name in _DATA_FILES:
+        return read_data_file(name)
+    if name in ('ocr_error_dict', 'phonetic_error_dict', 'qwerty_error_dict'):
+        return load_lookup_tables()[name]
+    if name in ('ocr_table', 'phonetic_table', 'qwerty_table'):
+        return get_substitution_table(name[:-len('_table')])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+# Vectorized token corruption
+#
+# The scalar functions below walk a string one position at a time, trying the
+# tokens that match at that position from longest to shortest, each with
+# probability corrupted_pr, and skipping past any token that gets replaced.
+# Both corrupt_string and corrupt_tokens find the token matches with a precompiled
+# Aho-Corasick automaton instead of slicing out every candidate token.
+# corrupt_tokens produces the same distribution for a whole Series at once:
+# all token matches are found up front, one uniform is drawn for every match,
+# and the only sequential work left is resolving overlaps between the (rare)
+# successful replacements.
+
+class SubstitutionTable:
+    """Tokens that can be corrupted, the possible replacements for each
+    token, and a precompiled matcher for finding the tokens in strings.
+    If `rules` is passed, it must have an allowed_replacements method like
+    phonetic_rules.PhoneticRules, which restricts the replacements that can
+    be used for a token depending on its context.
+    """
+    def __init__(self, error_dict, rules=None):
+        self.tokens = list(error_dict)
+        self.replacement_lists = [list(error_dict[token]) for token in self.tokens]
+        self.rules = rules
+        self.matcher = AhoCorasickMatcher(self.tokens)
+        self.token_lengths = self.matcher.token_lengths
+        self.num_replacements = np.array(
+            [len(error_dict[token]) for token in self.tokens], dtype=np.int64)
+        # Replacements for token i are replacements[offsets[i]:offsets[i]+num_replacements[i]]
+        self.offsets = np.concatenate([[0], np.cumsum(self.num_replacements)[:-1]]).astype(np.int64)
+        self.replacements = np.array(
+            [replacement for token in self.tokens for replacement in error_dict[token]],
+            dtype=object)
+        self.max_replacements = self.num_replacements.max(initial=0)
+
+    def allowed_replacements(self, strings, rows, starts, token_ids):
+        """Return a bitmask for each token match with bit j set if the j'th
+        replacement for the token is allowed at that match.
+        """
+        if self.rules is None:
+            return np.left_shift(1, self.num_replacements[token_ids]) - 1
+        return self.rules.allowed_replacements(strings, rows, starts, token_ids)
+
+    def choose_replacements(self, token_ids, allowed, u):
+        """Choose one of the allowed replacements for each token match,
+        using a uniform random number u for each match.
+        """
+        slots = np.arange(self.max_replacements)
+        is_allowed = (allowed[:, None] >> slots) & 1
+        num_allowed = is_allowed.sum(axis=1)
+        # Index of the chosen replacement among the allowed ones, then its slot
+        k = (u * num_allowed).astype(np.int64)
+        chosen_slot = np.argmax(is_allowed.cumsum(axis=1) > k[:, None], axis=1)
+        return self.replacements[self.offsets[token_ids] + chosen_slot]
+
+def corrupt_string(truth, table, corrupted_pr, addl_pr=None, random_state=None):
+    """Corrupt the tokens of a single string, using the tokens and
+    replacements in the SubstitutionTable `table`.
+
+    At each position, the tokens starting there are tried from longest to
+    shortest, and each is replaced with probability corrupted_pr by a
+    replacement chosen uniformly at random from those allowed in that context.
+    After a replacement, the original token is re-inserted with probability
+    addl_pr, and the rest of the token is skipped. If addl_pr is None, the
+    token is never re-inserted, and no random number is drawn for it (so
+    the draws match those of the original scalar corruptors: OCR and
+    phonetic corruption never drew one, and keyboard corruption always did).
+    """
+    rng = random_streams.as_generator(random_state)
+    matches = table.matcher.matches_by_start(truth)
+    if table.rules is not None:
+        lowered = truth.translate(ASCII_LOWERCASE)
+        candidates = {}
+        for start, token_ids in matches.items():
+            for token_id in token_ids:
+                allowed = table.rules.allowed_slots(lowered, start, token_id)
+                replacements = [
+                    replacement for replacement, ok
+                    in zip(table.replacement_lists[token_id], allowed) if ok
+                ]
+                if replacements:
+                    candidates.setdefault(start, []).append((token_id, replacements))
+    else:
+        candidates = {
+            start: [(token_id, table.replacement_lists[token_id]) for token_id in token_ids]
+            for start, token_ids in matches.items()
+        }
+    err = ''
+    i = 0
+    while i < len(truth):
+        error_introduced = False
+        for token_id, replacements in candidates.get(i, ()):
+            if rng.uniform() < corrupted_pr:
+                token = table.tokens[token_id]
+                err += rng.choice(replacements)
+                if addl_pr is not None and rng.uniform() < addl_pr:
+                    err += token
+                i += len(token)
+                error_introduced = True
+                break
+        if not error_introduced:
+            err += truth[i:(i+1)]
+            i += 1
+    return err
+
+def corrupt_tokens(
+    strings, table, corrupted_pr, addl_pr=0, random_state=None, chunk_size=2**16,
+    deduplicate=False, stats=None,
+):
+    """Corrupt the tokens of every string in a pandas Series, using the tokens
+    and replacements in the SubstitutionTable `table`.
+
+    Each token is replaced with probability corrupted_pr by a replacement chosen
+    uniformly at random from those allowed in that context, and with probability
+    addl_pr the original token is re-inserted after its replacement.
+    Missing values are left as is. The strings are processed `chunk_size`
+    at a time to bound memory use.
+
+    If deduplicate is True, the strings are grouped by value first, and the
+    tokens of each distinct value are found (and their context rules
+    evaluated) only once, though every string still gets its own random
+    draws. This is much faster for columns with many repeated values, like
+    names. Categorical Series are always processed this way, by category.
+    If stats is a dict, it is then updated with the number of non-missing
+    strings, the number of distinct values among them, and the ratio of the
+    two (dedup_ratio).
+    """
+    rng = random_streams.as_generator(random_state)
+    is_categorical = categorical.is_categorical(strings)
+    if not (deduplicate or is_categorical):
+        # (Some pandas versions ignore copy=True when na_value is passed and nothing is missing)
+        values = strings.to_numpy(dtype=object, na_value=None).copy()
+        present = np.flatnonzero(strings.notna().to_numpy())
+        for i in range(0, len(present), chunk_size):
+            chunk = present[i:i+chunk_size]
+            # Every chunk starts from the same draw of a record-bound generator
+            _corrupt_chunk(values, chunk, table, corrupted_pr, addl_pr, random_streams.restrict(rng, chunk))
+        corrupted_strings = pd.Series(values, index=strings.index, name=strings.name)
+        return corrupted_strings.astype(strings.dtype)
+
+    if is_categorical:
+        codes, uniques = strings.cat.codes, strings.cat.categories
+    else:
+        codes, uniques = pd.factorize(strings)
+    # Only look at the values that appear in strings
+    used, codes = categorical.used_categories(codes, len(uniques))
+    uniques = np.asarray(uniques[used], dtype=object)
+    values, changed = _corrupt_distinct_tokens(
+        codes, uniques, table, corrupted_pr, addl_pr, rng, chunk_size)
+    if stats is not None:
+        num_strings = int((codes >= 0).sum())
+        stats.update(
+            num_strings=num_strings, num_distinct=len(uniques),
+            dedup_ratio=num_strings / len(uniques) if len(uniques) else 1.0)
+    if is_categorical:
+        return categorical.assign(strings, changed, values[changed])
+    corrupted_strings = pd.Series(values, index=strings.index, name=strings.name)
+    return corrupted_strings.astype(strings.dtype)
+
+def _corrupt_distinct_tokens(codes, uniques, table, corrupted_pr, addl_pr, rng, chunk_size):
+    """corrupt_tokens for strings given as codes (-1 for missing) into an
+    array of distinct values. The tokens of each distinct value are found
+    once and the matches are shared by all rows with that value, though every
+    row still gets its own random draws. Returns an object array of the
+    corrupted strings (with None for missing values) and the positions of
+    the strings that were changed.
+    """
+    # Rows, starts, token ids, and allowed replacements of the matches in each distinct value,
+    # sorted by value so that the matches of value k are unique_matches[:, bounds[k]:bounds[k+1]]
+    unique_matches = np.stack(_find_candidate_matches(table, uniques))
+    unique_matches = unique_matches[:, np.argsort(unique_matches[0], kind='stable')]
+    bounds = np.searchsorted(unique_matches[0], np.arange(len(uniques) + 1))
+    present = np.flatnonzero(codes >= 0)
+    # Only references to the distinct strings, not new strings
+    values = np.full(len(codes), None, dtype=object)
+    values[present] = uniques[codes[present]]
+    changed = []
+    for i in range(0, len(present), chunk_size):
+        chunk = present[i:i+chunk_size]
+        chunk_codes = codes[chunk]
+        # Repeat the matches of each row's value for the row
+        num_matches = bounds[chunk_codes + 1] - bounds[chunk_codes]
+        rows = np.repeat(np.arange(len(chunk)), num_matches)
+        first_match = np.repeat(bounds[chunk_codes] - np.cumsum(num_matches) + num_matches, num_matches)
+        matches = unique_matches[:, first_match + np.arange(len(rows))]
+        matches[0] = rows
+        # Every chunk starts from the same draw of a record-bound generator
+        changed.append(_corrupt_chunk(
+            values, chunk, table, corrupted_pr, addl_pr, random_streams.restrict(rng, chunk),
+            matches=tuple(matches)))
+    changed = np.concatenate(changed) if changed else np.array([], dtype=np.int64)
+    return values, changed
+
+def _find_candidate_matches(table, strings):
+    """Find the token matches in strings that have at least one allowed
+    replacement. Returns four int64 arrays: the rows, starts, and token ids
+    of the matches (as in AhoCorasickMatcher.find_matches), and their
+    allowed replacements (see SubstitutionTable.allowed_replacements).
+    """
+    rows, starts, token_ids = table.matcher.find_matches(strings)
+    allowed = table.allowed_replacements(strings, rows, starts, token_ids)
+    # Tokens with no allowed replacement in their context can't be corrupted
+    if table.rules is not None:
+        candidate = allowed != 0
+        rows, starts, token_ids, allowed = (
+            rows[candidate], starts[candidate], token_ids[candidate], allowed[candidate])
+    return rows, starts, token_ids, allowed
+
+def _corrupt_chunk(values, chunk, table, corrupted_pr, addl_pr, rng, matches=None):
+    """Corrupt values[chunk] in place for corrupt_tokens, and return the
+    positions in values that were changed. If `matches` is passed, it is
+    used instead of finding the candidate matches in values[chunk] (see
+    _find_candidate_matches).
+    """
+    if matches is None:
+        matches = _find_candidate_matches(table, values[chunk])
+    rows, starts, token_ids, allowed = matches
+    lengths = table.token_lengths[token_ids]
+    # Decide which matches are corrupted, then keep only the longest corrupted
+    # token at each position, as the scalar functions do
+    # Match draws are keyed by position and token within the string
+    match_keys = starts * len(table.tokens) + token_ids
+    corrupted = random_streams.random_at(rng, rows, match_keys) < corrupted_pr
+    order = np.flatnonzero(corrupted)
+    order = order[np.lexsort((-lengths[order], starts[order], rows[order]))]
+    rows, starts, token_ids, lengths, allowed = (
+        rows[order], starts[order], token_ids[order], lengths[order], allowed[order])
+    longest = np.ones(len(rows), dtype=bool)
+    longest[1:] = (rows[1:] != rows[:-1]) | (starts[1:] != starts[:-1])
+    # A token that starts inside an earlier replaced token is never reached
+    ends = starts + lengths
+    keep = np.zeros(len(rows), dtype=bool)
+    last_row, last_end = -1, 0
+    candidates = np.flatnonzero(longest)
+    for i, row, start, end in zip(
+            candidates.tolist(), rows[candidates].tolist(),
+            starts[candidates].tolist(), ends[candidates].tolist()):
+        if row != last_row or start >= last_end:
+            keep[i] = True
+            last_row, last_end = row, end
+    rows, starts, ends, token_ids, allowed = (
+        rows[keep], starts[keep], ends[keep], token_ids[keep], allowed[keep])
+
+    insertions = table.choose_replacements(
+        token_ids, allowed, random_streams.random_at(rng, rows, starts))
+    if addl_pr > 0:
+        add_original = random_streams.random_at(rng, rows, starts) < addl_pr
+        originals = np.array([table.tokens[i] for i in token_ids], dtype=object)
+        insertions = np.where(add_original, insertions + originals, insertions)
+
+    _splice(values, chunk[rows], starts, ends, insertions)
+    return np.unique(chunk[rows])
+
+def _splice(values, positions, starts, ends, insertions):
+    """Replace values[positions[i]][starts[i]:ends[i]] with insertions[i] for
+    every i, in place. The replacements for each value must be consecutive and
+    sorted by start, and must not overlap.
+    """
+    current_position, truth, pieces, last_end = None, None, [], 0
+    for position, start, end, insertion in zip(
+            positions.tolist(), starts.tolist(), ends.tolist(), insertions.tolist()):
+        if position != current_position:
+            if current_position is not None:
+                pieces.append(truth[last_end:])
+                values[current_position] = ''.join(pieces)
+            current_position, truth, pieces, last_end = position, values[position], [], 0
+        pieces.append(truth[last_end:start])
+        pieces.append(insertion)
+        last_end = end
+    if current_position is not None:
+        pieces.append(truth[last_end:])
+        values[current_position] = ''.join(pieces)
 
 # OCR corruption
 
-def generate_ocr_error_dict(df_ocr=df_ocr):
+def generate_ocr_error_dict(df_ocr=None):
+    if df_ocr is None:
+        df_ocr = read_data_file('df_ocr')
     ocr_error_dict = {}
     for k, df_k in df_ocr.groupby('ocr_true'):
         ocr_error_dict[k] = list(df_k.ocr_err)
     return ocr_error_dict
 
-ocr_error_dict = generate_ocr_error_dict()
-    
-def ocr_corrupt(truth, corrupted_pr, random_state=None):
+def ocr_corrupt(truth, corrupted_pr, random_state=None, deduplicate=False, stats=None):
     """
+    If truth is a pandas Series, all strings are corrupted at once by corrupt_tokens
+    (see there for deduplicate and stats).
+
     # Algorithm sketch
 
     For each token decide if it is OCRed correctly, and if it is not, decide how it goes wrong.
@@ -52,94 +449,62 @@ def ocr_corrupt(truth, corrupted_pr, random_state=None):
     Since there are tokens of length 1, 2, and 3, how to handle?
     I guess I can start with threes, then twos, then ones, for each location in a string.
     """
-    rng = np.random.default_rng(random_state)
-    err = ''
-    i = 0
-    while i < len(truth):
-        error_introduced = False
-        for token_length in [3,2,1]:
-            token = truth[i:(i+token_length)]
-            if token in ocr_error_dict and not error_introduced:
-                if rng.uniform() < corrupted_pr:
-                    err += rng.choice(ocr_error_dict[token])
-                    i += token_length
-                    error_introduced = True
-        if not error_introduced:
-            err += truth[i:(i+1)]
-            i += 1
-    return err
+    table = get_substitution_table('ocr')
+    if isinstance(truth, pd.Series):
+        return corrupt_tokens(
+            truth, table, corrupted_pr, random_state=random_state, deduplicate=deduplicate, stats=stats)
+    return corrupt_string(truth, table, corrupted_pr, random_state=random_state)
 
 # Hardest one: phonetic corruption
 #
 # This includes an undocumented microlanguage, with commands like `n;-1;t`
 # to mean no using this rule if the character before it is a t.
+# The where, pre, post, pattern, and start conditions are compiled by
+# phonetic_rules.PhoneticRules, which documents how they are interpreted.
 
-def generate_phonetic_error_dict(df_phonetic=df_phonetic):
+def generate_phonetic_error_dict(df_phonetic=None):
+    if df_phonetic is None:
+        df_phonetic = read_data_file('df_phonetic')
     phonetic_error_dict = {}
     for k, df_k in df_phonetic.groupby('orig'):
         phonetic_error_dict[k] = list(df_k.new.str.replace('@', ''))
     return phonetic_error_dict
 
-phonetic_error_dict = generate_phonetic_error_dict()
-
-def phonetic_corrupt(truth, corrupted_pr, random_state=None):
-    rng = np.random.default_rng(random_state)
-    err = ''
-    i = 0
-    while i < len(truth):
-        error_introduced = False
-        for token_length in [7,6,5,4,3,2,1]:
-            token = truth[i:(i+token_length)]
-            if token in phonetic_error_dict and not error_introduced:
-                if rng.uniform() < corrupted_pr:
-                    err += rng.choice(phonetic_error_dict[token]) # TODO: only consider possibilities allowed by where, pre, post, pattern, and start values
-                    i += token_length
-                    error_introduced = True
-        if not error_introduced:
-            err += truth[i:(i+1)]
-            i += 1
-    return err
+def phonetic_corrupt(truth, corrupted_pr, random_state=None, deduplicate=False, stats=None):
+    table = get_substitution_table('phonetic')
+    if isinstance(truth, pd.Series):
+        return corrupt_tokens(
+            truth, table, corrupted_pr, random_state=random_state, deduplicate=deduplicate, stats=stats)
+    return corrupt_string(truth, table, corrupted_pr, random_state=random_state)
 
 # Keyboard corruption
 
-def generate_qwerty_error_dict(df_qwerty=df_qwerty):
+def generate_qwerty_error_dict(df_qwerty=None):
+    """Map each key in the keyboard grid df_qwerty to the list of its
+    neighboring keys (including diagonal neighbors).
+    """
+    if df_qwerty is None:
+        df_qwerty = read_data_file('df_qwerty')
+    keys = df_qwerty.to_numpy(dtype=object)
+    is_key = (keys.astype(str) != 'nan') & (keys != '#')
+    num_rows, num_cols = keys.shape
     qwerty_error_dict = {}
-    for i in df_qwerty.index:
-        for j in df_qwerty.columns:
-            val = df_qwerty.loc[i,j]
-            if str(val) != 'nan' and val != '#':
-                nbrs = []
-                for di in [-1,0,1]:
-                    for dj in [-1,0,1]:
-                        if di != 0 or dj != 0: # only actual nbrs, not val itself
-                            if i+di in df_qwerty.index and j+dj in df_qwerty.columns:
-                                nbr_val = df_qwerty.loc[i+di, j+dj]
-                                if str(nbr_val) != 'nan' and nbr_val != '#':
-                                    nbrs.append(nbr_val)
-                qwerty_error_dict[val] = nbrs
+    for i, j in zip(*np.nonzero(is_key)):
+        nbrs = []
+        for di in [-1,0,1]:
+            for dj in [-1,0,1]:
+                if di != 0 or dj != 0: # only actual nbrs, not val itself
+                    if 0 <= i+di < num_rows and 0 <= j+dj < num_cols and is_key[i+di, j+dj]:
+                        nbrs.append(keys[i+di, j+dj])
+        qwerty_error_dict[keys[i, j]] = nbrs
     return qwerty_error_dict
 
-qwerty_error_dict = generate_qwerty_error_dict()
-
-def keyboard_corrupt(truth, corrupted_pr, addl_pr, random_state=None):
-    rng = np.random.default_rng(random_state)
-    err = ''
-    i = 0
-    while i < len(truth):
-        error_introduced = False
-        for token_length in [1]:
-            token = truth[i:(i+token_length)]
-            if token in qwerty_error_dict and not error_introduced:
-                if rng.uniform() < corrupted_pr:
-                    err += rng.choice(qwerty_error_dict[token])
-                    if rng.uniform() < addl_pr:
-                        err += token
-                    i += token_length
-                    error_introduced = True
-        if not error_introduced:
-            err += truth[i:(i+1)]
-            i += 1
-    return err
+def keyboard_corrupt(truth, corrupted_pr, addl_pr, random_state=None, deduplicate=False, stats=None):
+    table = get_substitution_table('qwerty')
+    if isinstance(truth, pd.Series):
+        return corrupt_tokens(
+            truth, table, corrupted_pr, addl_pr, random_state, deduplicate=deduplicate, stats=stats)
+    return corrupt_string(truth, table, corrupted_pr, addl_pr, random_state)
 
 def swap_month_day(date, date_format="yyyy-mm-dd"):
     """Swaps month and day in a date or pandas Series of dates.
@@ -147,13 +512,23 @@ def swap_month_day(date, date_format="yyyy-mm-dd"):
     The format of the date(s) must be specified; default is "yyyy-mm-dd",
     and currently no other formats are supported except replacing '-' with
     a different separator like '/'.
+
+    A Series of 10-character ASCII dates (including large_string[pyarrow]
+    columns) is swapped in a fixed-width byte buffer without creating any
+    Python string objects; other Series fall back to string slicing.
     """
-    if isinstance(date, pd.Series):
-        date = date.str
     date_format = date_format.lower()
     y_idx = date_format.find("yyyy")
     m_idx = date_format.find("mm")
     d_idx = date_format.find("dd")
+    if isinstance(date, pd.Series) and y_idx==0 and m_idx==5 and d_idx==8:
+        chars = _to_fixed_width_bytes(date, 10)
+        if chars is not None:
+            swapped = chars.copy()
+            swapped[:, 5:7], swapped[:, 8:10] = chars[:, 8:10], chars[:, 5:7]
+            return _from_fixed_width_bytes(swapped, date)
+    if isinstance(date, pd.Series):
+        date = date.str
     if y_idx == -1:
          # in case year format is yy not yyyy
          # NOTE: yy format is not yet implemented below and will raise a ValueError
@@ -181,18 +556,30 @@ def miswrite_zipcode(
     Zipcodes must be stored as strings.
     The probabilities of changing the first 2 digits, middle digit, and last 2 digits
     are separately specified.
+
+    A Series of 5-character ASCII zipcodes (including large_string[pyarrow]
+    columns) is changed in a fixed-width byte buffer without creating any
+    Python string objects; other Series fall back to string slicing.
     """
-    rng = np.random.default_rng(random_state)
+    rng = random_streams.as_generator(random_state)
     is_series = isinstance(zipcode, pd.Series)
     if is_series:
-        zipcode_series = zipcode
-        zipcode = zipcode.str
-        shape = (len(zipcode_series),5)
+        shape = (len(zipcode),5)
     else: # type should be str
         shape = (1,5)
     threshold = np.array([2*[first2_prob] + [middle_prob] + 2*[last2_prob]])
     replace = rng.random(shape) < threshold
-    random_digits = rng.choice(list('0123456789'), shape)
+    # Same draws as rng.choice(list('0123456789'), shape)
+    random_digits = rng.integers(0, 10, shape)
+    chars = _to_fixed_width_bytes(zipcode, 5) if is_series else None
+    if chars is not None:
+        new_chars = np.where(replace, random_digits + ord('0'), chars).astype(np.uint8)
+        return _from_fixed_width_bytes(new_chars, zipcode)
+
+    random_digits = random_digits.astype(str)
+    if is_series:
+        zipcode_series = zipcode
+        zipcode = zipcode.str
     digits = []
     for i in range(5):
         digit = np.where(replace[:,i], random_digits[:,i], zipcode[i])
@@ -204,6 +591,82 @@ def miswrite_zipcode(
     new_zipcode = digits[0] + digits[1] + digits[2] + digits[3] + digits[4]
     return new_zipcode
 
+def _to_fixed_width_bytes(strings, width):
+    """Return the characters of a Series of ASCII strings that all have length
+    `width` as a (len(strings), width) array of uint8, or None if some value
+    is missing, has a different length, or isn't ASCII.
+    Arrow-backed string Series are viewed without copying the character data,
+    and categorical Series are converted one category at a time.
+    """
+    if categorical.is_categorical(strings):
+        used, codes = categorical.used_categories(strings.cat.codes, len(strings.cat.categories))
+        category_chars = _to_fixed_width_bytes(pd.Series(strings.cat.categories[used]), width)
+        if category_chars is None or np.any(codes < 0):
+            return None
+        return category_chars[codes]
+    if _is_arrow_string_dtype(strings.dtype):
+        import pyarrow as pa
+        array = pa.array(strings.array)
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        array = array.cast(pa.large_string())
+        if array.null_count:
+            return None
+        _, offsets_buffer, data_buffer = array.buffers()
+        offsets = np.frombuffer(offsets_buffer, dtype=np.int64)[array.offset:array.offset+len(array)+1]
+        if not np.all(np.diff(offsets) == width):
+            return None
+        chars = np.frombuffer(data_buffer, dtype=np.uint8)[offsets[0]:offsets[-1]]
+    else:
+        if strings.hasnans:
+            return None
+        try:
+            codes = np.asarray(strings.to_numpy(dtype=object), dtype=str)
+        except (TypeError, ValueError):
+            return None
+        # Every string has length width if the longest does and none is shorter
+        if len(codes) and codes.dtype.itemsize != 4 * width:
+            return None
+        chars = codes.view(np.uint32).reshape(len(codes), width)
+        if np.any(chars[:, -1] == 0):
+            return None
+    if np.any(chars >= 128):
+        return None
+    return chars.astype(np.uint8, copy=False).reshape(len(strings), width)
+
+def _from_fixed_width_bytes(chars, like):
+    """Convert a (n, width) array of ASCII uint8 to a Series with the index,
+    name, and string dtype of the Series `like` (for a categorical Series,
+    with any new strings added to its categories).
+    """
+    num_strings, width = chars.shape
+    if categorical.is_categorical(like):
+        # Make one string for each distinct value
+        unique_chars, inverse = np.unique(
+            np.ascontiguousarray(chars).view(f'S{width}').ravel(), return_inverse=True)
+        codes, new_categories = categorical.encode(
+            unique_chars.astype(f'U{width}').astype(object), like.cat.categories)
+        return categorical.from_codes(
+            codes[inverse.ravel()], categorical.extend(like.dtype, new_categories),
+            like.index, like.name)
+    if _is_arrow_string_dtype(like.dtype):
+        import pyarrow as pa
+        offsets = np.arange(0, (num_strings + 1) * width, width, dtype=np.int64)
+        array = pa.Array.from_buffers(
+            pa.large_string(), num_strings,
+            [None, pa.py_buffer(offsets), pa.py_buffer(np.ascontiguousarray(chars))])
+        values = pd.arrays.ArrowExtensionArray(array)
+        return pd.Series(values, index=like.index, name=like.name).astype(like.dtype)
+    strings = np.ascontiguousarray(chars).view(f'S{width}').ravel().astype(f'U{width}')
+    return pd.Series(strings, index=like.index, name=like.name, dtype=like.dtype)
+
+def _is_arrow_string_dtype(dtype):
+    """Check whether dtype is a string dtype stored in pyarrow (e.g. large_string[pyarrow])."""
+    if isinstance(dtype, pd.ArrowDtype):
+        import pyarrow as pa
+        return pa.types.is_string(dtype.pyarrow_dtype) or pa.types.is_large_string(dtype.pyarrow_dtype)
+    return isinstance(dtype, pd.StringDtype) and dtype.storage == 'pyarrow'
+
 def random_choice(
     current_choice,
     choices,
@@ -212,6 +675,8 @@ def random_choice(
     p=None,
     shuffle=True,
     random_state=None,
+    max_resampling_rounds=None,
+    resampling_stats=None,
 ):
     """Replaces current choice with a value randomly selected from choices.
 
@@ -224,10 +689,20 @@ def random_choice(
     'explicit_exclusion' (default) or 'resampling'.
     The values of replace, p, and suffle are passed to
     numpy.random.Generator.choice.
+    max_resampling_rounds and resampling_stats are passed to
+    random_different_choice_via_resampling as max_rounds and stats.
+
+    A categorical Series is noised in terms of its integer codes and
+    returned as a categorical Series, with any choices that weren't
+    categories added to its categories.
     """
+    if categorical.is_categorical(current_choice):
+        return _random_categorical_choice(
+            current_choice, choices, exclusion_algorithm, replace, p, shuffle, random_state,
+            max_resampling_rounds, resampling_stats)
     if not exclusion_algorithm:
         # Allow current choice to stay the same if it is selected from choices
-        rng = np.random.default_rng(random_state)
+        rng = random_streams.as_generator(random_state)
         is_series = isinstance(current_choice, pd.Series)
         if is_series:
             new_choice = pd.Series(
@@ -241,11 +716,27 @@ def random_choice(
             current_choice, choices, replace, p, shuffle, random_state)
     elif exclusion_algorithm == 'resampling':
         new_choice = random_different_choice_via_resampling(
-            current_choice, choices, replace, p, shuffle, random_state)
+            current_choice, choices, replace, p, shuffle, random_state,
+            max_resampling_rounds, resampling_stats)
     else:
         raise ValueError(f'Unrecognized exclusion algorithm: {exclusion_algorithm}')
     return new_choice
 
+def _random_categorical_choice(current_choice, choices, *args):
+    """random_choice for a categorical Series: the choices are converted to
+    their codes among the categories (adding any new ones), and codes are
+    chosen in place of values, which gives the same distribution since equal
+    values have equal codes.
+    """
+    categories = current_choice.cat.categories
+    choice_codes, new_categories = categorical.encode(choices, categories)
+    current_codes = pd.Series(
+        current_choice.cat.codes.to_numpy(dtype=np.int64), index=current_choice.index)
+    new_codes = random_choice(current_codes, choice_codes, *args)
+    return categorical.from_codes(
+        new_codes.to_numpy(dtype=np.int64), categorical.extend(current_choice.dtype, new_categories),
+        current_choice.index, current_choice.name)
+
 def random_different_choice_via_explicit_exclusion(
     current_choice,
     choices,
@@ -254,26 +745,43 @@ def random_different_choice_via_explicit_exclusion(
     shuffle=True,
     random_state=None,
 ):
-    rng = np.random.default_rng(random_state)
+    """Choose a value from choices (with probabilities p) that differs from
+    current_choice, by drawing from the distribution conditional on not
+    choosing the current value.
+
+    For a Series, each row is drawn with a single uniform random number in
+    one vectorized step, so the cost is O(rows) no matter how many choices
+    there are: the current values are mapped to codes, and a draw from the
+    probability mass outside the current value is shifted past the current
+    value's interval of the CDF. Sampling without replacement (replace=False)
+    falls back to drawing for one current value at a time.
+    """
+    rng = random_streams.as_generator(random_state)
     is_series = isinstance(current_choice, pd.Series)
     choices = np.asarray(choices)
     if p is None:
         p = np.full(len(choices), 1/len(choices))
-    if is_series:
+    if is_series and replace:
+        new_choice = pd.Series(
+            _draw_excluding_current(current_choice, choices, np.asarray(p, dtype=float), rng),
+            index=current_choice.index, name=current_choice.name)
+        if not isinstance(current_choice.dtype, pd.CategoricalDtype):
+            new_choice = new_choice.astype(current_choice.dtype)
+    elif is_series:
         new_choice = pd.Series(
             np.empty(len(current_choice), dtype=current_choice.dtype),
             index=current_choice.index, name=current_choice.name)
         current_not_in_choices = ~current_choice.isin(choices)
         num_rows = current_not_in_choices.sum()
-        new_choice[current_not_in_choices] = rng.choice(
-                choices, num_rows, replace, p, shuffle=shuffle)
+        new_choice[current_not_in_choices] = random_streams.restrict(
+            rng, current_not_in_choices.to_numpy()).choice(choices, num_rows, replace, p, shuffle=shuffle)
         for c in choices:
             p_cond = np.where(choices != c, p, 0)
             p_cond /= p_cond.sum()
             current_equals_c = (current_choice == c)
             num_rows = current_equals_c.sum()
-            new_choice[current_equals_c] = rng.choice(
-                choices, num_rows, replace, p_cond, shuffle=shuffle)
+            new_choice[current_equals_c] = random_streams.restrict(
+                rng, current_equals_c.to_numpy()).choice(choices, num_rows, replace, p_cond, shuffle=shuffle)
     else: # Scalar version
         p_cond = np.where(choices != current_choice, p, 0)
         p_cond /= p_cond.sum()
@@ -281,6 +789,48 @@ def random_different_choice_via_explicit_exclusion(
 
     return new_choice
 
+def _draw_excluding_current(current_choice, choices, p, rng):
+    """Vectorized draw for random_different_choice_via_explicit_exclusion.
+    Returns an array with one choice for each element of current_choice.
+    """
+    # Put equal choices next to each other so each distinct value owns one
+    # contiguous interval of the CDF
+    values, value_ids = np.unique(choices, return_inverse=True)
+    order = np.argsort(value_ids, kind='stable')
+    choices, p, value_ids = choices[order], p[order], value_ids[order]
+    cdf = np.cumsum(p)
+    total = cdf[-1]
+    value_mass = np.bincount(value_ids, weights=p, minlength=len(values))
+    value_start = np.cumsum(value_mass) - value_mass
+
+    # Code of the current value among the distinct choices, or -1 if it isn't one
+    codes = pd.Index(values).get_indexer(current_choice)
+    is_choice = codes >= 0
+    excluded_mass = np.where(is_choice, value_mass[codes], 0)
+    if np.any(excluded_mass >= total):
+        raise ValueError('No choices other than the current value have positive probability')
+    excluded_start = np.where(is_choice, value_start[codes], np.inf)
+
+    # Draw from the mass outside the current value's interval, then skip over the interval
+    target = rng.random(len(codes)) * (total - excluded_mass)
+    past_current = target >= excluded_start
+    target += np.where(past_current, excluded_mass, 0)
+    index = np.searchsorted(cdf, target, side='right').clip(max=len(choices) - 1)
+
+    # Rounding can leave a target at the very edge of the excluded interval;
+    # move those to the nearest choice with positive probability on the correct side
+    hit_current = is_choice & (value_ids[index] == codes)
+    if hit_current.any():
+        positive = np.flatnonzero(p > 0)
+        for i in np.flatnonzero(hit_current):
+            allowed = positive[value_ids[positive] != codes[i]] # Not empty, checked above
+            before, after = allowed[allowed < index[i]], allowed[allowed > index[i]]
+            if past_current[i]:
+                index[i] = after[0] if len(after) else before[-1]
+            else:
+                index[i] = before[-1] if len(before) else after[0]
+    return choices[index]
+
 def random_different_choice_via_resampling(
     current_choice,
     choices,
@@ -288,31 +838,67 @@ def random_different_choice_via_resampling(
     p=None,
     shuffle=True,
     random_state=None,
+    max_rounds=None,
+    stats=None,
 ):
-    rng = np.random.default_rng(random_state)
+    """Choose a value from choices (with probabilities p) that differs from
+    current_choice, by redrawing values that are the same as the current
+    value until they all differ.
+
+    This can take many rounds when the current value has most of the
+    probability mass. If max_rounds is not None, at most max_rounds rounds
+    are drawn, and the values that still equal the current value are then
+    drawn by explicit exclusion, which gives the same distribution.
+    If stats is a dict, it is updated with the number of rounds drawn, the
+    number of rows redrawn after the first round, and the number of rows
+    that fell back to explicit exclusion.
+    """
+    rng = random_streams.as_generator(random_state)
     is_series = isinstance(current_choice, pd.Series)
     if is_series:
         shape = len(current_choice)
-        new_choice = pd.Series(
-            np.empty(shape, dtype=current_choice.dtype),
-            index=current_choice.index, name=current_choice.name)
+        # Every row is overwritten in the first round; copying keeps any extension dtype
+        # (e.g., 'large_string[pyarrow]'), which np.empty can't allocate
+        new_choice = current_choice.copy()
         # No values have changed until the loop executes the first time
         unchanged = pd.Series(True, index=new_choice.index)
     else:
         # Set shape=None not shape=1 so that rng.choice returns a scalar not an array
         shape = None
+    num_rounds, rows_resampled, rows_excluded = 0, 0, 0
     # Resample until all values differ from current
     done = False
     while not done:
+        if max_rounds is not None and num_rounds >= max_rounds:
+            # Draw the stragglers exactly instead
+            choices = np.asarray(choices)
+            p_array = np.full(len(choices), 1/len(choices)) if p is None else np.asarray(p, dtype=float)
+            if is_series:
+                rows_excluded = shape
+                new_choice[unchanged] = _draw_excluding_current(
+                    current_choice[unchanged], choices, p_array, rng)
+            else:
+                rows_excluded = 1
+                p_cond = np.where(choices != current_choice, p_array, 0)
+                new_choice = rng.choice(choices, None, replace, p_cond / p_cond.sum(), shuffle=shuffle)
+            break
         random_choice = rng.choice(choices, shape, replace, p, shuffle=shuffle)
+        if num_rounds > 0:
+            rows_resampled += 1 if shape is None else shape
+        num_rounds += 1
         if is_series:
             new_choice[unchanged] = random_choice
-            unchanged = (new_choice == current_choice)
+            still_unchanged = (new_choice == current_choice)
+            # Redraw only for the rows that are still unchanged
+            rng = random_streams.restrict(rng, still_unchanged[unchanged].to_numpy())
+            unchanged = still_unchanged
             shape = unchanged.sum()
             done = (shape == 0)
         else: # Scalar version
             new_choice = random_choice
             done = (new_choice != current_choice)
+    if stats is not None:
+        stats.update(rounds=num_rounds, rows_resampled=int(rows_resampled), rows_excluded=int(rows_excluded))
     return new_choice
 
 def add_random_increment(current_value, increment_choices, replace=True, p=None, shuffle=True, random_state=None):
@@ -337,7 +923,12 @@ def miswrite_age(age, increment_choices, p=None, random_state=None):
     Resetting a negative age to 0 in the exceptional case when the original age = 1
     guarantees that all ages receive noise for other increment choices as well,
     e.g., [-2,-1,1,2].
+
+    A categorical Series of ages is noised in terms of its integer codes,
+    computing the new age for each category and increment only once.
     """
+    if categorical.is_categorical(age):
+        return _miswrite_categorical_age(age, increment_choices, p, random_state)
     new_age = add_random_increment(age, increment_choices, p=p, random_state=random_state)
     # Replace any negative ages with 1
     if isinstance(new_age, pd.Series):
@@ -347,9 +938,38 @@ def miswrite_age(age, increment_choices, p=None, random_state=None):
         new_age = 1 if age != 1 else 0
     return new_age
 
+def _miswrite_categorical_age(age, increment_choices, p, random_state):
+    """miswrite_age for a categorical Series: each row gets the code of the
+    new age for its category and the increment drawn for it.
+    """
+    rng = random_streams.as_generator(random_state)
+    increments = np.asarray(increment_choices)
+    # Same draws as add_random_increment
+    increment_ids = rng.choice(len(increments), len(age), True, p)
+    used, codes = categorical.used_categories(age.cat.codes, len(age.cat.categories))
+    old_ages = np.repeat(age.cat.categories[used].to_numpy(), len(increments))
+    new_ages = old_ages + np.tile(increments, len(used))
+    # Replace any negative ages as in miswrite_age
+    new_ages = np.where(new_ages < 0, 1, new_ages)
+    new_ages = np.where((new_ages == 1) & (old_ages == 1), 0, new_ages)
+    new_age_codes, new_categories = categorical.encode(new_ages, age.cat.categories)
+    new_codes = np.where(
+        codes >= 0, new_age_codes[np.maximum(codes, 0) * len(increments) + increment_ids], -1)
+    return categorical.from_codes(
+        new_codes, categorical.extend(age.dtype, new_categories), age.index, age.name)
+
 def replace_with_missing(value, missing_value=np.nan):
-    if isinstance(value, pd.Series):
+    if categorical.is_categorical(value):
+        # Same categories, so that no values are materialized
+        codes, new_categories = categorical.encode([missing_value], value.cat.categories)
+        missing = categorical.from_codes(
+            np.repeat(codes, len(value)), categorical.extend(value.dtype, new_categories),
+            value.index, value.name)
+    elif isinstance(value, pd.Series):
         missing = pd.Series(missing_value, index=value.index, name=value.name)
+        # String dtypes like pandas' str only accept strings or their own missing values
+        if pd.isna(missing_value) and pd.api.types.is_string_dtype(value.dtype):
+            missing = missing.astype(value.dtype)
     else:
         missing = missing_value
     return missing
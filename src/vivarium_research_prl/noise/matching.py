@@ -0,0 +1,159 @@
+"""
+Module for finding the tokens of a substitution table (e.g., the OCR or
+phonetic variations used in corruption.py) in strings and batches of strings.
+"""
+
+import collections
+import numpy as np
+
+class AhoCorasickMatcher:
+    """Precompiled Aho-Corasick automaton for a fixed set of tokens.
+
+    Reports every (position, token) pair such that the token occurs in a
+    string starting at the position, including overlapping occurrences and
+    tokens that are prefixes of other tokens matching at the same position.
+    Matching takes time linear in the length of the strings, no matter how
+    many tokens there are.
+
+    The automaton is stored twice: as a list of dicts for walking a single
+    Python string, and as dense NumPy tables for walking a whole batch of
+    strings one character position at a time.
+    """
+    # Number of strings to convert to a padded array of code points at once
+    batch_size = 2**16
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self.token_lengths = np.array([len(token) for token in self.tokens], dtype=np.int64)
+        # The empty token can't be matched, so leave it out of the trie
+        tokens_to_match = [(i, token) for i, token in enumerate(self.tokens) if token]
+
+        # Build the trie
+        goto = [{}]
+        ends_here = [[]] # Ids of tokens ending at each state
+        for token_id, token in tokens_to_match:
+            state = 0
+            for char in token:
+                if char not in goto[state]:
+                    goto.append({})
+                    ends_here.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            ends_here[state].append(token_id)
+
+        # Compute failure links breadth-first, completing the transitions
+        # so that the automaton never has to follow a failure link at match time
+        alphabet = sorted({char for _, token in tokens_to_match for char in token})
+        num_states = len(goto)
+        fail = [0] * num_states
+        outputs = [list(ends_here[0])] + [None] * (num_states - 1)
+        transitions = [dict(goto[0])] + [None] * (num_states - 1)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            outputs[state] = ends_here[state] + outputs[fail[state]]
+            transitions[state] = dict(transitions[fail[state]])
+            for char, child in goto[state].items():
+                fail[child] = transitions[fail[state]].get(char, 0) if state else 0
+                transitions[state][char] = child
+                queue.append(child)
+        # Tokens ending at a state all have different lengths; list the longest first
+        self._outputs = [
+            sorted(state_outputs, key=lambda token_id: -self.token_lengths[token_id])
+            for state_outputs in outputs
+        ]
+        self._transitions = transitions
+
+        # Dense tables for batches. Symbol 0 stands for any character
+        # that doesn't appear in a token (including padding).
+        self._alphabet_codes = np.array([ord(char) for char in alphabet], dtype=np.uint32)
+        char_to_symbol = {char: symbol for symbol, char in enumerate(alphabet, start=1)}
+        self._delta = np.zeros((num_states, len(alphabet) + 1), dtype=np.int32)
+        for state, state_transitions in enumerate(transitions):
+            for char, next_state in state_transitions.items():
+                self._delta[state, char_to_symbol[char]] = next_state
+        max_outputs = max(len(state_outputs) for state_outputs in self._outputs)
+        self._output_table = np.full((num_states, max(max_outputs, 1)), -1, dtype=np.int64)
+        for state, state_outputs in enumerate(self._outputs):
+            self._output_table[state, :len(state_outputs)] = state_outputs
+
+    def iter_matches(self, string):
+        """Iterate over (start, token_id) pairs for all token matches in a
+        single string, in order of their end position, longest token first
+        for matches ending at the same position.
+        """
+        state = 0
+        transitions = self._transitions
+        outputs = self._outputs
+        token_lengths = self.token_lengths
+        for end, char in enumerate(string, start=1):
+            state = transitions[state].get(char, 0)
+            for token_id in outputs[state]:
+                yield end - token_lengths[token_id], token_id
+
+    def matches_by_start(self, string):
+        """Return a dict mapping each position in `string` where at least one
+        token matches to the list of ids of the matching tokens, longest first.
+        """
+        matches = collections.defaultdict(list)
+        for start, token_id in self.iter_matches(string):
+            matches[start].append(token_id)
+        for token_ids in matches.values():
+            token_ids.sort(key=lambda token_id: -self.token_lengths[token_id])
+        return matches
+
+    def find_matches(self, strings):
+        """Find all token matches in a sequence of strings.
+        Returns three int64 arrays of equal length: the index of the string
+        in `strings`, the start position of the match in that string, and
+        the id of the matched token (its index in self.tokens).
+        """
+        strings = np.asarray(strings, dtype=object)
+        results = [
+            self._find_matches_in_batch(strings[i:i+self.batch_size], offset=i)
+            for i in range(0, len(strings), self.batch_size)
+        ]
+        if not results:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, empty
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+    def _find_matches_in_batch(self, strings, offset=0):
+        symbols, lengths = self.to_symbols(strings)
+        # Walk the longest strings first so that the strings still being
+        # walked at each position are always a prefix of the batch
+        order = np.argsort(-lengths, kind='stable')
+        # One row per character position, for contiguous access while walking
+        symbols = np.ascontiguousarray(symbols[order].T)
+        num_active = np.searchsorted(-lengths[order], -np.arange(len(symbols)), side='left')
+
+        states = np.zeros(len(strings), dtype=np.int32)
+        rows, ends, token_ids = [], [], []
+        for position in range(len(symbols)):
+            n = num_active[position]
+            states[:n] = self._delta[states[:n], symbols[position, :n]]
+            outputs = self._output_table[states[:n]]
+            match_rows, match_slots = np.nonzero(outputs >= 0)
+            if len(match_rows):
+                rows.append(match_rows)
+                ends.append(np.full(len(match_rows), position + 1, dtype=np.int64))
+                token_ids.append(outputs[match_rows, match_slots])
+        if not rows:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, empty
+        rows = order[np.concatenate(rows)] + offset
+        token_ids = np.concatenate(token_ids)
+        starts = np.concatenate(ends) - self.token_lengths[token_ids]
+        return rows.astype(np.int64), starts, token_ids
+
+    def to_symbols(self, strings):
+        """Convert a sequence of strings to a 2D array of automaton symbols,
+        one row per string, padded with 0 on the right. Also returns the length
+        of each string.
+        """
+        strings = np.asarray(strings, dtype=str)
+        codes = strings.view(np.uint32).reshape(len(strings), strings.dtype.itemsize // 4)
+        index = np.searchsorted(self._alphabet_codes, codes).clip(max=len(self._alphabet_codes) - 1)
+        is_token_char = self._alphabet_codes[index] == codes
+        symbols = np.where(is_token_char, index + 1, 0)
+        return symbols, np.char.str_len(strings).astype(np.int64)
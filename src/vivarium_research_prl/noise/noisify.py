@@ -1,7 +1,25 @@
 """
 Module to apply noise to dataframe columns.
 """
-from . import corruption, fake_names
+import inspect
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from . import categorical, corruption, fake_names, random_streams
+
+# Modules whose functions can be named in noise specifications as 'module.function'
+NOISE_FUNCTION_MODULES = {'corruption': corruption, 'fake_names': fake_names}
+
+def get_noise_function(funckey):
+    """Look up a noise function by its name in the form 'module.function',
+    where module is a key of NOISE_FUNCTION_MODULES. Callables are returned as is.
+    """
+    if callable(funckey):
+        return funckey
+    module_name, funcname = funckey.split('.')
+    return getattr(NOISE_FUNCTION_MODULES[module_name], funcname)
 
 def apply_noise_function_to_column(
     df, colname, row_prob, rng, noise_function, args=None, kwargs=None,
@@ -9,6 +27,8 @@ def apply_noise_function_to_column(
 ):
     """Apply a noise function that operates on scalars or on pandas Series
     to a fraction of rows in a single column of a dataframe.
+    A categorical column stays categorical, with any new values the noise
+    function returns added to its categories.
     """
     if not inplace:
         df = df.copy()
@@ -23,31 +43,298 @@ def apply_noise_function_to_column(
     if corrupted.sum() > 0:
         if share_random_state:
             kwargs['random_state'] = rng
+        to_corrupt = df.loc[corrupted, colname]
         if vectorized:
-            df.loc[corrupted, colname] = noise_function(df.loc[corrupted, colname], *args, **kwargs)
+            noised = noise_function(to_corrupt, *args, **kwargs)
         else:
-            df.loc[corrupted, colname] = df.loc[corrupted, colname].map(
-                lambda element: noise_function(element, *args, **kwargs))
+            noised = _map_elements(to_corrupt, lambda element: noise_function(element, *args, **kwargs))
+            if isinstance(df[colname].dtype, pd.StringDtype) and noised.dtype != df[colname].dtype:
+                # Mapping can give a float Series (e.g., all NaN), and pandas string
+                # dtypes only accept strings or their own missing values
+                noised = noised.astype(df[colname].dtype)
+        if categorical.is_categorical(df[colname]):
+            # Writing new values into a categorical with .loc would raise an error
+            df[colname] = categorical.assign(df[colname], corrupted.to_numpy(), noised)
+        else:
+            df.loc[corrupted, colname] = noised
     if not inplace:
         return df
     else:
         return None
 
-def apply_noise_to_column(df, colname, rng, function_args_dict, inplace=False):
-    """Apply multiple noise functions to a column, using parameters specified in a dictionary."""
+def apply_noise_to_column(df, colname, rng, function_args_dict, inplace=False, stats=None):
+    """Apply multiple noise functions to a column, using parameters specified in a dictionary.
+
+    function_args_dict maps noise function names ('module.function', see
+    get_noise_function) to dicts of parameters with the key 'row_prob' and
+    the optional keys 'args', 'kwargs', 'vectorized', and 'share_random_state',
+    which have the same meaning as in apply_noise_function_to_column.
+    The functions are applied in order, each to a random subset of the rows
+    that are non-missing at that point.
+
+    If stats is a list, a dict with the column, the name of the noise function,
+    the number of rows it was applied to, and the time it took in seconds is
+    appended to it for each noise function. Vectorized noise functions with a
+    `stats` parameter (e.g., corruption.phonetic_corrupt) are passed a dict,
+    and whatever they record in it is included too.
+    """
     if not inplace:
         df = df.copy()
-    for funckey, params in function_args_dict.items():
-        module_name, funcname = funckey.split('.')
-        noise_func = getattr(globals()[module_name], funcname)
-        apply_noise_function_to_column(
-            df, colname, params['row_prob'], rng, noise_func,
-            params.get('args'), prams.get('kwargs'),
-            params.get('vectorized', True), params.get('share_random_state', True),
-            inplace=True
-        )
+    steps = compile_noise_steps(function_args_dict)
+    df[colname] = apply_noise_steps_to_series(df[colname], steps, rng, stats)
     if not inplace:
         return df
+    else:
+        return None
+
+def compile_noise_steps(function_args_dict):
+    """Convert a function_args_dict as in apply_noise_to_column to a list of
+    (name, noise function, parameters) tuples, looking up each function once
+    and filling in the defaults for the optional parameters.
+    """
+    steps = []
+    for funckey, params in function_args_dict.items():
+        noise_function = get_noise_function(funckey)
+        params = _normalize_noise_params(params)
+        params['reports_stats'] = (
+            _has_parameter(noise_function, 'stats') and 'stats' not in params['kwargs'])
+        steps.append((
+            funckey if isinstance(funckey, str) else funckey.__name__, noise_function, params))
+    return steps
+
+def _has_parameter(func, name):
+    try:
+        return name in inspect.signature(func).parameters
+    except (TypeError, ValueError): # Some builtins have no signature
+        return False
+
+class NoisePlan:
+    """Compiled plan for adding noise to several columns of a dataframe.
+
+    The plan is built from a specification mapping each column name to a
+    function_args_dict as in apply_noise_to_column, i.e., a dict mapping
+    noise function names ('module.function', see get_noise_function) to
+    dicts of parameters with the key 'row_prob' and the optional keys
+    'args', 'kwargs', 'vectorized', and 'share_random_state'. Since the
+    specification only contains names, lists, and numbers, it can also be
+    loaded from a YAML or JSON file.
+
+    The noise functions for each column are applied in order, each to a
+    random subset of the rows that are non-missing at that point, as if
+    they were applied one at a time with apply_noise_function_to_column.
+    However, the plan reads each column from the dataframe and writes it
+    back only once, draws the random rows chosen for all of the column's
+    noise functions at once, and keeps track of the missing values in the
+    column as it goes instead of recomputing them for each function.
+
+    If the plan is applied with a random_streams.RecordBoundGenerator bound
+    to the rows of the dataframe instead of a numpy Generator, the noise in
+    each row depends only on the generator's seed and the row's record id,
+    so applying the plan to each partition of a dataset separately gives
+    the same result as applying it to the whole dataset.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        # List of (name, noise function, parameters) tuples for each column
+        self.steps = {
+            colname: compile_noise_steps(function_args_dict)
+            for colname, function_args_dict in spec.items()
+        }
+
+    def apply(self, df, rng, inplace=False, verbose=False, stats=None):
+        """Apply the noise in the plan to df using the numpy Generator rng.
+        If stats is a list, per-function statistics are appended to it as in
+        apply_noise_to_column.
+        """
+        if not inplace:
+            df = df.copy()
+        for colname, steps in self.steps.items():
+            if verbose:
+                print(colname)
+            df[colname] = apply_noise_steps_to_series(df[colname], steps, rng, stats)
+        if not inplace:
+            return df
+        else:
+            return None
+
+    def apply_to_parquet(
+        self, input_path, output_path, random_state=None, record_id_column=None,
+        verbose=False, stats=None,
+    ):
+        """Apply the plan to a Parquet file, or a directory of Parquet files,
+        one row group at a time, so that only one row group is in memory at
+        once. Each noised row group is written to the directory output_path
+        as part.0.parquet, part.1.parquet, etc., like a Dask dataset.
+
+        The noise in each row is keyed by random_state and the row's integer
+        record id, taken from record_id_column or else the row's position in
+        the input (counting across row groups and files), so the result is
+        the same as applying the plan to the whole dataset at once with a
+        random_streams.RecordBoundGenerator bound to those ids.
+        Returns the number of rows written.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        # Fix the entropy so that every row group uses the same seed even if random_state is None
+        seed = np.random.SeedSequence(random_state).entropy
+        os.makedirs(output_path, exist_ok=True)
+        num_rows = 0
+        for part, table in enumerate(iter_parquet_row_groups(input_path)):
+            df = table.to_pandas(split_blocks=True, self_destruct=True)
+            del table
+            if verbose:
+                print(f'Row group {part}: {len(df)} rows')
+            if record_id_column is None:
+                record_ids = np.arange(num_rows, num_rows + len(df))
+            else:
+                record_ids = df[record_id_column].to_numpy(dtype=np.int64)
+            rng = random_streams.RecordBoundGenerator(seed, record_ids)
+            self.apply(df, rng, inplace=True, stats=stats)
+            # A RangeIndex of a row group would be wrong for the dataset as a whole
+            table = pa.Table.from_pandas(df, preserve_index=not isinstance(df.index, pd.RangeIndex))
+            pq.write_table(
+                _widen_dictionary_indices(table), os.path.join(output_path, f'part.{part}.parquet'))
+            num_rows += len(df)
+        return num_rows
+
+def apply_noise_steps_to_series(series, steps, rng, stats=None):
+    """Apply a sequence of steps as returned by compile_noise_steps to a Series
+    and return the noised Series. The eligible rows for all steps are drawn
+    with a single call to rng, and the Series is copied only once.
+    If stats is a list, per-function statistics are appended to it as in
+    apply_noise_to_column.
+
+    If rng is a random_streams.RecordBoundGenerator bound to the rows of the
+    Series, the random numbers for each row are keyed by the Series name,
+    the noise function, and the row's record id, so the result for a row
+    doesn't depend on which other rows are noised with it.
+
+    A categorical Series is noised in terms of its integer codes: each noise
+    function is passed a categorical Series, and any new values it returns
+    are added to the categories all at once at the end.
+    """
+    is_categorical = categorical.is_categorical(series)
+    if is_categorical:
+        codes = series.cat.codes.to_numpy(dtype=np.int64, copy=True)
+        dtype = series.dtype
+        notna = codes >= 0
+    else:
+        values = series.copy()
+        notna = values.notna().to_numpy(copy=True)
+    keyed = isinstance(rng, random_streams.RecordBoundGenerator)
+    if keyed:
+        # Key the random streams by column (and below by noise function), so
+        # that each record's noise doesn't depend on any other records
+        if len(rng) != len(series):
+            raise ValueError(f'rng is bound to {len(rng)} records but the Series has {len(series)}')
+        rng = rng.spawn(series.name)
+    row_probs = np.array([params['row_prob'] for _, _, params in steps], dtype=float)
+    # One column of eligibility per step; row k is chosen for step j if it's
+    # still non-missing when step j is applied
+    # (single precision is plenty for comparing with a probability, and halves the memory)
+    eligible = rng.random((len(series), len(steps)), dtype=np.float32) < row_probs
+    for j, (name, noise_function, params) in enumerate(steps):
+        start = time.perf_counter()
+        function_stats = {}
+        corrupted = eligible[:, j] & notna
+        num_rows = int(corrupted.sum())
+        # Don't try adding noise to empty Series, which can lead to errors
+        if num_rows > 0:
+            args, kwargs = params['args'], dict(params['kwargs'])
+            if params['share_random_state']:
+                kwargs['random_state'] = rng.spawn(name).restrict(corrupted) if keyed else rng
+            if is_categorical:
+                to_corrupt = categorical.from_codes(
+                    codes[corrupted], dtype, series.index[corrupted], series.name)
+            else:
+                to_corrupt = values[corrupted]
+            if params['vectorized']:
+                if stats is not None and params['reports_stats']:
+                    kwargs['stats'] = function_stats
+                noised = noise_function(to_corrupt, *args, **kwargs)
+            elif keyed and params['share_random_state']:
+                # Each scalar call gets a generator bound to its element's record
+                step_rng = kwargs.pop('random_state')
+                noised = pd.Series(
+                    [noise_function(element, *args, random_state=step_rng.restrict([i]), **kwargs)
+                     for i, element in enumerate(to_corrupt)],
+                    index=to_corrupt.index, dtype=object)
+            else:
+                noised = _map_elements(to_corrupt, lambda element: noise_function(element, *args, **kwargs))
+            if is_categorical:
+                codes[corrupted], new_categories = categorical.encode(noised, dtype.categories)
+                dtype = categorical.extend(dtype, new_categories)
+                notna[corrupted] = codes[corrupted] >= 0
+            else:
+                if isinstance(values.dtype, pd.StringDtype) and noised.dtype != values.dtype:
+                    # Mapping can give a float Series (e.g., all NaN), and pandas string
+                    # dtypes only accept strings or their own missing values
+                    noised = pd.Series(noised).astype(values.dtype)
+                values[corrupted] = noised
+                notna[corrupted] = values[corrupted].notna().to_numpy()
+        if stats is not None:
+            stats.append({
+                'column': series.name,
+                'function': name,
+                'num_rows': num_rows,
+                'seconds': time.perf_counter() - start,
+                **function_stats,
+            })
+    if is_categorical:
+        values = categorical.from_codes(codes, dtype, series.index, series.name)
+    return values
+
+def _map_elements(series, func):
+    """Apply func to each element of a Series. (Series.map would apply it
+    once per category of a categorical Series, giving every row with the
+    same value the same noise.)
+    """
+    if categorical.is_categorical(series):
+        series = series.astype(object)
+    return series.map(func)
+
+def iter_parquet_row_groups(path, columns=None):
+    """Iterate over the row groups of a Parquet file, or of all the .parquet
+    files in a directory (in natural order, so part.10 comes after part.9),
+    as pyarrow Tables, reading only the given columns if columns isn't None.
+    """
+    import pyarrow.parquet as pq
+    if os.path.isdir(path):
+        filenames = [name for name in os.listdir(path) if name.endswith('.parquet')]
+        natural_key = lambda name: [
+            int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+        paths = [os.path.join(path, name) for name in sorted(filenames, key=natural_key)]
+    else:
+        paths = [path]
+    for file_path in paths:
+        parquet_file = pq.ParquetFile(file_path)
+        for i in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(i, columns=columns, use_pandas_metadata=True)
+
+def _widen_dictionary_indices(table):
+    """Cast the dictionary (categorical) columns of a pyarrow Table to int32
+    indices, so that row groups whose categoricals got different numbers of
+    categories have the same schema.
+    """
+    import pyarrow as pa
+    fields = [
+        field.with_type(pa.dictionary(pa.int32(), field.type.value_type, field.type.ordered))
+        if pa.types.is_dictionary(field.type) else field
+        for field in table.schema
+    ]
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+def _normalize_noise_params(params):
+    """Fill in the defaults for the optional parameters of a noise function."""
+    args = params.get('args')
+    kwargs = params.get('kwargs')
+    return {
+        'row_prob': params['row_prob'],
+        'args': () if args is None else tuple(args),
+        'kwargs': {} if kwargs is None else dict(kwargs),
+        'vectorized': params.get('vectorized', True),
+        'share_random_state': params.get('share_random_state', True),
+    }
 
 def _locals_globals_test():
     a,b,c=1,2,3 # This is all that's in locals
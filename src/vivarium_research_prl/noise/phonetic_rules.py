@@ -0,0 +1,309 @@
+"""
+Module for compiling the context rules of the phonetic variations table
+(phonetic-variations.csv) into arrays that can be evaluated for all token
+matches in a batch of strings at once.
+
+The table is undocumented, so the conditions are interpreted as follows.
+All conditions are evaluated on the string with its ASCII letters lowercased, and a replacement is
+only allowed if all of its conditions hold.
+
+where
+    ALL (anywhere), START (the token starts the string), END (the token ends
+    the string), or MIDDLE (the token neither starts nor ends the string).
+pre, post
+    'V' or 'C': the character immediately before (pre) or after (post) the
+    token is a vowel or a consonant.
+    Otherwise a context condition like 'n;-1;t' or 'y;1;i;e', meaning
+    the text at the given offset from the token is (y) or is not (n) one of
+    the listed strings. Negative offsets count back from the start of the
+    token and anchor the end of the listed strings ('y;-1;ai' means the
+    token is preceded by 'ai'); positive offsets count forward from the end
+    of the token and anchor the start of the listed strings ('n;1;hu' means
+    the token is not followed by 'hu'). Several context conditions joined
+    by '|' must all hold.
+pattern
+    'y;slavo' or 'n;slavo': the string looks (or doesn't look) Slavo-Germanic,
+    i.e., contains one of SLAVO_GERMANIC_MARKERS. Otherwise a condition like
+    'n;rgy;ogy', meaning the string contains (y) or doesn't contain (n) one of
+    the listed strings.
+start
+    A condition like 'y;van;von', meaning the string starts (y) or doesn't
+    start (n) with one of the listed strings.
+"""
+
+import numpy as np
+import pandas as pd
+
+VOWELS = 'aeiouy'
+SLAVO_GERMANIC_MARKERS = ('w', 'k', 'cz')
+
+# Codes for the 'where' condition
+ALL, START, END, MIDDLE = range(4)
+_WHERE_CODES = {'ALL': ALL, 'START': START, 'END': END, 'MIDDLE': MIDDLE}
+# Codes for single-character 'pre' and 'post' conditions, which are compared
+# to the class of the neighboring character
+NO_CONDITION, VOWEL, CONSONANT = range(3)
+_CHAR_CLASS_CODES = {'V': VOWEL, 'C': CONSONANT}
+
+_vowel_codes = np.array([ord(char) for char in VOWELS], dtype=np.uint32)
+# Translation table for lowercasing only the ASCII letters of a string
+ASCII_LOWERCASE = str.maketrans(
+    ''.join(map(chr, range(ord('A'), ord('Z') + 1))),
+    ''.join(map(chr, range(ord('a'), ord('z') + 1))))
+
+def _is_missing(condition):
+    return pd.isna(condition) or condition == 'None'
+
+def parse_context_condition(condition):
+    """Parse a context condition like 'y;-1;u|y;-3;c;g;l;r;t' into a list of
+    (required, offset, alternatives) tuples that must all be satisfied.
+    """
+    parsed = []
+    for part in condition.split('|'):
+        required, offset, *alternatives = part.split(';')
+        parsed.append((required == 'y', int(offset), tuple(alternatives)))
+    return parsed
+
+def parse_string_condition(condition, kind):
+    """Parse a 'pattern' or 'start' condition into a (required, kind, alternatives)
+    tuple, where kind is 'contains' or 'startswith'.
+    """
+    required, *alternatives = condition.split(';')
+    if kind == 'contains' and alternatives == ['slavo']:
+        alternatives = SLAVO_GERMANIC_MARKERS
+    return (required == 'y', kind, tuple(alternatives))
+
+class PhoneticRules:
+    """Compiled conditions for the replacements of every token in a
+    substitution table.
+
+    The replacements of each token are numbered by slot, in the same order
+    as in the table's replacement lists. The 'where' condition and the
+    single-character 'pre' and 'post' conditions are precompiled into
+    bitmasks of allowed slots, indexed by token and by the position or
+    neighboring character class of a match, so that evaluating them for all
+    matches at once takes a few array lookups.
+    The few rules with context or whole-string conditions are listed
+    separately and evaluated only for matches of their token.
+    """
+    def __init__(self, tokens, rule_lists):
+        """`rule_lists[i]` is a list with one mapping per replacement for
+        tokens[i], with keys 'where', 'pre', 'post', 'pattern', and 'start'.
+        """
+        self.tokens = list(tokens)
+        self.token_lengths = np.array([len(token) for token in self.tokens], dtype=np.int64)
+        num_slots = max(len(rules) for rules in rule_lists)
+        shape = (len(self.tokens), num_slots)
+        self.has_rule = np.zeros(shape, dtype=bool)
+        self.where = np.full(shape, ALL, dtype=np.int8)
+        self.pre = np.full(shape, NO_CONDITION, dtype=np.int8)
+        self.post = np.full(shape, NO_CONDITION, dtype=np.int8)
+        # (token_id, slot, context conditions, string conditions)
+        self.special_rules = []
+        # Parsed conditions of each rule, for evaluating one match at a time
+        self._parsed_rules = [[] for _ in self.tokens]
+        for token_id, rules in enumerate(rule_lists):
+            for slot, rule in enumerate(rules):
+                self.has_rule[token_id, slot] = True
+                self.where[token_id, slot] = _WHERE_CODES[rule['where']]
+                context_conditions = []
+                for column, codes in [('pre', self.pre), ('post', self.post)]:
+                    condition = rule[column]
+                    if _is_missing(condition):
+                        continue
+                    elif condition in _CHAR_CLASS_CODES:
+                        codes[token_id, slot] = _CHAR_CLASS_CODES[condition]
+                    else:
+                        context_conditions += parse_context_condition(condition)
+                string_conditions = [
+                    parse_string_condition(rule[column], kind)
+                    for column, kind in [('pattern', 'contains'), ('start', 'startswith')]
+                    if not _is_missing(rule[column])
+                ]
+                if context_conditions or string_conditions:
+                    self.special_rules.append(
+                        (token_id, slot, context_conditions, string_conditions))
+                self._parsed_rules[token_id].append((
+                    int(self.where[token_id, slot]), int(self.pre[token_id, slot]),
+                    int(self.post[token_id, slot]), context_conditions, string_conditions))
+        self.slot_bits = np.left_shift(1, np.arange(num_slots, dtype=np.int64))
+
+        # Bitmasks of the slots allowed by the 'where' condition, indexed by
+        # token and position class (bit 0: match starts the string, bit 1: match ends it)
+        at_start = (np.arange(4) & 1).astype(bool)[:, None, None]
+        at_end = (np.arange(4) & 2).astype(bool)[:, None, None]
+        where_ok = self.has_rule & (
+            (self.where == ALL)
+            | ((self.where == START) & at_start)
+            | ((self.where == END) & at_end)
+            | ((self.where == MIDDLE) & ~at_start & ~at_end)
+        )
+        self.where_masks = np.ascontiguousarray((where_ok @ self.slot_bits).T)
+        # Bitmasks of the slots allowed by the 'pre' and 'post' conditions,
+        # indexed by token and the character class of the neighboring character
+        char_classes = np.arange(3)[:, None, None]
+        self.pre_masks, self.post_masks = [
+            np.ascontiguousarray(
+                (((conditions == NO_CONDITION) | (conditions == char_classes)) @ self.slot_bits).T)
+            for conditions in [self.pre, self.post]
+        ]
+
+    @classmethod
+    def from_dataframe(cls, df_phonetic):
+        """Compile the rules in a DataFrame with the columns of phonetic-variations.csv,
+        grouping replacements by original token in the same order as
+        corruption.generate_phonetic_error_dict.
+        """
+        return cls(*rules_by_token(df_phonetic))
+
+    def allowed_slots(self, lowered, start, token_id):
+        """Return a list with one boolean per replacement slot of the token,
+        saying whether the replacement is allowed for the match of the token
+        at position `start` in `lowered`, the string with its ASCII letters
+        lowercased.
+        This is a pure-Python equivalent of allowed_replacements for a
+        single match, which is much faster for scalar strings.
+        """
+        end = start + len(self.tokens[token_id])
+        at_start, at_end = start == 0, end == len(lowered)
+        before = _char_class(lowered[start-1]) if start > 0 else NO_CONDITION
+        after = _char_class(lowered[end]) if not at_end else NO_CONDITION
+        allowed = []
+        for where, pre, post, context_conditions, string_conditions in self._parsed_rules[token_id]:
+            ok = (
+                where == ALL
+                or (where == START and at_start)
+                or (where == END and at_end)
+                or (where == MIDDLE and not at_start and not at_end)
+            )
+            ok = ok and pre in (NO_CONDITION, before) and post in (NO_CONDITION, after)
+            for required, offset, alternatives in context_conditions:
+                if not ok:
+                    break
+                found = False
+                for alternative in alternatives:
+                    position = start + offset - len(alternative) + 1 if offset < 0 else end + offset - 1
+                    if position >= 0 and lowered[position:position+len(alternative)] == alternative:
+                        found = True
+                ok = (found == required)
+            for required, kind, alternatives in string_conditions:
+                if not ok:
+                    break
+                if kind == 'contains':
+                    found = any(alternative in lowered for alternative in alternatives)
+                else:
+                    found = lowered.startswith(alternatives)
+                ok = (found == required)
+            allowed.append(ok)
+        return allowed
+
+    def allowed_replacements(self, strings, rows, starts, token_ids):
+        """Return an int64 bitmask for each token match, with bit j set if the
+        replacement in slot j of the matched token is allowed in the match's context.
+        Matches are specified as in matching.AhoCorasickMatcher.find_matches.
+        """
+        strings = np.asarray(strings, dtype=str)
+        codes = _ascii_lower(
+            strings.view(np.uint32).reshape(len(strings), strings.dtype.itemsize // 4))
+        lengths = np.char.str_len(strings).astype(np.int64)[rows]
+        ends = starts + self.token_lengths[token_ids]
+        position_class = (starts == 0) + 2 * (ends == lengths)
+
+        allowed = (
+            self.where_masks[token_ids, position_class]
+            & self.pre_masks[token_ids, _char_classes(codes, rows, starts - 1, lengths)]
+            & self.post_masks[token_ids, _char_classes(codes, rows, ends, lengths)]
+        )
+
+        if self.special_rules and len(token_ids):
+            # Group matches by token so each special rule only looks at its own token's matches
+            order = np.argsort(token_ids, kind='stable')
+            bounds = np.searchsorted(token_ids[order], np.arange(len(self.tokens) + 1))
+            for token_id, slot, context_conditions, string_conditions in self.special_rules:
+                matches = order[bounds[token_id]:bounds[token_id+1]]
+                if len(matches) == 0:
+                    continue
+                ok = (allowed[matches] & self.slot_bits[slot]) != 0
+                for required, offset, alternatives in context_conditions:
+                    found = _context_found(
+                        codes, rows[matches], starts[matches], ends[matches],
+                        lengths[matches], offset, alternatives)
+                    ok &= (found == required)
+                if string_conditions:
+                    lowered = codes[rows[matches]].view(strings.dtype).ravel()
+                for required, kind, alternatives in string_conditions:
+                    found = _string_condition_found(lowered, kind, alternatives)
+                    ok &= (found == required)
+                allowed[matches[~ok]] &= ~self.slot_bits[slot]
+
+        return allowed
+
+def rules_by_token(df_phonetic):
+    """Group the rules in a DataFrame with the columns of phonetic-variations.csv
+    by original token, in the same order as corruption.generate_phonetic_error_dict.
+    Returns a sorted list of tokens and a list with the rules for each token
+    (the `rule_lists` argument of PhoneticRules), with missing conditions as None.
+    """
+    columns = ['where', 'pre', 'post', 'pattern', 'start']
+    rules = {}
+    for token, *conditions in df_phonetic[['orig'] + columns].itertuples(index=False):
+        if _is_missing(token):
+            continue
+        rules.setdefault(token, []).append({
+            column: None if _is_missing(condition) else condition
+            for column, condition in zip(columns, conditions)
+        })
+    tokens = sorted(rules)
+    return tokens, [rules[token] for token in tokens]
+
+def _ascii_lower(codes):
+    """Lowercase an array of code points, changing only the ASCII letters A-Z
+    (like str.translate(ASCII_LOWERCASE) for a single string).
+    """
+    is_upper = (codes >= ord('A')) & (codes <= ord('Z'))
+    return np.where(is_upper, codes + (ord('a') - ord('A')), codes).astype(np.uint32)
+
+def _char_class(char):
+    """Classify a single lowercase character like _char_classes."""
+    if char in VOWELS:
+        return VOWEL
+    elif 'a' <= char <= 'z':
+        return CONSONANT
+    else:
+        return NO_CONDITION
+
+def _char_classes(codes, rows, positions, lengths):
+    """Classify the character at each (row, position) as VOWEL, CONSONANT, or,
+    if it is outside the string or not a letter, NO_CONDITION.
+    """
+    inside = (positions >= 0) & (positions < lengths)
+    chars = np.where(inside, codes[rows, positions.clip(0, codes.shape[1] - 1)], 0)
+    is_vowel = np.isin(chars, _vowel_codes)
+    is_consonant = (chars >= ord('a')) & (chars <= ord('z')) & ~is_vowel
+    return np.select([is_vowel, is_consonant], [VOWEL, CONSONANT], NO_CONDITION)
+
+def _context_found(codes, rows, starts, ends, lengths, offset, alternatives):
+    """Check whether one of the alternatives appears at the given offset from each match."""
+    found = np.zeros(len(rows), dtype=bool)
+    for alternative in alternatives:
+        width = len(alternative)
+        if offset < 0:
+            positions = starts + offset - width + 1
+        else:
+            positions = ends + offset - 1
+        matches = (positions >= 0) & (positions + width <= lengths)
+        for j, char in enumerate(alternative):
+            chars = codes[rows, (positions + j).clip(0, codes.shape[1] - 1)]
+            matches &= (chars == ord(char))
+        found |= matches
+    return found
+
+def _string_condition_found(lowered, kind, alternatives):
+    """Check whether each lowercased string contains or starts with one of the alternatives."""
+    found = np.zeros(len(lowered), dtype=bool)
+    for alternative in alternatives:
+        if kind == 'contains':
+            found |= np.char.find(lowered, alternative) >= 0
+        else:
+            found |= np.char.startswith(lowered, alternative)
+    return found
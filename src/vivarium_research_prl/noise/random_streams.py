@@ -0,0 +1,183 @@
+"""
+Module for drawing random numbers that are keyed by record instead of by
+position in a sequential stream, so that any subset of a dataset can be
+noised independently (e.g., one partition per worker) with exactly the same
+result as noising the whole dataset at once.
+
+The random numbers for a record are computed with the counter-based Philox4x32-10
+generator, using a key derived from a seed and a path of names (e.g., the
+column and the noise function) and a counter made of the record id, the
+number of the draw, and the position within the draw. Nothing depends on
+how many other records are processed or in which order.
+"""
+
+import hashlib
+import numpy as np
+
+# Philox4x32 constants (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3", 2011)
+_PHILOX_M0 = np.uint64(0xD2511F53)
+_PHILOX_M1 = np.uint64(0xCD9E8D57)
+_PHILOX_W0 = np.uint32(0x9E3779B9)
+_PHILOX_W1 = np.uint32(0xBB67AE85)
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+def philox4x32(counter, key, rounds=10):
+    """Compute the Philox4x32 block function for arrays of counters.
+    `counter` is a sequence of four arrays of uint32 (broadcastable against
+    each other) and `key` is a pair of uint32. Returns four uint32 arrays.
+    """
+    c0, c1, c2, c3 = np.broadcast_arrays(*[np.asarray(word, dtype=np.uint32) for word in counter])
+    k0, k1 = np.uint32(key[0]), np.uint32(key[1])
+    with np.errstate(over='ignore'):
+        for _ in range(rounds):
+            product0 = _PHILOX_M0 * c0.astype(np.uint64)
+            product1 = _PHILOX_M1 * c2.astype(np.uint64)
+            hi0, lo0 = (product0 >> np.uint64(32)).astype(np.uint32), (product0 & _MASK32).astype(np.uint32)
+            hi1, lo1 = (product1 >> np.uint64(32)).astype(np.uint32), (product1 & _MASK32).astype(np.uint32)
+            c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+            k0, k1 = k0 + _PHILOX_W0, k1 + _PHILOX_W1
+    return c0, c1, c2, c3
+
+def name_to_int(name):
+    """Convert a name (any object with a stable str) to a 64-bit integer that
+    is the same in every process, unlike hash().
+    """
+    return int.from_bytes(hashlib.sha256(str(name).encode()).digest()[:8], 'little')
+
+class RecordBoundGenerator:
+    """Random number generator bound to a sequence of records.
+
+    Supports the subset of the numpy.random.Generator interface used by the
+    noise functions (random, uniform, integers, and choice), with the
+    restriction that the first dimension of `size` must equal the number of
+    records: row i of each result is drawn for record i. Scalars (size=None)
+    can be drawn when the generator is bound to a single record.
+
+    Each call to one of these methods is one draw, and successive draws
+    give independent random numbers. Use restrict() to get a generator for a
+    subset of the records that continues from the same draw, and spawn() to
+    get an independent generator for a named sub-task.
+    """
+    def __init__(self, seed, record_ids, path=(), draw=0):
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.path = tuple(path)
+        self.key = np.random.SeedSequence(
+            self.seed_sequence.entropy, spawn_key=self.path).generate_state(2, dtype=np.uint32)
+        record_ids = np.asarray(record_ids)
+        if not np.issubdtype(record_ids.dtype, np.integer):
+            raise TypeError(f'record ids must be integers, not {record_ids.dtype}')
+        record_ids = record_ids.astype(np.int64).view(np.uint64)
+        self.record_ids = record_ids
+        self._ids_lo = (record_ids & _MASK32).astype(np.uint32)
+        self._ids_hi = (record_ids >> np.uint64(32)).astype(np.uint32)
+        self.draw = draw
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def spawn(self, name):
+        """Return an independent generator for the same records, keyed by
+        this generator's path extended by `name`.
+        """
+        return RecordBoundGenerator(
+            self.seed_sequence.entropy, self.record_ids, self.path + (name_to_int(name),))
+
+    def restrict(self, rows):
+        """Return a generator for the records selected by `rows` (a boolean
+        mask or an array of positions), continuing from the current draw.
+        This generator's own state is unchanged.
+        """
+        restricted = RecordBoundGenerator.__new__(RecordBoundGenerator)
+        restricted.seed_sequence, restricted.path, restricted.key = self.seed_sequence, self.path, self.key
+        rows = np.asarray(rows)
+        restricted.record_ids = self.record_ids[rows]
+        restricted._ids_lo, restricted._ids_hi = self._ids_lo[rows], self._ids_hi[rows]
+        restricted.draw = self.draw
+        return restricted
+
+    def random_at(self, rows, positions):
+        """Draw one uniform float in [0, 1) for each (row, position) pair,
+        where rows index this generator's records and positions are any
+        nonnegative integers less than 2**32 that are distinct within a row.
+        """
+        c0, c1, _, _ = philox4x32(
+            (self._ids_lo[rows], self._ids_hi[rows], self.draw, positions), self.key)
+        self.draw += 1
+        return _to_unit_interval(c0, c1)
+
+    def random(self, size=None, dtype=np.float64):
+        shape = self._check_size(size)
+        width = int(np.prod(shape[1:], dtype=np.int64))
+        positions = np.arange(width, dtype=np.uint32)
+        u = self.random_at(np.arange(len(self))[:, None], positions[None, :])
+        u = u.reshape(shape).astype(dtype, copy=False)
+        return u[0] if size is None else u
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return low + (high - low) * self.random(size)
+
+    def integers(self, low, high=None, size=None):
+        """Draw integers in [low, high), or in [0, low) if high is None."""
+        if high is None:
+            low, high = 0, low
+        return low + np.floor(self.random(size) * (high - low)).astype(np.int64)
+
+    def choice(self, a, size=None, replace=True, p=None, shuffle=True):
+        """Draw from a sequence (or from range(a) if a is an int) with
+        replacement, optionally with probabilities p.
+        """
+        if not replace:
+            raise ValueError('RecordBoundGenerator can only choose with replacement')
+        if isinstance(a, (int, np.integer)):
+            population, num_choices = None, int(a)
+        else:
+            population = np.asarray(a)
+            num_choices = len(population)
+        u = self.random(size)
+        if p is None:
+            index = np.floor(u * num_choices).astype(np.int64)
+        else:
+            cdf = np.cumsum(p)
+            cdf /= cdf[-1]
+            index = np.searchsorted(cdf, u, side='right').clip(max=num_choices - 1)
+        return index if population is None else population[index]
+
+    def _check_size(self, size):
+        if size is None:
+            if len(self) != 1:
+                raise ValueError(
+                    f'can only draw a scalar from a generator bound to 1 record, not {len(self)}')
+            return (1,)
+        shape = (size,) if np.ndim(size) == 0 else tuple(size)
+        if shape[0] != len(self):
+            raise ValueError(
+                f'size {size} must start with the number of records ({len(self)})')
+        return shape
+
+def _to_unit_interval(hi, lo):
+    """Convert pairs of uint32 words to floats in [0, 1) with 53 random bits."""
+    bits = (hi.astype(np.uint64) << np.uint64(32)) | lo.astype(np.uint64)
+    return (bits >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+def as_generator(random_state=None):
+    """Like np.random.default_rng, but pass RecordBoundGenerators through unchanged."""
+    if isinstance(random_state, RecordBoundGenerator):
+        return random_state
+    return np.random.default_rng(random_state)
+
+def restrict(rng, rows):
+    """Restrict a RecordBoundGenerator to a subset of its records, as in
+    RecordBoundGenerator.restrict. Other generators are returned unchanged,
+    since their draws aren't tied to records.
+    """
+    if isinstance(rng, RecordBoundGenerator):
+        return rng.restrict(rows)
+    return rng
+
+def random_at(rng, rows, positions):
+    """Draw one uniform float for each (row, position) pair, as in
+    RecordBoundGenerator.random_at. Other generators just draw len(rows) floats.
+    """
+    if isinstance(rng, RecordBoundGenerator):
+        return rng.random_at(rows, positions)
+    return rng.random(len(rows))
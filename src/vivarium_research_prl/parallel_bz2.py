@@ -0,0 +1,102 @@
+"""
+Module for decompressing .bz2 files on several cores.
+
+A bzip2 stream is a sequence of independently compressed blocks (of up to
+900 kB of uncompressed data), each starting with a 48-bit magic number. The
+blocks aren't byte-aligned, so we find the magic numbers at every bit offset,
+rewrap each block as a one-block bzip2 stream, and decompress the streams in
+a pool of threads (the bz2 module releases the GIL while decompressing).
+The CRCs of each block are checked by the decompressor, and any failure
+(e.g., from a false match of the magic number inside compressed data) falls
+back to decompressing the whole file in one thread.
+"""
+
+import bz2
+import concurrent.futures
+import os
+
+BLOCK_MAGIC = 0x314159265359 # Start of each compressed block
+END_OF_STREAM_MAGIC = 0x177245385090 # Start of the footer of each stream
+_MAGIC_BITS = 48
+
+def find_bit_pattern(data, pattern, nbits=_MAGIC_BITS):
+    """Return the sorted bit offsets in the bytes `data` at which the nbits-bit
+    integer `pattern` occurs (most significant bit first), for nbits >= 48.
+    """
+    offsets = []
+    window_bytes = (nbits + 7) // 8 + 1
+    for shift in range(8):
+        # The bytes that are fully covered by the pattern when it starts at bit `shift`
+        shifted = pattern << (8 * window_bytes - nbits - shift)
+        window = shifted.to_bytes(window_bytes, 'big')
+        key = window[1:(shift + nbits) // 8]
+        position = data.find(key)
+        while position >= 0:
+            start = position - 1
+            if start >= 0 and 8 * start + shift + nbits <= 8 * len(data):
+                # Zero-padded if the pattern ends in the last byte of data
+                window = data[start:start + window_bytes].ljust(window_bytes, b'\0')
+                value = int.from_bytes(window, 'big')
+                value >>= 8 * window_bytes - nbits - shift
+                if value & ((1 << nbits) - 1) == pattern:
+                    offsets.append(8 * start + shift)
+            position = data.find(key, position + 1)
+    return sorted(offsets)
+
+def split_blocks(data):
+    """Split the bzip2 data (the bytes of a .bz2 file, possibly with several
+    concatenated streams) into a list of standalone one-block bzip2 streams
+    whose decompressed data concatenate to the decompressed file.
+    Returns None if the data doesn't look like bzip2 data with any blocks.
+    """
+    if not data.startswith(b'BZh'):
+        return None
+    block_starts = find_bit_pattern(data, BLOCK_MAGIC)
+    block_ends = sorted(block_starts[1:] + find_bit_pattern(data, END_OF_STREAM_MAGIC))
+    if not block_starts or len(block_ends) < len(block_starts):
+        return None
+    streams = []
+    end_index = 0
+    for start in block_starts:
+        # Each block ends at the next block or end-of-stream magic number
+        while end_index < len(block_ends) and block_ends[end_index] <= start:
+            end_index += 1
+        if end_index == len(block_ends):
+            return None
+        streams.append(_block_to_stream(data, start, block_ends[end_index]))
+    return streams
+
+def _block_to_stream(data, start, end):
+    """Make a one-block bzip2 stream from the bits start:end of data."""
+    first_byte, last_byte = start // 8, (end + 7) // 8
+    nbits = end - start
+    block = int.from_bytes(data[first_byte:last_byte], 'big') >> (8 * last_byte - end)
+    block &= (1 << nbits) - 1
+    # The stream's CRC is the CRC of its only block, which follows the block's magic number
+    block_crc = (block >> (nbits - _MAGIC_BITS - 32)) & 0xFFFFFFFF
+    stream = (((block << _MAGIC_BITS) | END_OF_STREAM_MAGIC) << 32) | block_crc
+    nbits += _MAGIC_BITS + 32
+    padding = -nbits % 8
+    # Level 9 allows the largest blocks, so it works for blocks compressed at any level
+    return b'BZh9' + (stream << padding).to_bytes((nbits + padding) // 8, 'big')
+
+def decompress(data, max_workers=None):
+    """Decompress bzip2 data (e.g., the bytes of a .bz2 file) using a pool of
+    max_workers threads (os.cpu_count() by default).
+    """
+    streams = split_blocks(data)
+    if streams is None or len(streams) == 1:
+        return bz2.decompress(data)
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            return b''.join(pool.map(bz2.decompress, streams))
+    except (OSError, ValueError, EOFError):
+        # E.g., the block magic number occurred by chance inside a block
+        return bz2.decompress(data)
+
+def decompress_file(path, max_workers=None):
+    """Read and decompress a .bz2 file using a pool of max_workers threads."""
+    with open(path, 'rb') as file:
+        return decompress(file.read(), max_workers)
@@ -0,0 +1,137 @@
+import functools
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vivarium_research_prl import arrow_cache, data_loading, datatypes
+
+def make_filter(min_age):
+    def keep_older(df):
+        return df[df['age'] >= min_age]
+    return keep_older
+
+def add_column(df, name, values=None):
+    df[name] = values if values is not None else 0
+    return df
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'observer_1.csv'
+    pd.DataFrame({'age': [1, 20, 50], 'sex': ['Male', 'Female', 'Male']}).to_csv(path, index=False)
+    return path
+
+@pytest.fixture
+def cache(tmp_path):
+    return arrow_cache.ArrowCache(tmp_path / 'cache')
+
+def test_key_of_closures(cache, source):
+    path = functools.partial(cache.cache_path, pd.read_csv, source)
+    assert path(transform=make_filter(18)) == path(transform=make_filter(18))
+    assert path(transform=make_filter(18)) != path(transform=make_filter(65))
+    assert path(transform=make_filter(18)) != path(transform=lambda df: df[df['age'] >= 18])
+    assert path(transform=make_filter(18)) != path()
+
+def test_key_of_partials_and_defaults(cache, source):
+    path = functools.partial(cache.cache_path, pd.read_csv, source)
+    add_a = functools.partial(add_column, name='a')
+    assert path(transform=add_a) == path(transform=functools.partial(add_column, name='a'))
+    assert path(transform=add_a) != path(transform=functools.partial(add_column, name='b'))
+    assert path(transform=lambda df, n=1: df) != path(transform=lambda df, n=2: df)
+
+def test_key_of_arrays(cache, source):
+    path = functools.partial(cache.cache_path, add_column, source, 'a')
+    values = np.arange(10_000)
+    changed = values.copy()
+    changed[5_000] = -1 # Not in the (truncated) repr
+    assert repr(changed) == repr(values)
+    assert path(values) == path(values.copy())
+    assert path(values) != path(changed)
+    assert path(values) != path(values.astype(np.int32))
+    assert path(pd.Series(values)) == path(pd.Series(values.copy()))
+    assert path(pd.Series(values)) != path(pd.Series(changed))
+    assert path(pd.DataFrame({'a': values})) != path(pd.DataFrame({'b': values}))
+    assert path([values, {'x': values}]) != path([values, {'x': changed}])
+
+def test_key_of_recursive_closure(cache, source):
+    def countdown(n):
+        return countdown(n - 1) if n else n
+    assert cache.cache_path(pd.read_csv, source, transform=countdown) == (
+        cache.cache_path(pd.read_csv, source, transform=countdown))
+
+KEY_SCRIPT = """
+import functools, sys
+from vivarium_research_prl import arrow_cache, data_loading, datatypes
+cache = arrow_cache.ArrowCache(sys.argv[1])
+print(cache.cache_path(
+    data_loading.load_shards_and_concatenate, sys.argv[2], '.csv', seeds=[1, 2],
+    transform=functools.partial(datatypes.convert_string_ids_to_ints, string_id_cols=['simulant_id'])))
+"""
+
+def test_key_is_the_same_in_another_process(cache, source):
+    # Nothing in the key may depend on memory addresses
+    path = cache.cache_path(
+        data_loading.load_shards_and_concatenate, source.parent, '.csv', seeds=[1, 2],
+        transform=functools.partial(datatypes.convert_string_ids_to_ints, string_id_cols=['simulant_id']))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    result = subprocess.run(
+        [sys.executable, '-c', KEY_SCRIPT, cache.cache_dir, str(source.parent)],
+        capture_output=True, text=True, check=True, env=env)
+    assert result.stdout.strip() == str(path)
+
+def test_source_changes_make_new_entries(cache, source):
+    file_key = cache.cache_path(pd.read_csv, source)
+    dir_key = cache.cache_path(data_loading.load_shards_and_concatenate, source.parent, '.csv')
+    os.utime(source, ns=(0, source.stat().st_mtime_ns + 1))
+    assert cache.cache_path(pd.read_csv, source) != file_key
+    file_key = cache.cache_path(pd.read_csv, source)
+    (source.parent / 'observer_2.csv').write_text('age,sex\n')
+    assert cache.cache_path(pd.read_csv, source) == file_key
+    assert cache.cache_path(data_loading.load_shards_and_concatenate, source.parent, '.csv') != dir_key
+
+calls = [] # Not in read_csv's closure, which is part of the key
+
+def read_csv(path, **kwargs):
+    calls.append(path)
+    return pd.read_csv(path, **kwargs)
+
+def test_load_uses_the_cache(cache, source):
+    calls.clear()
+    first = cache.load(read_csv, source, transform=make_filter(18))
+    second = cache.load(read_csv, source, transform=make_filter(18))
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(first, second)
+    assert first['age'].tolist() == [20, 50]
+    # Rewriting the source loads it again
+    pd.DataFrame({'age': [30], 'sex': ['Female']}).to_csv(source, index=False)
+    os.utime(source, ns=(0, source.stat().st_mtime_ns + 1))
+    assert cache.load(read_csv, source, transform=make_filter(18))['age'].tolist() == [30]
+    assert len(calls) == 2
+
+def test_evicts_least_recently_used(cache, tmp_path):
+    paths = []
+    for i in range(4):
+        path = tmp_path / f'observer_{i}.csv'
+        pd.DataFrame({'value': np.arange(1000) + i}).to_csv(path, index=False)
+        cache.load(pd.read_csv, path)
+        paths.append(cache.cache_path(pd.read_csv, path))
+    entry_bytes = os.path.getsize(paths[0])
+    # Used in the order 2, 0, 3, 1
+    for mtime, path in zip([2, 0, 3, 1], paths):
+        os.utime(path, (mtime, mtime))
+    cache.max_bytes = 2 * entry_bytes
+    cache.evict()
+    assert [os.path.exists(path) for path in paths] == [True, False, True, False]
+    # The file to keep stays even if it's the least recently used
+    os.utime(paths[2], (0, 0))
+    cache.max_bytes = 0
+    cache.evict(keep=paths[2])
+    assert [os.path.exists(path) for path in paths] == [False, False, True, False]
+    # Loading from the cache marks the file as used
+    cache.load(pd.read_csv, tmp_path / 'observer_2.csv')
+    assert os.path.getmtime(paths[2]) > 0
+    cache.clear()
+    assert cache.size() == 0
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vivarium_research_prl.noise import benchmarks, corruption, noisify
+
+STRING_DTYPES = [object, 'str', 'string', 'string[pyarrow]', 'large_string[pyarrow]']
+
+@pytest.mark.parametrize('string_dtype', STRING_DTYPES)
+def test_benchmarks_run_for_string_dtype(string_dtype):
+    results = benchmarks.run_noise_benchmarks(
+        sizes=(200,), modes=('vectorized', 'scalar'), string_dtype=string_dtype,
+        random_state=1, measure_memory=False)['results']
+    assert len(results) == 2 * len(benchmarks.NOISE_FUNCTION_CASES)
+    for result in results:
+        assert not result['skipped']
+        assert result['rows_per_sec'] > 0, result['case']
+
+@pytest.mark.parametrize('string_dtype', STRING_DTYPES)
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_replace_with_missing_keeps_string_dtype(string_dtype, vectorized):
+    df = pd.DataFrame({'name': pd.Series(['Ann', 'Bo', 'Cy'], dtype=string_dtype)})
+    noised = noisify.apply_noise_function_to_column(
+        df, 'name', 1.0, np.random.default_rng(0), corruption.replace_with_missing,
+        vectorized=vectorized, share_random_state=False)
+    assert noised['name'].dtype == df['name'].dtype
+    assert noised['name'].isna().all()
+
+def test_timing_doesnt_change_the_input():
+    df = benchmarks.synthetic_columns(100, random_state=0)
+    before = df.copy()
+    benchmarks.time_noise_function(
+        df, 'first_name', 'corruption.ocr_corrupt', args=(0.5,), random_state=0,
+        measure_memory=False)
+    pd.testing.assert_frame_equal(df, before)
+
+@pytest.mark.parametrize('string_dtype', STRING_DTYPES)
+def test_noise_plan_maps_scalar_functions_over_string_dtype(string_dtype):
+    df = pd.DataFrame({'name': pd.Series(['Ann', 'Bo', 'Cy'], dtype=string_dtype)})
+    plan = noisify.NoisePlan({'name': {
+        'corruption.replace_with_missing': dict(
+            row_prob=1.0, vectorized=False, share_random_state=False),
+    }})
+    noised = plan.apply(df, np.random.default_rng(0))
+    assert noised['name'].dtype == df['name'].dtype
+    assert noised['name'].isna().all()
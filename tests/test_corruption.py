@@ -0,0 +1,203 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vivarium_research_prl.noise import corruption, random_streams
+
+# Outputs of keyboard_corrupt(truth, 0.3, addl_pr, seed) before the scalar
+# corruptors were rewritten to share corrupt_string
+KEYBOARD_REFERENCE = [
+    ('christopher', 1, 0, 'chgistolher'),
+    ('christopher', 1, 0.5, 'chgristolher'),
+    ('123 main st', 7, 0, '123 hwin sg'),
+    ('mary-jane', 42, 1, 'mary-hjamne'),
+]
+
+@pytest.mark.parametrize('truth, seed, addl_pr, expected', KEYBOARD_REFERENCE)
+def test_seeded_keyboard_corrupt_is_unchanged(truth, seed, addl_pr, expected):
+    assert corruption.keyboard_corrupt(truth, 0.3, addl_pr, random_state=seed) == expected
+
+# Seeded comparisons of the distributions of the vectorized noise functions
+# with the scalar ones (or with the exact conditional distribution)
+
+NUM_DRAWS = 4000
+NAMES = ['christopher', 'Philip', 'schwarzenegger', 'Ng', "O'Neil", 'mcknight', 'Tschaikowsky', 'A']
+
+def assert_same_distribution(left, right, alpha=1e-3):
+    """Chi-squared test that two samples of values come from the same
+    distribution, pooling the values that are rare in both samples.
+    """
+    from scipy.stats import chi2_contingency
+    counts = pd.DataFrame({
+        'left': pd.Series(left).value_counts(), 'right': pd.Series(right).value_counts(),
+    }).fillna(0)
+    is_rare = counts.sum(axis=1) < 10
+    counts = pd.concat([counts[~is_rare], counts[is_rare].sum().to_frame('rare').T])
+    counts = counts[counts.sum(axis=1) > 0]
+    if len(counts) < 2: # E.g., a string with nothing to corrupt
+        return
+    assert chi2_contingency(counts.to_numpy().T).pvalue > alpha, counts
+
+def scalar_sample(corrupt, truth, *args):
+    return [corrupt(truth, *args, random_state=seed) for seed in range(NUM_DRAWS)]
+
+TOKEN_CORRUPTORS = [
+    ('ocr', corruption.ocr_corrupt, (0.2,)),
+    ('phonetic', corruption.phonetic_corrupt, (0.3,)),
+    ('keyboard', corruption.keyboard_corrupt, (0.05, 0.5)),
+]
+
+@pytest.mark.parametrize('kind, corrupt, args', TOKEN_CORRUPTORS, ids=[kind for kind, *_ in TOKEN_CORRUPTORS])
+@pytest.mark.parametrize('truth', NAMES)
+def test_vectorized_token_corruption_matches_scalar(kind, corrupt, args, truth):
+    vectorized = corrupt(pd.Series([truth] * NUM_DRAWS), *args, random_state=0)
+    assert_same_distribution(vectorized, scalar_sample(corrupt, truth, *args))
+
+@pytest.mark.parametrize('kind, corrupt, args', TOKEN_CORRUPTORS, ids=[kind for kind, *_ in TOKEN_CORRUPTORS])
+def test_deduplicated_token_corruption_matches(kind, corrupt, args):
+    strings = pd.Series(np.random.default_rng(0).choice(NAMES + [None], 3 * NUM_DRAWS))
+    ids = np.arange(len(strings)) * 7 + 3
+    def record_bound():
+        return random_streams.RecordBoundGenerator(1234, ids)
+    stats = {}
+    deduplicated = corrupt(strings, *args, random_state=record_bound(), deduplicate=True, stats=stats)
+    assert stats['num_distinct'] == len(NAMES)
+    # Every row still gets its own draws, keyed by its record id
+    expected = corrupt(strings, *args, random_state=record_bound())
+    pd.testing.assert_series_equal(deduplicated, expected)
+    categorical = corrupt(strings.astype('category'), *args, random_state=record_bound())
+    pd.testing.assert_series_equal(categorical.astype(object), expected.astype(object))
+    # And with an unkeyed generator, only the distribution is the same
+    for truth in NAMES[:3]:
+        is_truth = (strings == truth).to_numpy()
+        deduplicated = corrupt(strings, *args, random_state=0, deduplicate=True)
+        assert_same_distribution(deduplicated[is_truth], scalar_sample(corrupt, truth, *args))
+
+def random_strings(num_strings, seed=0):
+    # Mostly letters that occur in the phonetic tokens, in both cases, with some punctuation
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list('aeiouchgkpstwyznrlmbdfAECHGKSTW -\''))
+    lengths = rng.integers(1, 12, num_strings)
+    return [''.join(rng.choice(alphabet, length)) for length in lengths]
+
+def test_phonetic_rule_bitmasks_match_scalar_rules():
+    table = corruption.get_substitution_table('phonetic')
+    strings = NAMES + random_strings(3000)
+    rows, starts, token_ids = table.matcher.find_matches(strings)
+    assert len(rows) > 10_000
+    allowed = table.rules.allowed_replacements(strings, rows, starts, token_ids)
+    lowered = [string.translate(corruption.ASCII_LOWERCASE) for string in strings]
+    expected = [
+        sum(ok << slot for slot, ok in enumerate(table.rules.allowed_slots(lowered[row], start, token_id)))
+        for row, start, token_id in zip(rows.tolist(), starts.tolist(), token_ids.tolist())
+    ]
+    np.testing.assert_array_equal(allowed, expected)
+    # The rules do restrict the replacements, but not all of them
+    full = np.left_shift(1, table.num_replacements[token_ids]) - 1
+    assert 0 < np.mean(allowed != full) < 1
+
+@pytest.mark.parametrize('truth', random_strings(5, seed=1))
+def test_vectorized_phonetic_corruption_of_random_strings_matches_scalar(truth):
+    vectorized = corruption.phonetic_corrupt(pd.Series([truth] * NUM_DRAWS), 0.5, random_state=0)
+    assert_same_distribution(vectorized, scalar_sample(corruption.phonetic_corrupt, truth, 0.5))
+
+# Choices with a repeated value, a value with no probability, and a value that has most of it
+CHOICES = np.array(['a', 'b', 'c', 'b', 'd', 'e'])
+P = np.array([0.05, 0.1, 0.6, 0.15, 0.0, 0.1])
+
+def conditional_probabilities(current):
+    mass = pd.Series(P).groupby(CHOICES).sum()
+    mass[mass.index == current] = 0
+    return (mass / mass.sum()).to_dict()
+
+def assert_matches_probabilities(sample, probabilities, alpha=1e-3):
+    """Chi-squared test that a sample comes from the distribution with the
+    given probabilities (a dict from value to probability).
+    """
+    from scipy.stats import chisquare
+    counts = pd.Series(sample).value_counts()
+    assert set(counts.index) <= {value for value, pr in probabilities.items() if pr > 0}
+    expected = pd.Series(probabilities)
+    expected = expected[expected > 0] * len(sample)
+    observed = counts.reindex(expected.index, fill_value=0)
+    assert chisquare(observed, expected).pvalue > alpha, (observed, expected)
+
+@pytest.mark.parametrize('current', ['a', 'b', 'c', 'd', 'z'])
+def test_explicit_exclusion_matches_conditional_distribution(current):
+    current_choice = pd.Series([current] * NUM_DRAWS, index=np.arange(NUM_DRAWS)[::-1])
+    new_choice = corruption.random_different_choice_via_explicit_exclusion(
+        current_choice, CHOICES, p=P, random_state=0)
+    assert new_choice.index.equals(current_choice.index)
+    assert_matches_probabilities(new_choice, conditional_probabilities(current))
+    # The same as drawing for one value at a time
+    scalar = [
+        corruption.random_different_choice_via_explicit_exclusion(current, CHOICES, p=P, random_state=seed)
+        for seed in range(NUM_DRAWS)
+    ]
+    assert_same_distribution(new_choice, scalar)
+
+def test_explicit_exclusion_of_mixed_current_values():
+    rng = np.random.default_rng(2)
+    current_choice = pd.Series(rng.choice(['a', 'b', 'c', 'z'], 4 * NUM_DRAWS))
+    new_choice = corruption.random_different_choice_via_explicit_exclusion(
+        current_choice, CHOICES, p=P, random_state=0)
+    assert (new_choice != current_choice).all()
+    for current in ['a', 'b', 'c', 'z']:
+        assert_matches_probabilities(
+            new_choice[current_choice == current], conditional_probabilities(current))
+
+def test_explicit_exclusion_without_other_choices_raises():
+    with pytest.raises(ValueError, match='No choices other than the current value'):
+        corruption.random_different_choice_via_explicit_exclusion(
+            pd.Series(['a', 'b']), np.array(['a', 'b']), p=[1.0, 0.0], random_state=0)
+
+class FixedDraws:
+    """Stands in for a generator whose uniform draws are all `value`, to put
+    the exclusion sampler's targets at the edges of the intervals.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def random(self, size):
+        return np.full(size, self.value)
+
+@pytest.mark.parametrize('draw, current, expected', [
+    # A target at the very start of the first value's interval
+    (-1e-12, 'a', 'b'),
+    # A target at the very end of the last value's interval
+    (1.0, 'e', 'd'),
+    (1.0, 'd', 'e'),
+])
+def test_exclusion_rounding_fix_up_at_the_edges(draw, current, expected):
+    choices = np.array(['a', 'b', 'c', 'd', 'e'])
+    p = np.array([0.5, 0.2, 0.0, 0.2, 0.1])
+    new_choice = corruption._draw_excluding_current(
+        pd.Series([current]), choices, p, FixedDraws(draw))
+    assert new_choice.tolist() == [expected]
+
+@pytest.mark.parametrize('max_rounds', [None, 0, 1, 3])
+def test_resampling_matches_conditional_distribution(max_rounds):
+    rng = np.random.default_rng(3)
+    current_choice = pd.Series(rng.choice(['b', 'c'], 4 * NUM_DRAWS, p=[0.2, 0.8]))
+    stats = {}
+    new_choice = corruption.random_different_choice_via_resampling(
+        current_choice, CHOICES, p=P, random_state=0, max_rounds=max_rounds, stats=stats)
+    assert (new_choice != current_choice).all()
+    for current in ['b', 'c']:
+        assert_matches_probabilities(
+            new_choice[current_choice == current], conditional_probabilities(current))
+    if max_rounds is None:
+        assert stats['rows_excluded'] == 0 and stats['rounds'] > 3
+    else:
+        assert stats['rounds'] == max_rounds and stats['rows_excluded'] > 0
+        exact = corruption.random_different_choice_via_explicit_exclusion(
+            current_choice, CHOICES, p=P, random_state=1)
+        assert_same_distribution(new_choice, exact)
+
+def test_scalar_resampling_with_max_rounds():
+    stats = {}
+    new_choices = []
+    for seed in range(NUM_DRAWS):
+        new_choices.append(corruption.random_different_choice_via_resampling(
+            'c', CHOICES, p=P, random_state=seed, max_rounds=1, stats=stats))
+    assert_matches_probabilities(new_choices, conditional_probabilities('c'))
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vivarium_research_prl import data_loading
+
+def write_shards(tmp_path, shards, ext):
+    for seed, shard in shards.items():
+        path = tmp_path / f'social_security_observer_{seed}{ext}'
+        if ext == '.parquet':
+            shard.to_parquet(path)
+        else:
+            shard.to_csv(path, index=False)
+
+@pytest.mark.parametrize('ext', ['.csv', '.csv.bz2', '.parquet'])
+def test_load_shards_ssns_to_uint32(tmp_path, ext):
+    shards = {
+        7: pd.DataFrame({'ssn': ['123-45-6789', None], 'age': [3, 40]}),
+        2: pd.DataFrame({'ssn': ['912701234', '123-45-6789'], 'age': [70, 8]}),
+    }
+    if ext == '.parquet':
+        shards[7]['ssn'] = shards[7]['ssn'].astype('category')
+    write_shards(tmp_path, shards, ext)
+    df = data_loading.load_shards_and_concatenate(tmp_path, ext, ssns_to_uint32=True)
+    assert df['ssn'].dtype == 'UInt32'
+    assert df['ssn'].tolist() == [912701234, 123456789, 123456789, pd.NA]
+
+def test_load_shards_malformed_ssns_raise(tmp_path):
+    write_shards(tmp_path, {1: pd.DataFrame({'ssn': ['123-45-678']})}, '.csv')
+    with pytest.raises(ValueError, match='malformed SSNs'):
+        data_loading.load_shards_and_concatenate(tmp_path, '.csv', ssns_to_uint32=True)
+
+QUERIES = [
+    'age < 5',
+    '5 < age <= 10',
+    'age == [1, 2]',
+    'year in (2020,)',
+    'state == "WA"',
+    'state in ["WA", "OR"]',
+    'sex == "Male" & age >= 90',
+    '(sex == "Male") and (state == "CA" or age > 95)',
+    'income > 5e4 or age < 3',
+    'income >= 9e4 | state == "OR"',
+    '90 <= age & income < 1e4',
+]
+UNSUPPORTED_QUERIES = [
+    'age != 3',
+    'state not in ["WA"]',
+    'age > income',
+    'not age < 5',
+    '~(age < 5)',
+    'sex.str.startswith("M")',
+    'income == income',
+    'age < 5 or sex != "Male"',
+]
+# Pushed down but rejected by the reader, so the query is applied after a full read
+REJECTED_QUERIES = ['age == "3"', 'state == 1', 'age in [1, "a"]', 'missing_column > 3']
+
+@pytest.fixture
+def parquet_dir(tmp_path):
+    rng = np.random.default_rng(1234)
+    for seed in [3, 1]:
+        n = 1000
+        pd.DataFrame({
+            'age': rng.integers(0, 100, n),
+            'income': np.where(rng.random(n) < 0.1, np.nan, rng.random(n) * 1e5),
+            'state': pd.Categorical(rng.choice(['WA', 'OR', 'CA', None], n)),
+            'sex': rng.choice(['Male', 'Female'], n),
+            'year': rng.integers(2019, 2023, n),
+            'simulant_id': np.arange(seed * n, (seed + 1) * n),
+        }).to_parquet(tmp_path / f'census_observer_{seed}.parquet', row_group_size=100)
+    return tmp_path
+
+@pytest.fixture
+def read_parquet_calls(monkeypatch):
+    calls = []
+    read_parquet = pd.read_parquet
+    def recording_read_parquet(path, **kwargs):
+        calls.append(kwargs.get('filters'))
+        return read_parquet(path, **kwargs)
+    monkeypatch.setattr(pd, 'read_parquet', recording_read_parquet)
+    return calls
+
+def assert_frames_match(got, expected):
+    # Pushed-down filters only keep the categories of the rows that are read
+    pd.testing.assert_frame_equal(got, expected, check_categorical=False)
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_pushed_down_query_matches_full_read(parquet_dir, read_parquet_calls, query):
+    assert data_loading._query_to_parquet_filters(query) is not None
+    full = data_loading.load_shards_and_concatenate(parquet_dir, '.parquet')
+    expected = full.query(query).reset_index(drop=True)
+    read_parquet_calls.clear()
+    got = data_loading.load_shards_and_concatenate(parquet_dir, '.parquet', filter_query=query)
+    assert all(filters is not None for filters in read_parquet_calls)
+    assert 0 < len(got) < len(full)
+    assert_frames_match(got, expected)
+
+@pytest.mark.parametrize('query', UNSUPPORTED_QUERIES)
+def test_unsupported_query_is_applied_after_reading(parquet_dir, read_parquet_calls, query):
+    assert data_loading._query_to_parquet_filters(query) is None
+    full = data_loading.load_shards_and_concatenate(parquet_dir, '.parquet')
+    got = data_loading.load_shards_and_concatenate(parquet_dir, '.parquet', filter_query=query)
+    assert all(filters is None for filters in read_parquet_calls)
+    assert_frames_match(got, full.query(query).reset_index(drop=True))
+
+@pytest.mark.parametrize('query', REJECTED_QUERIES)
+def test_rejected_filters_fall_back_to_full_read(parquet_dir, read_parquet_calls, query):
+    full = data_loading.load_shards_and_concatenate(parquet_dir, '.parquet')
+    read_parquet_calls.clear()
+    if query.startswith('missing_column'):
+        with pytest.raises(pd.errors.UndefinedVariableError):
+            data_loading.load_shards_and_concatenate(parquet_dir, '.parquet', filter_query=query)
+        return
+    got = data_loading.load_shards_and_concatenate(parquet_dir, '.parquet', filter_query=query)
+    # Each shard is read once with the filters and again without them
+    assert read_parquet_calls[0] is not None and read_parquet_calls[1] is None
+    assert_frames_match(got, full.query(query).reset_index(drop=True))
+
+def test_filters_keep_a_stored_index(parquet_dir, read_parquet_calls):
+    for path in parquet_dir.iterdir():
+        shard = pd.read_parquet(path)
+        # Shuffled, so that it's not stored as a RangeIndex
+        shard = shard.sample(frac=1, random_state=0).set_index('simulant_id')
+        shard.to_parquet(path, row_group_size=100)
+    query = 'sex == "Female" & age < 10'
+    full = data_loading.load_shards_and_concatenate(parquet_dir, '.parquet', ignore_index=False)
+    read_parquet_calls.clear()
+    got = data_loading.load_shards_and_concatenate(
+        parquet_dir, '.parquet', filter_query=query, ignore_index=False)
+    assert all(filters is not None for filters in read_parquet_calls)
+    assert_frames_match(got, full.query(query))
+
+def test_filters_are_not_pushed_down_for_a_range_index(parquet_dir, read_parquet_calls):
+    query = 'age < 5'
+    full = data_loading.load_shards_and_concatenate(parquet_dir, '.parquet', ignore_index=False)
+    read_parquet_calls.clear()
+    got = data_loading.load_shards_and_concatenate(
+        parquet_dir, '.parquet', filter_query=query, ignore_index=False)
+    assert all(filters is None for filters in read_parquet_calls)
+    assert_frames_match(got, full.query(query))
+
+def test_query_to_parquet_filters():
+    to_filters = data_loading._query_to_parquet_filters
+    assert to_filters('age < 5 & sex == "Male"') == [[('age', '<', 5), ('sex', '==', 'Male')]]
+    assert to_filters('5 > age') == [[('age', '<', 5)]]
+    assert to_filters('age < 5 | age > 90') == [[('age', '<', 5)], [('age', '>', 90)]]
+    assert to_filters('age == [1, 2]') == [[('age', 'in', [1, 2])]]
+    # The condition that can't be translated is left to the query
+    assert to_filters('age < 5 and age != 3') == [[('age', '<', 5)]]
+    assert to_filters('`first name` == "Ann"') is None
+    assert to_filters('@ages.max() > age') is None
+
+def make_shards(num_shards=6, seed=0):
+    rng = np.random.default_rng(seed)
+    states = np.array(['WA', 'OR', 'CA', 'ID', 'NV', 'AZ'])
+    shards = []
+    for i in range(num_shards):
+        n = int(rng.integers(0, 50)) if i else 30
+        # Each shard has its own subset of the categories, in its own order
+        shard_states = rng.permutation(rng.choice(states, rng.integers(1, len(states)), replace=False))
+        shards.append(pd.DataFrame({
+            'state': pd.Categorical(
+                rng.choice(np.append(shard_states, None), n), categories=shard_states),
+            'year': pd.Categorical(rng.integers(2019, 2019 + i + 1, n)),
+            'age': rng.integers(0, 100, n),
+            'income': rng.random(n),
+            'name': pd.Series(rng.choice(['Ann', 'Bo', None], n), dtype='str'),
+        }, index=rng.permutation(1000)[:n]))
+    return shards
+
+def concat_with_union_categoricals(shards, **kwargs):
+    expected = pd.concat(shards, **kwargs)
+    for col in shards[0]:
+        if isinstance(shards[0][col].dtype, pd.CategoricalDtype):
+            union = pd.api.types.union_categoricals([shard[col] for shard in shards], sort_categories=True)
+            expected[col] = pd.Series(union, index=expected.index)
+    return expected
+
+@pytest.mark.parametrize('num_rows', [None, 'exact', 1])
+def test_concat_conforming_categories_matches_union_categoricals(num_rows):
+    shards = make_shards()
+    num_rows = sum(map(len, shards)) if num_rows == 'exact' else num_rows
+    got = data_loading.concat_conforming_categories(shards, num_rows=num_rows)
+    expected = concat_with_union_categoricals(shards, ignore_index=True)
+    pd.testing.assert_frame_equal(got, expected)
+    assert got['state'].cat.categories.tolist() == sorted(got['state'].dropna().unique())
+
+def test_concat_conforming_categories_keeps_keyed_index():
+    shards = dict(zip([4, 2, 7, 1], make_shards(4, seed=1)))
+    got = data_loading.concat_conforming_categories(iter(shards.values()), ignore_index=False)
+    pd.testing.assert_frame_equal(got, concat_with_union_categoricals(list(shards.values())))
+    got = data_loading.concat_conforming_categories(shards, ignore_index=False)
+    pd.testing.assert_frame_equal(got, concat_with_union_categoricals(list(shards.values()), keys=shards.keys()))
+
+def test_concat_conforming_categories_of_mixed_dtypes():
+    # A 'str' column that's all missing, so float64, in some shards
+    shards = [
+        pd.DataFrame({'name': [np.nan, np.nan], 'age': [1, 2]}),
+        pd.DataFrame({'name': pd.Series(['Ann', None], dtype='str'), 'age': [3.5, 4]}),
+        pd.DataFrame({'name': [np.nan], 'age': [5]}),
+    ]
+    got = data_loading.concat_conforming_categories(shards)
+    pd.testing.assert_frame_equal(got, pd.concat(shards, ignore_index=True))
+
+def test_concat_conforming_categories_errors():
+    with pytest.raises(ValueError, match='No objects'):
+        data_loading.concat_conforming_categories([])
+    with pytest.raises(ValueError, match='different columns'):
+        data_loading.concat_conforming_categories([pd.DataFrame({'a': [1]}), pd.DataFrame({'b': [1]})])
+    with pytest.raises(TypeError, match='categorical in some shards'):
+        data_loading.concat_conforming_categories([
+            pd.DataFrame({'a': pd.Categorical(['x'])}), pd.DataFrame({'a': [1]})])
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vivarium_research_prl.find_kids import datasets
+
+def test_format_dates_matches_strftime():
+    dates = pd.Series(
+        pd.to_datetime(['2020-01-31', None, '1999-12-01', '2020-01-31', '1900-02-28']),
+        index=[5, 3, 8, 1, 2], name='date_of_birth')
+    expected = dates.dt.strftime('%Y-%m-%d')
+    formatted = datasets.format_dates(dates)
+    pd.testing.assert_series_equal(formatted.astype(object), expected.astype(object))
+
+def test_format_dates_of_many_distinct_days():
+    rng = np.random.default_rng(0)
+    dates = pd.Series(np.datetime64('1700-01-01') + rng.integers(0, 200_000, 1000))
+    assert formatted_equal(datasets.format_dates(dates), dates.dt.strftime('%Y-%m-%d'))
+
+def formatted_equal(left, right):
+    return (left.astype(object).to_numpy() == right.astype(object).to_numpy()).all()
+
+def test_fixed_width_offsets_past_int32():
+    # The offsets of 10-byte strings overflow int32 past 2**31 / 10 strings;
+    # wider strings reach that total size with far fewer of them
+    width = 2**20
+    num_strings = 2**31 // width + 10
+    offsets = datasets._fixed_width_offsets(num_strings, width)
+    assert offsets.dtype == np.int64
+    assert len(offsets) == num_strings + 1
+    assert (np.diff(offsets) == width).all()
+    assert offsets[-1] == width * num_strings > 2**31
+
+def test_format_dates_is_large_string_array():
+    import pyarrow as pa
+    dates = pd.Series(pd.to_datetime(['2001-02-03', None]))
+    formatted = datasets.format_dates(dates)
+    assert pa.array(formatted).type in (pa.large_string(), pa.string())
+    assert formatted.isna().tolist() == [False, True]
+
+@pytest.mark.parametrize('ages', [[-0.5, 1.5, 4.9, 7.0, np.nan], [-3.0, -0.01]])
+def test_wic_selection_only_draws_for_ages_in_table(ages):
+    df = pd.DataFrame({'age': ages, 'cause_of_death': 'not_dead', 'zipcode': '12345'})
+    included = datasets.select_random_wic_participants(df, random_state=1)
+    # Negative ages aren't in any WIC category, so they aren't subsampled (as in the original loop)
+    assert included[df['age'] < 0].all()
+    assert not included[(df['age'] >= 5) | df['age'].isna()].any()
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vivarium_research_prl import datatypes
+
+@pytest.mark.parametrize('dtype', [object, 'str', 'category'])
+def test_string_ids_round_trip(dtype):
+    ids = pd.Series(['0_1', '12_345', '7_-1', '9871_999999999', '3_0'], index=[4, 2, 9, 1, 0],
+                    name='simulant_id', dtype=dtype)
+    int_ids = datatypes.id_str_to_int(ids)
+    assert int_ids.tolist() == [1, 12_000_000_345, -1, 9871_999_999_999, 3_000_000_000]
+    assert int_ids.index.equals(ids.index)
+    assert int_ids.name == 'simulant_id'
+    # Missing ids of every seed map to the sentinel, which maps back to '0_-1'
+    expected = ids.astype(object).replace('7_-1', '0_-1')
+    assert datatypes.id_int_to_str(int_ids).astype(object).equals(expected)
+
+def test_int_ids_round_trip():
+    int_ids = pd.Series([-1, 0, 5, 10**9 + 7, 123 * 10**9 + 456], name='household_id')
+    strings = datatypes.id_int_to_str(int_ids)
+    assert strings.tolist() == ['0_-1', '0_0', '0_5', '1_7', '123_456']
+    assert datatypes.id_str_to_int(strings).equals(int_ids)
+
+def test_sentinel():
+    assert datatypes.id_str_to_int(pd.Series(['0_-1', '42_-1'])).tolist() == [-1, -1]
+    assert datatypes.id_int_to_str(pd.Series([-1])).tolist() == ['0_-1']
+
+def test_empty_ids():
+    assert len(datatypes.id_str_to_int(pd.Series([], dtype=object))) == 0
+
+@pytest.mark.parametrize('bad_id', ['12', '12_a', 'a_12', '', '1_2_3', '1__2'])
+def test_malformed_ids_raise(bad_id):
+    with pytest.raises(ValueError):
+        datatypes.id_str_to_int(pd.Series(['1_2', bad_id]))
+
+@pytest.mark.parametrize('missing', [None, np.nan])
+def test_missing_ids_raise(missing):
+    with pytest.raises(ValueError, match='missing'):
+        datatypes.id_str_to_int(pd.Series(['1_2', missing], dtype=object))
+
+SSNS = pd.Series(
+    ['123-45-6789', '987654321', None, '000-00-0000', '999-99-9999'], index=[3, 1, 4, 0, 2],
+    name='ssn', dtype=object)
+# ITINs start with 9 and have a fourth and fifth digit in 50-65, 70-88, 90-92, or 94-99
+ITINS = pd.Series(['912-70-1234', '900501234', '999-94-0000', np.nan], name='itin', dtype=object)
+
+@pytest.mark.parametrize('dtype', [object, 'str'])
+def test_ssn_to_uint32(dtype):
+    values = datatypes.ssn_to_uint32(SSNS.astype(dtype))
+    assert values.dtype == 'UInt32'
+    assert values.index.equals(SSNS.index) and values.name == 'ssn'
+    assert values.tolist() == [123456789, 987654321, pd.NA, 0, 999999999]
+
+def test_itins_to_uint32():
+    assert datatypes.ssn_to_uint32(ITINS).tolist() == [912701234, 900501234, 999940000, pd.NA]
+
+def test_ssn_to_int_uses_sentinel():
+    values = datatypes.ssn_to_int(SSNS)
+    assert values.dtype == 'int32'
+    assert values.tolist() == [123456789, 987654321, -1, 0, 999999999]
+
+MALFORMED = ['123-456-789', '12345678', '1234567890', '123 45 6789', '12a-45-6789', '123456-789', '']
+
+@pytest.mark.parametrize('bad_ssn', MALFORMED)
+def test_malformed_ssns_raise(bad_ssn):
+    ssns = pd.Series(['123-45-6789', bad_ssn], name='ssn')
+    with pytest.raises(ValueError, match='1 malformed SSNs'):
+        datatypes.ssn_to_uint32(ssns)
+    with pytest.raises(ValueError, match='1 malformed SSNs'):
+        datatypes.ssn_to_int(ssns)
+
+def test_malformed_ssns_coerce():
+    ssns = pd.Series(['123-45-6789'] + MALFORMED + [None], name='ssn')
+    with pytest.warns(UserWarning, match=f'{len(MALFORMED)} malformed SSNs'):
+        values = datatypes.ssn_to_uint32(ssns, errors='coerce')
+    assert values.tolist() == [123456789] + [pd.NA] * (len(MALFORMED) + 1)
+
+def test_ssn_errors_option_is_checked():
+    with pytest.raises(ValueError, match='errors must be'):
+        datatypes.ssn_to_uint32(pd.Series(['bad']), errors='ignore')
+
+def test_parse_ssns_masks():
+    values, is_valid, is_malformed = datatypes.parse_ssns(pd.Series(['123456789', None, 'x']))
+    assert values.dtype == np.uint32
+    assert values.tolist() == [123456789, 0, 0]
+    assert is_valid.tolist() == [True, False, False]
+    assert is_malformed.tolist() == [False, False, True]
+
+def test_load_csv_data_ssns_to_uint32(tmp_path):
+    path = tmp_path / 'observer_1.csv'
+    pd.DataFrame({'simulant_id': ['1_2', '1_3', '1_4'], 'ssn': ['123-45-6789', None, '987654321'],
+                  'itin': [None, '912-70-1234', None]}).to_csv(path, index=False)
+    for load in [datatypes.load_csv_data, datatypes.load_csv_data_parallel]:
+        df = load(path, convert_str_ids=True, ssns_to_uint32=True)
+        assert df['ssn'].dtype == 'UInt32' and df['itin'].dtype == 'UInt32'
+        assert df['ssn'].tolist() == [123456789, pd.NA, 987654321]
+        assert df['itin'].tolist() == [pd.NA, 912701234, pd.NA]
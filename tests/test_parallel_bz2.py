@@ -0,0 +1,77 @@
+import bz2
+
+import numpy as np
+import pytest
+
+from vivarium_research_prl import parallel_bz2
+
+def random_text(num_bytes, seed=0):
+    # Compressible, but not so much that the blocks hold much more than their level's size
+    rng = np.random.default_rng(seed)
+    return rng.choice(np.frombuffer(b'abcdefghij,0123456789\n', dtype=np.uint8), num_bytes).tobytes()
+
+DATA = random_text(2_500_000)
+
+@pytest.mark.parametrize('level', [1, 9])
+def test_decompress_matches_bz2(level):
+    compressed = bz2.compress(DATA, level)
+    streams = parallel_bz2.split_blocks(compressed)
+    # About 100 kB per block at level 1 and 900 kB at level 9
+    assert len(streams) == len(DATA) // (100_000 * level) + 1
+    assert parallel_bz2.decompress(compressed, max_workers=4) == bz2.decompress(compressed)
+
+def test_decompress_multiple_streams():
+    # E.g., from pbzip2 or concatenated .bz2 files
+    parts = [DATA[:1_000_000], DATA[1_000_000:1_000_010], DATA[1_000_010:]]
+    compressed = b''.join(bz2.compress(part, level) for part, level in zip(parts, [1, 9, 5]))
+    num_blocks = [len(parallel_bz2.split_blocks(bz2.compress(part, level)))
+                  for part, level in zip(parts, [1, 9, 5])]
+    assert num_blocks[1] == 1
+    assert len(parallel_bz2.split_blocks(compressed)) == sum(num_blocks)
+    assert parallel_bz2.decompress(compressed, max_workers=2) == bz2.decompress(compressed) == DATA
+
+@pytest.mark.parametrize('data', [b'', b'x', DATA[:1000]])
+def test_decompress_small_inputs(data):
+    compressed = bz2.compress(data)
+    assert parallel_bz2.decompress(compressed) == bz2.decompress(compressed) == data
+    assert parallel_bz2.decompress(b'') == bz2.decompress(b'') == b''
+
+def test_decompress_file(tmp_path):
+    path = tmp_path / 'observer_1.csv.bz2'
+    path.write_bytes(bz2.compress(DATA, 1))
+    assert parallel_bz2.decompress_file(path, max_workers=2) == DATA
+
+def test_false_block_magic_falls_back(monkeypatch):
+    compressed = bz2.compress(DATA, 1)
+    find_bit_pattern = parallel_bz2.find_bit_pattern
+    def find_bit_pattern_with_false_match(data, pattern, nbits=parallel_bz2._MAGIC_BITS):
+        offsets = find_bit_pattern(data, pattern, nbits)
+        if pattern == parallel_bz2.BLOCK_MAGIC:
+            # As if the magic number occurred by chance in the middle of the first block
+            offsets = sorted(offsets + [(offsets[0] + offsets[1]) // 2])
+        return offsets
+    monkeypatch.setattr(parallel_bz2, 'find_bit_pattern', find_bit_pattern_with_false_match)
+    streams = parallel_bz2.split_blocks(compressed)
+    with pytest.raises((OSError, ValueError)):
+        bz2.decompress(streams[0]) # The CRC check fails for the truncated block
+    assert parallel_bz2.decompress(compressed, max_workers=2) == DATA
+
+def test_corrupt_data_raises_like_bz2():
+    compressed = bytearray(bz2.compress(DATA, 1))
+    compressed[len(compressed) // 2] ^= 0xFF
+    with pytest.raises(OSError):
+        bz2.decompress(bytes(compressed))
+    with pytest.raises(OSError):
+        parallel_bz2.decompress(bytes(compressed), max_workers=2)
+
+def test_find_bit_pattern_at_every_shift():
+    rng = np.random.default_rng(1)
+    data = bytearray(rng.integers(0, 256, 200, dtype=np.uint8).tobytes())
+    as_int = int.from_bytes(data, 'big')
+    # Including at the start and end of data, at every shift within a byte
+    offsets = [0, 51, 100, 401, 807, 1205, 1403, 1470, 1600 - 48]
+    for offset in offsets:
+        shift = 8 * len(data) - 48 - offset
+        as_int = as_int & ~(((1 << 48) - 1) << shift) | (parallel_bz2.BLOCK_MAGIC << shift)
+    data = as_int.to_bytes(len(data), 'big')
+    assert parallel_bz2.find_bit_pattern(data, parallel_bz2.BLOCK_MAGIC) == offsets
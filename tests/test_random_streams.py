@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vivarium_research_prl.find_kids import noisify_data
+from vivarium_research_prl.noise import noisify, random_streams
+
+SEED = 1234
+
+def test_philox4x32_known_answers():
+    # Known-answer vectors for Philox4x32-10 from the Random123 library (kat_vectors)
+    cases = [
+        ((0, 0, 0, 0), (0, 0), (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)),
+        ((0xffffffff,) * 4, (0xffffffff,) * 2, (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd)),
+        (
+            (0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344), (0xa4093822, 0x299f31d0),
+            (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1),
+        ),
+    ]
+    for counter, key, expected in cases:
+        assert [int(word) for word in random_streams.philox4x32(counter, key)] == list(expected)
+
+def test_philox4x32_is_elementwise():
+    counters = [np.arange(5), np.arange(5, 10), np.arange(10, 15), np.arange(15, 20)]
+    key = (0xa4093822, 0x299f31d0)
+    batch = random_streams.philox4x32(counters, key)
+    for i in range(5):
+        single = random_streams.philox4x32([c[i] for c in counters], key)
+        assert [int(word[i]) for word in batch] == [int(word) for word in single]
+
+def make_census(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    first_names = np.array(['MARY', 'JAMES', 'PATRICIA', 'ROBERT', 'JENNIFER', 'MICHAEL'])
+    last_names = np.array(['SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'JONES', 'GARCIA'])
+    streets = np.array(['MAIN ST', 'OAK AVE', 'PINE RD', 'CEDAR LN'])
+    dates = pd.Timestamp('1950-01-01') + pd.to_timedelta(rng.integers(0, 25000, num_rows), unit='D')
+    return pd.DataFrame({
+        'first_name': rng.choice(first_names, num_rows),
+        'middle_initial': rng.choice(list('ABCDEFG'), num_rows),
+        'last_name': rng.choice(last_names, num_rows),
+        'age': rng.integers(0, 100, num_rows),
+        'date_of_birth': dates.strftime('%Y-%m-%d'),
+        'address': [
+            f'{number} {street}' for number, street in
+            zip(rng.integers(1, 9999, num_rows), rng.choice(streets, num_rows))
+        ],
+        'zipcode': [f'{zipcode:05d}' for zipcode in rng.integers(0, 100000, num_rows)],
+        'sex': rng.choice(['Male', 'Female'], num_rows),
+        'race_ethnicity': rng.choice(noisify_data.RACE_ETHNICITY_CHOICES, num_rows),
+    }, index=pd.RangeIndex(100, 100 + num_rows))
+
+@pytest.fixture(scope='module')
+def census():
+    return make_census(2000)
+
+@pytest.fixture(scope='module')
+def plan(census):
+    # A high row probability so that every noise function changes many rows
+    return noisify.NoisePlan(noisify_data.census_noise_spec(census, row_eligibility_rate=0.2))
+
+def noise_in_partitions(plan, df, num_partitions, order=None):
+    positions = np.arange(len(df)) if order is None else order
+    parts = []
+    for part_positions in np.array_split(positions, num_partitions):
+        part = df.iloc[part_positions]
+        rng = random_streams.RecordBoundGenerator(SEED, part.index.to_numpy())
+        parts.append(plan.apply(part, rng))
+    return pd.concat(parts).loc[df.index]
+
+@pytest.fixture(scope='module')
+def noised_whole(plan, census):
+    return plan.apply(census, random_streams.RecordBoundGenerator(SEED, census.index.to_numpy()))
+
+def test_plan_adds_noise(census, noised_whole):
+    for col in census:
+        assert (noised_whole[col] != census[col]).any(), col
+
+@pytest.mark.parametrize('num_partitions', [1, 4, 64])
+def test_partitioned_noise_matches_single_run(plan, census, noised_whole, num_partitions):
+    pd.testing.assert_frame_equal(noise_in_partitions(plan, census, num_partitions), noised_whole)
+
+def test_partitioned_noise_doesnt_depend_on_row_order(plan, census, noised_whole):
+    order = np.random.default_rng(1).permutation(len(census))
+    pd.testing.assert_frame_equal(noise_in_partitions(plan, census, 4, order), noised_whole)
+
+def test_noise_depends_on_seed(plan, census, noised_whole):
+    other = plan.apply(census, random_streams.RecordBoundGenerator(SEED + 1, census.index.to_numpy()))
+    assert not other.equals(noised_whole)